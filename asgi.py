@@ -0,0 +1,373 @@
+"""
+ASGI entry point for the Product Store Service
+Serves the /products routes of server.py from async_models, so that one
+event loop carries every request instead of a thread per request. Needs
+Python 3 and an ASGI server, e.g.:
+
+    uvicorn asgi:app --port 5000
+
+Paths:
+------
+GET /products - Returns a list all of the Products
+GET /products?category={category} - Returns the Products in a category
+GET /products?name={name} - Returns the Products with a name
+GET /products?color={color} - Returns the Products with a color
+GET /products?available=true - Returns the Products that are in stock
+GET /products?ids={ids} - Returns the Products with the given ids
+GET /products?limit={limit}&cursor={cursor} - Returns a page of Products
+GET /products?fields={fields} - Returns only some fields of the Products
+GET /products/available - Returns the Products that are in stock
+GET /products/{id} - Returns the Product with a given id number
+POST /products - creates a new Product record in the database
+PUT /products/{id} - updates a Product record in the database
+DELETE /products/{id} - deletes a Product record in the database
+PUT /products/{id}/add_unit - adds one unit to the count of a Product
+PUT /products/{id}/sell_products - sells one unit of a Product
+PUT /products/{id}/inventory - adds a delta to the count of a Product
+
+The list routes answer with an ETag and 304 Not Modified like server.py
+does, and PUT /products/{id} answers 412 Precondition Failed when its
+If-Match no longer holds the ETag of the Product. The q, sort, min_price and max_price parameters are answered with
+400 Bad Request, and these routes of server.py are not served here:
+POST /products/bulk, GET /products/export, GET /products/suggest,
+DELETE /products/reset, GET /healthcheck, GET /metrics and GET /ui.
+"""
+import re
+import json
+import logging
+import numbers
+import params
+from functools import wraps
+from urllib.parse import parse_qs, urlencode
+from werkzeug.http import parse_etags, quote_etag
+from async_models import AsyncProduct
+from models import Product, DataValidationError
+from models import NotFoundError, OutOfStockError, PreconditionFailedError
+
+# Status Codes
+HTTP_200_OK = 200
+HTTP_201_CREATED = 201
+HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
+HTTP_400_BAD_REQUEST = 400
+HTTP_404_NOT_FOUND = 404
+HTTP_405_METHOD_NOT_ALLOWED = 405
+HTTP_409_CONFLICT = 409
+HTTP_412_PRECONDITION_FAILED = 412
+HTTP_415_UNSUPPORTED_MEDIA_TYPE = 415
+
+# list parameters of server.py that this server does not implement
+UNSUPPORTED_ARGS = ('q', 'sort', 'min_price', 'max_price')
+
+logger = logging.getLogger(__name__)
+
+# (method, path pattern, handler) in the order they are tried
+ROUTES = []
+
+
+class HTTPError(Exception):
+    """ Ends a request with an error status and message """
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+def route(method, pattern):
+    """ Registers a handler for a method and a path pattern """
+    def decorator(handler):
+        ROUTES.append((method, re.compile('^{}$'.format(pattern)), handler))
+        return handler
+    return decorator
+
+
+class Request(object):
+    """ The parts of an ASGI request the handlers use """
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.args = dict((name, values[0]) for name, values in
+                         parse_qs(scope['query_string'].decode('latin-1')).items())
+        self.headers = dict((name.decode('latin-1').lower(),
+                             value.decode('latin-1'))
+                            for name, value in scope['headers'])
+        self.body = body
+        self.base_url = '{}://{}'.format(
+            scope.get('scheme', 'http'),
+            self.headers.get('host', 'localhost'))
+
+    def get_json(self):
+        """ Returns the JSON body, refusing other content types """
+        content_type = self.headers.get('content-type', '')
+        if content_type.split(';')[0].strip() != 'application/json':
+            raise HTTPError(HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            'Content-Type must be application/json')
+        try:
+            return json.loads(self.body.decode('utf-8'))
+        except ValueError:
+            raise HTTPError(HTTP_400_BAD_REQUEST, 'Invalid JSON body')
+
+
+async def catalog_etag(**kwargs):
+    """ Returns the unquoted ETag of any list of Products """
+    return str(await AsyncProduct.catalog_version())
+
+
+async def product_etag(product_id, **kwargs):
+    """ Returns the unquoted ETag of a Product, None if it has no version """
+    version = await AsyncProduct.get_version(product_id)
+    return str(version) if version is not None else None
+
+
+def conditional(etag_of):
+    """
+    Adds an ETag to the responses of a GET handler
+    When If-None-Match already holds the current ETag the handler is not
+    called at all and 304 Not Modified is returned.
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(request, **kwargs):
+            etag = await etag_of(**kwargs)
+            if etag is None:
+                return await handler(request, **kwargs)
+            headers = {'ETag': quote_etag(etag)}
+            if etag in parse_etags(request.headers.get('if-none-match')):
+                return None, HTTP_304_NOT_MODIFIED, headers
+            body, status, extra = (tuple(await handler(request, **kwargs))
+                                   + ({},))[:3]
+            return body, status, dict(extra, **headers)
+        return wrapper
+    return decorator
+
+
+######################################################################
+#  PATH: /products
+######################################################################
+@route('GET', '/products/?')
+@conditional(catalog_etag)
+async def list_products(request):
+    """ Returns the Products, filtered and paged like server.py does """
+    unsupported = [name for name in UNSUPPORTED_ARGS if name in request.args]
+    if unsupported:
+        raise HTTPError(HTTP_400_BAD_REQUEST,
+                        '{} not supported by the ASGI server'.format(
+                            ','.join(unsupported)))
+    ids = request.args.get('ids')
+    filters = dict((attribute, request.args[attribute])
+                   for attribute in Product.indexed_attributes
+                   if request.args.get(attribute))
+    available = params.get_flag_arg(request.args, 'available')
+    limit, after = params.get_page_args(request.args)
+    wanted = params.get_fields_arg(request.args)
+    if ids is not None:
+        if filters or available or limit:
+            raise HTTPError(HTTP_400_BAD_REQUEST,
+                            'ids cannot be combined with other query '
+                            'parameters')
+        products, missing = await AsyncProduct.find_many(
+            params.get_ids_arg(ids))
+        return {'products': serialized(products, wanted),
+                'missing': missing}, HTTP_200_OK
+    products, after = await AsyncProduct.filter(filters, available, limit,
+                                                after)
+    return serialized(products, wanted), HTTP_200_OK, \
+        next_page_headers(request, after)
+
+
+@route('POST', '/products/?')
+async def create_product(request):
+    """ Creates a Product from the data in the body """
+    product = Product().deserialize(request.get_json())
+    await AsyncProduct.save(product)
+    logger.info('Product with new id [%s] saved!', product.id)
+    location = '{}/products/{}'.format(request.base_url, product.id)
+    return product.serialize(), HTTP_201_CREATED, {'Location': location}
+
+
+@route('GET', '/products/available')
+@conditional(catalog_etag)
+async def list_available_products(request):
+    """ Returns the Products that are in stock """
+    limit, after = params.get_page_args(request.args)
+    products, after = await AsyncProduct.filter({}, True, limit, after)
+    return serialized(products, None), HTTP_200_OK, \
+        next_page_headers(request, after)
+
+
+######################################################################
+#  PATH: /products/{id}
+######################################################################
+@route('GET', r'/products/(?P<product_id>\d+)')
+@conditional(product_etag)
+async def get_product(request, product_id):
+    """ Returns the Product with the given id """
+    product = await AsyncProduct.find(product_id)
+    if not product:
+        raise HTTPError(HTTP_404_NOT_FOUND,
+                        "Product with id '{}' was not found.".format(product_id))
+    return product.serialize(), HTTP_200_OK
+
+
+@route('PUT', r'/products/(?P<product_id>\d+)')
+async def update_product(request, product_id):
+    """ Updates the Product with the given id from the body """
+    data = request.get_json()
+    product = await AsyncProduct.find(product_id)
+    if not product:
+        raise HTTPError(HTTP_404_NOT_FOUND,
+                        'Product with id [{}] was not found.'.format(product_id))
+    versions = None
+    if_match = parse_etags(request.headers.get('if-match'))
+    if if_match and not if_match.star_tag:
+        versions = if_match.as_set()
+    product.deserialize(data)
+    try:
+        # the version is checked in the same transaction as the write
+        await AsyncProduct.save(product, versions)
+    except PreconditionFailedError:
+        raise HTTPError(HTTP_412_PRECONDITION_FAILED,
+                        'Product with id [{}] has changed.'.format(product_id))
+    return product.serialize(), HTTP_200_OK, \
+        {'ETag': quote_etag(await product_etag(product_id))}
+
+
+@route('DELETE', r'/products/(?P<product_id>\d+)')
+async def delete_product(request, product_id):
+    """ Deletes the Product with the given id """
+    # a missing Product is not deleted, so the catalog version stays put
+    product = await AsyncProduct.find(product_id)
+    if product:
+        await AsyncProduct.delete(product_id)
+    return None, HTTP_204_NO_CONTENT
+
+
+@route('PUT', r'/products/(?P<product_id>\d+)/add_unit')
+async def add_product_unit(request, product_id):
+    """ Adds one unit to the count of a Product """
+    try:
+        product = await AsyncProduct.adjust_count(product_id, 1)
+    except NotFoundError as error:
+        return {'error': str(error)}, HTTP_404_NOT_FOUND
+    return product.serialize(), HTTP_200_OK
+
+
+@route('PUT', r'/products/(?P<product_id>\d+)/sell_products')
+async def sell_products(request, product_id):
+    """ Sells one unit of a Product if it is in stock """
+    try:
+        product = await AsyncProduct.adjust_count(product_id, -1)
+    except OutOfStockError as error:
+        return {'error': str(error)}, HTTP_200_OK
+    except NotFoundError as error:
+        return {'error': str(error)}, HTTP_404_NOT_FOUND
+    return product.serialize(), HTTP_200_OK
+
+
+@route('PUT', r'/products/(?P<product_id>\d+)/inventory')
+async def adjust_inventory(request, product_id):
+    """ Adds the delta in the body to the count of a Product """
+    payload = request.get_json()
+    delta = payload.get('delta') if isinstance(payload, dict) else None
+    if isinstance(delta, bool) or not isinstance(delta, numbers.Integral):
+        raise HTTPError(HTTP_400_BAD_REQUEST, 'delta must be an integer')
+    try:
+        product = await AsyncProduct.adjust_count(product_id, delta)
+    except OutOfStockError as error:
+        return {'error': str(error)}, HTTP_409_CONFLICT
+    except NotFoundError as error:
+        return {'error': str(error)}, HTTP_404_NOT_FOUND
+    return product.serialize(), HTTP_200_OK
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+def serialized(products, wanted):
+    """ Returns the dictionaries of Products, of only the wanted fields """
+    results = [product.serialize() for product in products]
+    if wanted:
+        return [dict((field, data[field]) for field in wanted)
+                for data in results]
+    return results
+
+
+def next_page_headers(request, after):
+    """ Returns a Link header to the page after the given id, if any """
+    if after is None:
+        return {}
+    args = dict(request.args, cursor=params.encode_cursor(after))
+    return {'Link': '<{}{}?{}>; rel="next"'.format(
+        request.base_url, request.path, urlencode(sorted(args.items())))}
+
+
+######################################################################
+#  A S G I   A P P L I C A T I O N
+######################################################################
+async def dispatch(request):
+    """ Runs the handler of the first route matching the request """
+    allowed = False
+    for method, pattern, handler in ROUTES:
+        match = pattern.match(request.path)
+        if not match:
+            continue
+        if method != request.method:
+            allowed = True
+            continue
+        kwargs = dict((name, int(value))
+                      for name, value in match.groupdict().items())
+        try:
+            return await handler(request, **kwargs)
+        except DataValidationError as error:
+            raise HTTPError(HTTP_400_BAD_REQUEST, str(error))
+    if allowed:
+        raise HTTPError(HTTP_405_METHOD_NOT_ALLOWED, 'Method not allowed')
+    raise HTTPError(HTTP_404_NOT_FOUND, 'Not found')
+
+
+async def read_body(receive):
+    """ Reads the whole body of a request """
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def lifespan(receive, send):
+    """ Connects to Redis when the server starts """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await AsyncProduct.init_db()
+            except Exception as error:  # pylint: disable=broad-except
+                await send({'type': 'lifespan.startup.failed',
+                            'message': str(error)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ The ASGI application """
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    request = Request(scope, await read_body(receive))
+    try:
+        result = await dispatch(request)
+    except HTTPError as error:
+        result = {'status': error.status, 'message': str(error)}, error.status
+    body, status, headers = (tuple(result) + ({},))[:3]
+    payload = b'' if body is None else json.dumps(body).encode('utf-8')
+    raw_headers = [(b'content-type', b'application/json'),
+                   (b'content-length', str(len(payload)).encode('ascii'))]
+    raw_headers += [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers.items()]
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': raw_headers})
+    await send({'type': 'http.response.body', 'body': payload})
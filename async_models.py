@@ -0,0 +1,396 @@
+"""
+Asyncio Product Model that uses Redis
+The data access of models.Product on an asyncio Redis client, so that a
+single event loop can wait on Redis for many requests at once. Products
+are read and written exactly as models.Product does, with the same
+storage layout, codec, indexes and versions, so both models can share
+one database. Methods take and return models.Product objects.
+
+Needs Python 3 and redis-py 4.2 or later for redis.asyncio. You must call
+AsyncProduct.init_db() from the event loop before use.
+"""
+import os
+import json
+import asyncio
+import logging
+from collections import OrderedDict
+from redis.asyncio import Redis, ConnectionPool, BlockingConnectionPool
+from redis.asyncio.retry import Retry
+from redis.backoff import NoBackoff
+from redis.exceptions import ConnectionError, TimeoutError, WatchError
+import connection
+from models import Product, PreconditionFailedError, _text
+from models import ADJUST_COUNT_SCRIPT, ADJUST_HASH_COUNT_SCRIPT
+
+logger = logging.getLogger(__name__)
+
+
+class RetryingRedis(Redis):
+    """
+    An asyncio Redis client that retries commands which failed to reach Redis
+    It follows the rules of connection.RetryingRedis: only the
+    connection.IDEMPOTENT_COMMANDS are retried, with exponential backoff,
+    and timeouts only with retry_on_timeout. The connections themselves
+    never retry, or INCR and EVALSHA could run twice.
+    """
+
+    def __init__(self, retries=0, retry_backoff=0.05, retry_on_timeout=False,
+                 **kwargs):
+        super(RetryingRedis, self).__init__(**kwargs)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_on_timeout = retry_on_timeout
+
+    async def execute_command(self, *args, **options):
+        attempt = 0
+        while True:
+            try:
+                return await super(RetryingRedis, self).execute_command(
+                    *args, **options)
+            except (ConnectionError, TimeoutError) as error:
+                if attempt >= self.retries or \
+                        not connection.idempotent(args) or (
+                            isinstance(error, TimeoutError) and
+                            not self.retry_on_timeout):
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning('Redis %s failed (%s), retrying in %.2fs',
+                               args[0], error, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+def create_client(host, port, password, **options):
+    """ Creates an asyncio Redis client on a new connection pool """
+    options = connection.get_options(options)
+    pool_options = dict(host=host, port=port, password=password,
+                        max_connections=options['max_connections'],
+                        socket_timeout=options['socket_timeout'],
+                        socket_connect_timeout=options['connect_timeout'],
+                        retry=Retry(NoBackoff(), 0))
+    if options['blocking']:
+        pool = BlockingConnectionPool(timeout=options['pool_timeout'],
+                                      **pool_options)
+    else:
+        pool = ConnectionPool(**pool_options)
+    return RetryingRedis(connection_pool=pool,
+                         retries=options['retries'],
+                         retry_backoff=options['retry_backoff'],
+                         retry_on_timeout=options['retry_on_timeout'])
+
+
+class AsyncProduct(object):
+    """ Async data access for Products """
+    logger = logging.getLogger(__name__)
+    redis = None
+    __scripts = {}
+
+    @staticmethod
+    async def save(product, versions=None):
+        """
+        Saves a Product, giving it a new id when its id is 0
+        Args:
+            product (Product): the Product to save
+            versions (list): when given, only save an existing Product
+                             while it has one of these versions
+        Raises:
+            PreconditionFailedError: if the Product has another version
+        """
+        if product.id == 0:
+            product.id = await AsyncProduct.redis.incr(Product.counter_key)
+            pipe = AsyncProduct.redis.pipeline()
+            product._queue(pipe, None)
+            await pipe.execute()
+        else:
+            await AsyncProduct.__transact(product.id, product._queue,
+                                          versions)
+        return product
+
+    @staticmethod
+    async def delete(product_id):
+        """ Removes a Product from the data store """
+        await AsyncProduct.__transact(
+            product_id, lambda pipe, old_data:
+            Product._queue_delete(pipe, product_id, old_data))
+
+    @staticmethod
+    async def __transact(product_id, queue, versions=None):
+        """
+        Runs writes that depend on the stored data of a Product atomically
+        The record key is WATCHed while the data is read and both are
+        retried when another writer changed the Product in between. With
+        versions the version of the Product is checked under the same
+        WATCH, as models.Product does.
+        Raises:
+            PreconditionFailedError: if the Product has another version
+        """
+        if versions is not None:
+            versions = set('%s' % version for version in versions)
+        async with AsyncProduct.redis.pipeline() as pipe:
+            while True:
+                try:
+                    await pipe.watch(Product._key(product_id))
+                    if versions is not None:
+                        version = await pipe.hget(Product.versions_key,
+                                                  product_id)
+                        if version is None or _text(version) not in versions:
+                            raise PreconditionFailedError(
+                                'Product with id: %s has changed'
+                                % product_id)
+                    old_data = await AsyncProduct.__load(product_id)
+                    pipe.multi()
+                    queue(pipe, old_data)
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    AsyncProduct.logger.info('Product %s changed, retrying',
+                                             product_id)
+
+    @staticmethod
+    async def find(product_id):
+        """ Finds a Product by it's ID """
+        data = await AsyncProduct.__load(product_id)
+        if data:
+            return Product.from_dict(data)
+        return None
+
+    @staticmethod
+    async def find_many(product_ids):
+        """
+        Finds many Products by their ids in one round trip
+        Returns:
+            tuple: the Products found, in the order their ids were given
+                   without repeats, and the list of the ids not found
+        """
+        product_ids = list(OrderedDict.fromkeys(int(i) for i in product_ids))
+        found = dict((data['id'], data) for data in
+                     await AsyncProduct.__fetch_data(product_ids))
+        return ([Product.from_dict(found[i]) for i in product_ids
+                 if i in found], [i for i in product_ids if i not in found])
+
+    @staticmethod
+    async def all():
+        """ Returns all of the Products in the database """
+        return [product async for product in AsyncProduct.iterate()]
+
+    @staticmethod
+    async def iterate(batch_size=None):
+        """ Yields every Product in id order, fetched batch_size at a time """
+        batch_size = batch_size or Product.batch_size
+        start = 0
+        while True:
+            ids = await AsyncProduct.redis.zrange(
+                Product.ids_key, start, start + batch_size - 1)
+            for product in await AsyncProduct.__fetch(ids):
+                yield product
+            if len(ids) < batch_size:
+                return
+            start += batch_size
+
+    @staticmethod
+    async def filter(filters, available=False, limit=None, after=0):
+        """
+        Returns the Products that match every filter, ordered by id
+        The index sets are intersected with the id index in Redis so only
+        the Products of the requested page are fetched.
+        Args:
+            filters (dict): indexed attributes and the values they must have
+            available (bool): only return Products with count greater than 0
+            limit (int): the maximum number of Products, all if None
+            after (int): only return Products with an id greater than this
+        Returns:
+            tuple: the list of Products and the id to continue after,
+                   which is None when this is the last page
+        """
+        pairs, keys = Product._filter_keys(filters, available)
+        key = Product.available_key if available else Product.ids_key
+        page = {} if limit is None else {'start': 0, 'num': limit + 1}
+        pipe = AsyncProduct.redis.pipeline()
+        if filters:
+            weights = dict((k, 0) for k in keys)
+            weights[Product.ids_key] = 1
+            key = u'%sfilter:async:%s' % (
+                Product.prefix, u'&'.join(u'%s=%s' % pair for pair in pairs))
+            pipe.zinterstore(key, weights)
+        pipe.zrangebyscore(key, '(%d' % after, '+inf', **page)
+        if filters:
+            pipe.delete(key)
+        product_ids = (await pipe.execute())[1 if filters else 0]
+        products = await AsyncProduct.__fetch(product_ids[:limit])
+        if limit is None or len(product_ids) <= limit:
+            return products, None
+        return products, int(product_ids[limit - 1])
+
+    @staticmethod
+    async def catalog_version():
+        """ Returns the version of the catalog, which every change bumps """
+        return int(await AsyncProduct.redis.get(Product.version_key) or 0)
+
+    @staticmethod
+    async def get_version(product_id):
+        """ Returns the version of a Product, None if it has none """
+        version = await AsyncProduct.redis.hget(Product.versions_key,
+                                                product_id)
+        return int(version) if version is not None else None
+
+    @staticmethod
+    async def available():
+        """ Returns the Products that are in stock """
+        ids = await AsyncProduct.redis.zrange(Product.available_key, 0, -1)
+        return await AsyncProduct.__fetch(ids)
+
+    @staticmethod
+    async def find_by_category(category):
+        """ Returns all of the Products in a category """
+        return await AsyncProduct.__find_by('category', category)
+
+    @staticmethod
+    async def find_by_name(name):
+        """ Returns all Products with the given name """
+        return await AsyncProduct.__find_by('name', name)
+
+    @staticmethod
+    async def __find_by(attribute, value):
+        """ Generic Query that finds a key with a specific value """
+        product_ids = await AsyncProduct.redis.smembers(
+            Product._index_key(attribute, value))
+        return await AsyncProduct.__fetch(product_ids)
+
+    @staticmethod
+    async def adjust_count(product_id, delta):
+        """
+        Atomically adds delta to the count of a Product
+        Raises:
+            NotFoundError: if the Product does not exist
+            OutOfStockError: if the count would go below zero
+        """
+        if Product.storage == 'hash':
+            result = await AsyncProduct.__run_script(
+                ADJUST_HASH_COUNT_SCRIPT,
+                [Product._key(product_id), Product.available_key,
+                 Product.count_key, Product.version_key, Product.versions_key],
+                [product_id, delta])
+        else:
+            keys = [Product.inventory_key, Product._key(product_id),
+                    Product.available_key, Product.count_key,
+                    Product.version_key, Product.versions_key]
+            result = await AsyncProduct.__run_script(
+                ADJUST_COUNT_SCRIPT, keys, [product_id, delta])
+            if result and result[0] == -1:
+                # seed the inventory from a record saved before it existed
+                data = await AsyncProduct.__load(product_id)
+                if data:
+                    await AsyncProduct.redis.hsetnx(
+                        Product.inventory_key, product_id, int(data['count']))
+                result = await AsyncProduct.__run_script(
+                    ADJUST_COUNT_SCRIPT, keys, [product_id, delta])
+        data = Product._count_result(product_id, result)
+        pipe = AsyncProduct.redis.pipeline()
+        Product._invalidate(pipe, product_id)
+        await pipe.execute()
+        return Product.from_dict(data)
+
+    @staticmethod
+    async def __run_script(source, keys, args):
+        """ Runs a Lua script, registering it with the client once """
+        script = AsyncProduct.__scripts.get(source)
+        if script is None or script.registered_client is not AsyncProduct.redis:
+            script = AsyncProduct.redis.register_script(source)
+            AsyncProduct.__scripts[source] = script
+        return await script(keys=keys, args=args)
+
+    @staticmethod
+    async def __load(product_id):
+        """ Returns the stored dictionary for a Product or None """
+        results = await AsyncProduct.__fetch_data([product_id])
+        return results[0] if results else None
+
+    @staticmethod
+    async def __fetch_data(product_ids):
+        """ Fetches the stored dictionaries of many Products at once """
+        product_ids = sorted(int(i) for i in product_ids)
+        if not product_ids:
+            return []
+        results = []
+        pipe = AsyncProduct.redis.pipeline()
+        if Product.storage == 'hash':
+            for product_id in product_ids:
+                pipe.hmget(Product._key(product_id), Product.fields)
+            for values in await pipe.execute():
+                if values[0] is not None:
+                    results.append(
+                        Product._decode_fields(Product.fields, values))
+        else:
+            pipe.mget([Product._key(i) for i in product_ids])
+            pipe.hmget(Product.inventory_key, product_ids)
+            records, counts = await pipe.execute()
+            for record, count in zip(records, counts):
+                if record is not None:
+                    results.append(Product._decode(record, count))
+        return results
+
+    @staticmethod
+    async def __fetch(product_ids):
+        """ Fetches many Products in one round trip """
+        return [Product.from_dict(data)
+                for data in await AsyncProduct.__fetch_data(product_ids)]
+
+######################################################################
+#  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
+######################################################################
+
+    @staticmethod
+    async def connect_to_redis(hostname, port, password, **options):
+        """
+        Connects to Redis and tests the connection
+        Takes the same pool, timeout and retry options as models.Product.
+        """
+        AsyncProduct.redis = create_client(hostname, port, password,
+                                           **options)
+        try:
+            await AsyncProduct.redis.ping()
+            AsyncProduct.logger.info("Connection established")
+        except ConnectionError:
+            AsyncProduct.logger.info("Connection Error from: %s:%s",
+                                     hostname, port)
+            AsyncProduct.redis = None
+        return AsyncProduct.redis
+
+    @staticmethod
+    async def init_db(redis=None, **options):
+        """
+        Initializes the asyncio Redis connection
+        Connects the same way as models.Product.init_db(): to a client
+        passed in, to the Redis bound in VCAP_SERVICES, or to localhost
+        and then to a host called 'redis'.
+        Exception:
+        ----------
+          redis.ConnectionError - if ping() test fails
+        """
+        if redis:
+            AsyncProduct.redis = redis
+            try:
+                await AsyncProduct.redis.ping()
+            except ConnectionError:
+                AsyncProduct.redis = None
+                raise ConnectionError('Could not connect to the Redis Service')
+            return
+        if 'VCAP_SERVICES' in os.environ:
+            services = json.loads(os.environ['VCAP_SERVICES'])
+            creds = services['rediscloud'][0]['credentials']
+            pool_options = dict((name, value) for name, value in creds.items()
+                                if name in connection.OPTIONS)
+            pool_options.update(options)
+            await AsyncProduct.connect_to_redis(
+                creds['hostname'], creds['port'], creds['password'],
+                **pool_options)
+        else:
+            await AsyncProduct.connect_to_redis('127.0.0.1', 6379, None,
+                                                **options)
+            if not AsyncProduct.redis:
+                await AsyncProduct.connect_to_redis('redis', 6379, None,
+                                                    **options)
+        if not AsyncProduct.redis:
+            AsyncProduct.logger.fatal(
+                '*** FATAL ERROR: Could not connect to the Redis Service')
+            raise ConnectionError('Could not connect to the Redis Service')
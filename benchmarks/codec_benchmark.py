@@ -0,0 +1,75 @@
+"""
+Benchmark of the Product serialization codecs
+Builds a catalog by repeating the rows of sample_products.csv and reports,
+for every available codec, the time to encode and decode the whole catalog
+and the number of bytes stored per Product.
+
+Usage:
+------
+python benchmarks/codec_benchmark.py [--size 100000] [--repeat 3]
+"""
+import os
+import sys
+import csv
+import timeit
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import serializers  # noqa: E402
+
+
+def load_catalog(size, path=os.path.join(ROOT, 'sample_products.csv')):
+    """ Returns size Product dictionaries built from the sample rows """
+    with open(path) as csvfile:
+        rows = list(csv.DictReader(csvfile))
+    catalog = []
+    for i in range(size):
+        row = rows[i % len(rows)]
+        catalog.append({'id': i + 1, 'name': row['Name'],
+                        'category': row['Category'],
+                        'price': int(row['Price']),
+                        'description': row['Description'],
+                        'color': row['Color'], 'count': int(row['Count'])})
+    return catalog
+
+
+def benchmark(codec, catalog, repeat):
+    """ Returns the best encode and decode times and the stored bytes """
+    records = [serializers.encode(data, codec) for data in catalog]
+    encode = min(timeit.repeat(
+        lambda: [serializers.encode(data, codec) for data in catalog],
+        number=1, repeat=repeat))
+    decode = min(timeit.repeat(
+        lambda: [serializers.decode(record) for record in records],
+        number=1, repeat=repeat))
+    return encode, decode, sum(len(record) for record in records)
+
+
+def main(argv=None):
+    """ Runs the benchmark and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=100000,
+                        help='number of products in the catalog')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per measurement, the best one is kept')
+    args = parser.parse_args(argv)
+
+    catalog = load_catalog(args.size)
+    print('{:<10}{:>14}{:>14}{:>16}'.format(
+        'codec', 'encode us/op', 'decode us/op', 'bytes/product'))
+    for name in sorted(serializers.CODECS):
+        try:
+            codec = serializers.get_codec(name)
+        except ValueError as error:
+            print('{:<10}{}'.format(name, error))
+            continue
+        encode, decode, size = benchmark(codec, catalog, args.repeat)
+        print('{:<10}{:>14.2f}{:>14.2f}{:>16.1f}'.format(
+            name, encode * 1e6 / len(catalog), decode * 1e6 / len(catalog),
+            float(size) / len(catalog)))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,81 @@
+"""
+Benchmark of the JSON renderers of the Product listing
+Loads catalogs of each size into Redis under their own key prefix and
+reports the time to render the full GET /products body, once through
+Product objects and the marshaller and once through the fast path that
+encodes each Product straight from the stored data. The keys are removed
+again when it finishes. Redis is found the same way the service finds it.
+
+Usage:
+------
+python benchmarks/list_benchmark.py [--sizes 10000 100000] [--repeat 3]
+"""
+import os
+import sys
+import json
+import timeit
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import server  # noqa: E402
+from models import Product  # noqa: E402
+from codec_benchmark import load_catalog  # noqa: E402
+
+
+def load(size, chunk=1000):
+    """ Replaces the catalog with size Products built from the sample rows """
+    Product.remove_all()
+    catalog = load_catalog(size)
+    for start in range(0, size, chunk):
+        Product.save_many([Product(data['id']).deserialize(data)
+                           for data in catalog[start:start + chunk]])
+
+
+def render_marshalled():
+    """ Renders the listing through Product objects and the marshaller """
+    return server.stream_products(Product.iterate()).get_data()
+
+
+def render_fast():
+    """ Renders the listing through the pre-encoded fast path """
+    return server.stream_json(Product.iterate_json()).get_data()
+
+
+def main(argv=None):
+    """ Runs the benchmark and prints a table of the results """
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000],
+                        help='numbers of products in the catalogs')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per measurement, the best one is kept')
+    parser.add_argument('--prefix', default='benchmark:',
+                        help='the key prefix the catalogs are loaded under')
+    args = parser.parse_args(argv)
+
+    Product.init_db(prefix=args.prefix)
+    print('{:<10}{:>8}{:>16}{:>16}{:>10}'.format(
+        'storage', 'rows', 'marshal ms', 'fast ms', 'speedup'))
+    try:
+        with server.app.test_request_context('/products'):
+            for size in args.sizes:
+                load(size)
+                assert (sorted(json.loads(render_marshalled()),
+                               key=lambda data: data['id']) ==
+                        sorted(json.loads(render_fast()),
+                               key=lambda data: data['id']))
+                marshalled = min(timeit.repeat(render_marshalled, number=1,
+                                               repeat=args.repeat))
+                fast = min(timeit.repeat(render_fast, number=1,
+                                         repeat=args.repeat))
+                print('{:<10}{:>8}{:>16.1f}{:>16.1f}{:>9.1f}x'.format(
+                    Product.storage, size, marshalled * 1e3, fast * 1e3,
+                    marshalled / fast))
+    finally:
+        Product.remove_all()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+"""
+In-process caches for the Product Store Service
+"""
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A thread safe cache that holds at most maxsize entries
+    The least recently used entry is evicted first and, when ttl is
+    given, entries older than ttl seconds are treated as missing. When
+    maxbytes is given the sizes passed to set() are added up as well and
+    entries are evicted until their total fits.
+    Every delete() and clear() bumps generation, so a value read before
+    one of them can be refused by set().
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns the value cached for a key, or default on a miss """
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or (self.ttl and entry[1] < time.time()):
+                if entry is not None:
+                    self._bytes -= entry[2]
+                self.misses += 1
+                return default
+            self._data[key] = entry  # move it to the most recent end
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, generation=None, size=0):
+        """
+        Caches a value, evicting the least recently used if full
+        When generation is given and something was deleted since it was
+        read, the value may already be stale and is not cached. A value
+        whose size alone is over maxbytes is not cached either.
+        """
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._remove(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._data[key] = (value, expires, size)
+            self._bytes += size
+            while len(self._data) > self.maxsize or \
+                    (self.maxbytes is not None and
+                     self._bytes > self.maxbytes):
+                self._bytes -= self._data.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        """ Removes a key from the cache """
+        with self._lock:
+            self._remove(key)
+            self.generation += 1
+
+    def clear(self):
+        """ Removes every key from the cache """
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+            self.generation += 1
+
+    def _remove(self, key):
+        """ Removes a key, the lock must be held """
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def stats(self):
+        """ Returns the hit and miss counters and the size of the cache """
+        with self._lock:
+            stats = {'hits': self.hits, 'misses': self.misses,
+                     'size': len(self._data), 'maxsize': self.maxsize}
+            if self.maxbytes is not None:
+                stats.update(bytes=self._bytes, maxbytes=self.maxbytes)
+            return stats
@@ -0,0 +1,174 @@
+"""
+Redis connections for the Product Store Service
+Every client shares a bounded connection pool with socket timeouts, and
+commands that could not reach Redis are retried with exponential backoff
+when running them twice does no harm, see IDEMPOTENT_COMMANDS.
+Options are read from the environment, can be overridden by the
+credentials in VCAP_SERVICES and by the arguments of Product.init_db().
+
+Environment:
+------------
+REDIS_MAX_CONNECTIONS - connections kept in the pool (50)
+REDIS_BLOCKING_POOL - True to wait for a free connection instead of failing
+REDIS_POOL_TIMEOUT - seconds to wait for a free connection (5)
+REDIS_SOCKET_TIMEOUT - seconds to wait for a reply (5)
+REDIS_CONNECT_TIMEOUT - seconds to wait for a new connection (2)
+REDIS_RETRIES - times an idempotent command is retried after a connection
+                error (3)
+REDIS_RETRY_BACKOFF - seconds before the first retry, doubled each time
+REDIS_RETRY_ON_TIMEOUT - True to retry commands that timed out too
+
+Every command and every command of a pipeline is counted against the
+Product method that sent it, see metrics.py.
+"""
+import os
+import time
+import logging
+from redis import Redis, ConnectionPool, BlockingConnectionPool
+from redis.client import Pipeline
+from redis.exceptions import ConnectionError, TimeoutError
+import metrics
+
+
+def _flag(value):
+    """ Reads a boolean option given as text """
+    return str(value).lower() in ('1', 'true', 'yes')
+
+
+# option name to its default, the variable it is read from and its type
+OPTIONS = {
+    'max_connections': (50, 'REDIS_MAX_CONNECTIONS', int),
+    'blocking': (False, 'REDIS_BLOCKING_POOL', _flag),
+    'pool_timeout': (5.0, 'REDIS_POOL_TIMEOUT', float),
+    'socket_timeout': (5.0, 'REDIS_SOCKET_TIMEOUT', float),
+    'connect_timeout': (2.0, 'REDIS_CONNECT_TIMEOUT', float),
+    'retries': (3, 'REDIS_RETRIES', int),
+    'retry_backoff': (0.05, 'REDIS_RETRY_BACKOFF', float),
+    'retry_on_timeout': (False, 'REDIS_RETRY_ON_TIMEOUT', _flag),
+}
+
+# Commands that leave Redis in the same state when they run twice. A
+# connection can fail after Redis ran a command, so only these are retried:
+# INCR, EVALSHA and the like could take two ids or sell a unit twice.
+IDEMPOTENT_COMMANDS = frozenset([
+    'PING', 'EXISTS', 'TYPE', 'TTL', 'KEYS', 'SCAN', 'DBSIZE',
+    'GET', 'MGET', 'SET', 'MSET', 'DEL', 'UNLINK', 'EXPIRE', 'PERSIST',
+    'HGET', 'HMGET', 'HGETALL', 'HEXISTS', 'HLEN', 'HKEYS', 'HSCAN',
+    'HSET', 'HMSET', 'HSETNX', 'HDEL',
+    'SMEMBERS', 'SISMEMBER', 'SCARD', 'SINTER', 'SUNION', 'SSCAN',
+    'SADD', 'SREM', 'SINTERSTORE', 'SUNIONSTORE',
+    'ZRANGE', 'ZREVRANGE', 'ZRANGEBYSCORE', 'ZREVRANGEBYSCORE',
+    'ZRANGEBYLEX', 'ZREVRANGEBYLEX', 'ZSCORE', 'ZMSCORE', 'ZCARD', 'ZCOUNT',
+    'ZLEXCOUNT', 'ZRANK', 'ZSCAN', 'ZADD', 'ZREM', 'ZREMRANGEBYSCORE',
+    'ZINTERSTORE', 'ZUNIONSTORE', 'SCRIPT LOAD', 'SCRIPT EXISTS'])
+
+logger = logging.getLogger(__name__)
+
+
+def get_options(*overrides):
+    """
+    Returns the connection options
+    The defaults are replaced by the environment and then by each of the
+    given dictionaries in turn. Keys that are not options are ignored.
+    """
+    options = {}
+    for name, (default, variable, convert) in OPTIONS.items():
+        value = os.getenv(variable)
+        options[name] = convert(value) if value is not None else default
+    for override in overrides:
+        for name, value in (override or {}).items():
+            if name in OPTIONS and value is not None:
+                options[name] = OPTIONS[name][2](value)
+    return options
+
+
+class RetryingRedis(Redis):
+    """
+    A Redis client that retries commands which failed to reach Redis
+    Retries wait retry_backoff seconds and then twice as long each time.
+    A connection error can come after Redis ran the command, so only the
+    IDEMPOTENT_COMMANDS are retried, and timeouts only with
+    retry_on_timeout. Pipelines are not retried here, redis-py
+    reconnects them once by itself.
+    """
+
+    def __init__(self, retries=0, retry_backoff=0.05, retry_on_timeout=False,
+                 **kwargs):
+        super(RetryingRedis, self).__init__(**kwargs)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_on_timeout = retry_on_timeout
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks,
+                                transaction, shard_hint)
+
+    def execute_command(self, *args, **options):
+        metrics.count_commands()
+        attempt = 0
+        while True:
+            try:
+                return super(RetryingRedis, self).execute_command(
+                    *args, **options)
+            except (ConnectionError, TimeoutError) as error:
+                if attempt >= self.retries or not idempotent(args) or (
+                        isinstance(error, TimeoutError) and
+                        not self.retry_on_timeout):
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                logger.warning('Redis %s failed (%s), retrying in %.2fs',
+                               args[0], error, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+def idempotent(args):
+    """ Tells if a command can safely run again, see IDEMPOTENT_COMMANDS """
+    command = ('%s' % args[0]).upper()
+    if command == 'ZADD':
+        return 'INCR' not in args
+    return command in IDEMPOTENT_COMMANDS
+
+
+class CountingPipeline(Pipeline):
+    """ A pipeline that counts the commands it sends """
+
+    def execute(self, raise_on_error=True):
+        metrics.count_commands(len(self.command_stack))
+        return super(CountingPipeline, self).execute(raise_on_error)
+
+
+def create_client(host, port, password, **options):
+    """ Creates a Redis client on a new connection pool """
+    options = get_options(options)
+    pool_options = dict(host=host, port=port, password=password,
+                        max_connections=options['max_connections'],
+                        socket_timeout=options['socket_timeout'],
+                        socket_connect_timeout=options['connect_timeout'])
+    if options['blocking']:
+        pool = BlockingConnectionPool(timeout=options['pool_timeout'],
+                                      **pool_options)
+    else:
+        pool = ConnectionPool(**pool_options)
+    return RetryingRedis(connection_pool=pool,
+                         retries=options['retries'],
+                         retry_backoff=options['retry_backoff'],
+                         retry_on_timeout=options['retry_on_timeout'])
+
+
+def pool_stats(client):
+    """ Returns how many connections of the pool of a client are in use """
+    pool = getattr(client, 'connection_pool', None)
+    if pool is None:
+        return None
+    if isinstance(pool, BlockingConnectionPool):
+        created = len(pool._connections)
+        available = sum(1 for conn in list(pool.pool.queue) if conn)
+    else:
+        created = getattr(pool, '_created_connections', 0)
+        available = len(getattr(pool, '_available_connections', ()))
+    return {'max_connections': pool.max_connections,
+            'blocking': isinstance(pool, BlockingConnectionPool),
+            'created': created,
+            'in_use': created - available,
+            'available': available}
@@ -0,0 +1,159 @@
+"""
+Management commands for the Product Store Service
+Usage:
+------
+python manage.py rebuild-indexes - rebuilds the Redis secondary indexes
+python manage.py migrate-storage - converts pickled Products into hashes
+python manage.py import FILE - loads Products from a CSV or NDJSON file
+python manage.py migrate-keys - moves keys from before the key prefix under it
+"""
+import os
+import io
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+from models import Product, DataValidationError
+
+# hash of import file path to the number of rows already imported, it is
+# kept under the key prefix of the model, see checkpoint_key()
+CHECKPOINT_KEY = 'import:checkpoints'
+
+
+def rebuild_indexes(args):
+    """ Rebuilds the secondary indexes from the stored Products """
+    count = Product.rebuild_indexes()
+    print('Indexed {} products'.format(count))
+
+
+def migrate_storage(args):
+    """ Converts Products stored as pickled blobs into hashes """
+    count = Product.migrate_storage(args.batch_size)
+    print('Converted {} products'.format(count))
+
+
+def migrate_keys(args):
+    """ Moves the keys written before the key prefix existed under it """
+    count = Product.migrate_keys(args.batch_size)
+    print('Moved {} keys under {}'.format(count, Product.prefix))
+
+
+def checkpoint_key():
+    """ Returns the key of the import checkpoints """
+    return Product.prefix + CHECKPOINT_KEY
+
+
+def read_rows(path, file_format):
+    """ Streams the rows of a CSV or NDJSON file as dictionaries """
+    if file_format == 'ndjson':
+        with io.open(path, encoding='utf-8') as ndjson_file:
+            for line in ndjson_file:
+                if line.strip():
+                    yield json.loads(line)
+    elif sys.version_info[0] < 3:
+        with open(path, 'rb') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield dict((k, v.decode('utf-8')) for k, v in row.items())
+    else:
+        with io.open(path, encoding='utf-8', newline='') as csv_file:
+            for row in csv.DictReader(csv_file):
+                yield row
+
+
+def row_to_product(row):
+    """ Builds a Product from a row, matching column names in any case """
+    row = dict((str(key).strip().lower(), value)
+               for key, value in row.items())
+    try:
+        product = Product(int(row['id'])).deserialize(row)
+        product.count = int(product.count)
+    except (KeyError, TypeError, ValueError):
+        raise DataValidationError('Invalid row: {}'.format(row.get('id')))
+    return product
+
+
+def import_products(args):
+    """
+    Loads Products from a CSV or NDJSON file in pipelined batches
+    The source id column becomes the Product id, so importing the same
+    file again overwrites rather than duplicates. Progress is checkpointed
+    after every batch and --resume skips the rows already imported.
+    """
+    path = os.path.abspath(args.file)
+    file_format = args.format or (
+        'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv')
+    skip = 0
+    if args.resume:
+        skip = int(Product.redis.hget(checkpoint_key(), path) or 0)
+        print('Resuming after {} rows'.format(skip))
+    Product.register_keys(checkpoint_key())
+    started = time.time()
+    imported = errors = 0
+    batch = []
+    for number, row in enumerate(read_rows(path, file_format), 1):
+        if number <= skip:
+            continue
+        try:
+            batch.append(row_to_product(row))
+        except DataValidationError as error:
+            logging.warning('Skipping row %d: %s', number, error)
+            errors += 1
+        if len(batch) >= args.batch_size:
+            Product.save_many(batch)
+            Product.redis.hset(checkpoint_key(), path, number)
+            imported += len(batch)
+            batch = []
+            print('Imported {} rows ({:.0f} rows/sec)'.format(
+                imported, imported / max(time.time() - started, 1e-6)))
+    Product.save_many(batch)
+    imported += len(batch)
+    Product.redis.hdel(checkpoint_key(), path)
+    print('Imported {} rows with {} errors in {:.1f}s ({:.0f} rows/sec)'.format(
+        imported, errors, time.time() - started,
+        imported / max(time.time() - started, 1e-6)))
+
+
+def main(argv=None):
+    """ Parses the command line and runs the requested command """
+    parser = argparse.ArgumentParser(
+        description='Product Store Service management commands')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    rebuild = commands.add_parser(
+        'rebuild-indexes', help='rebuild the secondary indexes')
+    rebuild.set_defaults(func=rebuild_indexes)
+
+    migrate = commands.add_parser(
+        'migrate-storage', help='convert pickled products into hashes')
+    migrate.add_argument('--batch-size', type=int, default=None,
+                         help='number of products converted per round trip')
+    migrate.set_defaults(func=migrate_storage)
+
+    keys = commands.add_parser(
+        'migrate-keys', help='move keys from before the key prefix under it')
+    keys.add_argument('--batch-size', type=int, default=None,
+                      help='number of keys renamed per round trip')
+    keys.set_defaults(func=migrate_keys)
+
+    load = commands.add_parser(
+        'import', help='load products from a CSV or NDJSON file')
+    load.add_argument('file', help='the file to import')
+    load.add_argument('--format', choices=('csv', 'ndjson'), default=None,
+                      help='the file format, guessed from the extension')
+    load.add_argument('--batch-size', type=int, default=Product.batch_size,
+                      help='number of products written per round trip')
+    load.add_argument('--resume', action='store_true',
+                      help='skip the rows a failed import already loaded')
+    load.set_defaults(func=import_products)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    Product.init_db()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
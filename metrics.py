@@ -0,0 +1,227 @@
+"""
+Prometheus metrics for the Product Store Service
+Counters and histograms are kept in process memory and served in the
+Prometheus text format by GET /metrics. Every worker process keeps its
+own numbers, so each one has to be scraped.
+
+Metrics:
+--------
+http_requests_total - requests by method, route and status
+http_request_errors_total - requests answered with a 4xx or 5xx status
+http_request_duration_seconds - request latency by method and route
+http_response_size_bytes - response body size by method and route
+product_method_duration_seconds - time spent in each Product method
+product_method_redis_commands_total - Redis commands each Product method sent
+"""
+import time
+import bisect
+import inspect
+import threading
+import functools
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class Metric(object):
+    """
+    A counter, or a histogram when buckets are given, with one value per
+    combination of label values
+    """
+
+    def __init__(self, name, description, labels, buckets=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.kind = 'histogram' if buckets else 'counter'
+        self._values = {}
+
+    def inc(self, labels, amount=1):
+        """ Adds amount to the counter of some label values """
+        with _lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def observe(self, labels, value):
+        """ Records a value in the histogram of some label values """
+        with _lock:
+            data = self._values.get(labels)
+            if data is None:
+                # a count per bucket, then +Inf, the sum and the count
+                data = self._values[labels] = [0] * (len(self.buckets) + 1) \
+                    + [0.0, 0]
+            data[bisect.bisect_left(self.buckets, value)] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def get(self, labels):
+        """ Returns the value, or the histogram count, of some label values """
+        with _lock:
+            value = self._values.get(labels)
+        if isinstance(value, list):
+            return value[-1]
+        return value or 0
+
+    def clear(self):
+        """ Forgets every value """
+        with _lock:
+            self._values.clear()
+
+    def render(self):
+        """ Returns the metric in the Prometheus text format """
+        with _lock:
+            values = sorted((labels, list(value) if isinstance(value, list)
+                             else value)
+                            for labels, value in self._values.items())
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for labels, value in values:
+            pairs = list(zip(self.labels, labels))
+            if self.kind == 'counter':
+                lines.append('{}{} {}'.format(self.name, _labels(pairs),
+                                              _number(value)))
+                continue
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), value):
+                total += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _labels(pairs + [('le', bound)]), total))
+            lines.append('{}_sum{} {}'.format(self.name, _labels(pairs),
+                                              _number(value[-2])))
+            lines.append('{}_count{} {}'.format(self.name, _labels(pairs),
+                                                value[-1]))
+        return '\n'.join(lines)
+
+
+def _labels(pairs):
+    """ Formats label names and values, escaped, between braces """
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        name, ('%s' % value).replace('\\', r'\\').replace('"', r'\"')
+        .replace('\n', r'\n')) for name, value in pairs) + '}'
+
+
+def _number(value):
+    """ Formats a sample value """
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REQUESTS = Metric('http_requests_total', 'HTTP requests served.',
+                  ('method', 'route', 'status'))
+ERRORS = Metric('http_request_errors_total',
+                'HTTP requests answered with an error status.',
+                ('method', 'route', 'status'))
+LATENCY = Metric('http_request_duration_seconds',
+                 'Time to serve an HTTP request, body included.',
+                 ('method', 'route'), LATENCY_BUCKETS)
+SIZES = Metric('http_response_size_bytes', 'Size of HTTP response bodies.',
+               ('method', 'route'), SIZE_BUCKETS)
+METHOD_LATENCY = Metric('product_method_duration_seconds',
+                        'Time spent in a Product method.',
+                        ('method',), LATENCY_BUCKETS)
+REDIS_COMMANDS = Metric('product_method_redis_commands_total',
+                        'Redis commands sent by a Product method.',
+                        ('method',))
+METRICS = (REQUESTS, ERRORS, LATENCY, SIZES, METHOD_LATENCY, REDIS_COMMANDS)
+
+
+def observe_request(method, route, status, seconds, size):
+    """ Records one HTTP request """
+    REQUESTS.inc((method, route, str(status)))
+    if status >= 400:
+        ERRORS.inc((method, route, str(status)))
+    LATENCY.observe((method, route), seconds)
+    if size is not None:
+        SIZES.observe((method, route), size)
+
+
+def count_commands(count=1):
+    """ Adds Redis commands to the Product method that is running, if any """
+    call = getattr(_local, 'call', None)
+    if call is not None:
+        call.commands += count
+
+
+class _Call(object):
+    """
+    The time and Redis commands of one call of a Product method
+    Methods called from another one are counted as part of the outer one.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.commands = 0
+        self.ran = False
+        self._outer = False
+        self._started = None
+
+    def __enter__(self):
+        self._outer = getattr(_local, 'call', None) is None
+        if self._outer:
+            _local.call = self
+            self.ran = True
+            self._started = time.time()
+        return self
+
+    def __exit__(self, *error):
+        if self._outer:
+            self.seconds += time.time() - self._started
+            _local.call = None
+
+    def finish(self):
+        """ Records the call once it is over """
+        if self.ran:
+            METHOD_LATENCY.observe((self.name,), self.seconds)
+            REDIS_COMMANDS.inc((self.name,), self.commands)
+
+
+def timed(function):
+    """
+    Records the time and the Redis commands of each call of a function
+    Generators are timed while they run, not while their caller works
+    on what they yielded, and are recorded once they are exhausted.
+    """
+    name = function.__name__
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator(*args, **kwargs):
+            call = _Call(name)
+            items = function(*args, **kwargs)
+            try:
+                while True:
+                    with call:
+                        try:
+                            item = next(items)
+                        except StopIteration:
+                            return
+                    yield item
+            finally:
+                call.finish()
+        return generator
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        call = _Call(name)
+        try:
+            with call:
+                return function(*args, **kwargs)
+        finally:
+            call.finish()
+    return wrapper
+
+
+def render():
+    """ Returns every metric in the Prometheus text format """
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+
+def reset():
+    """ Forgets every recorded value """
+    for metric in METRICS:
+        metric.clear()
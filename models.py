@@ -5,15 +5,43 @@ This class looks for an environment variable called VCAP_SERVICES
 to get it's database credentials from. If it cannot find one, it
 tries to connect to Redis on the localhost. If that fails it looks
 for a server name 'redis' to connect to.
+
+Products are stored as pickled blobs by default. Set PRODUCT_CODEC to
+json or msgpack to encode new blobs with another codec, older blobs stay
+readable. Set PRODUCT_STORAGE=hash to store each Product as a Redis hash
+of JSON encoded fields instead, after converting existing data with:
+python manage.py migrate-storage
+
+Set PRODUCT_CACHE_SIZE (and optionally PRODUCT_CACHE_TTL in seconds, 60
+by default) to keep recently found Products in process memory. Every
+instance drops its copy when any instance changes a Product, through
+Redis pub/sub.
+
+Connections come from a bounded pool with timeouts and retries, see
+connection.py for the REDIS_* variables that tune it.
+
+Every key lives under PRODUCT_KEY_PREFIX (products: by default) and is
+recorded in a registry set, so remove_all() only deletes keys of this
+service. Move keys written before the prefix existed with:
+python manage.py migrate-keys
+
+The data methods are timed and the Redis commands they send counted for
+GET /metrics, see metrics.py.
 """
 
 import os
+import re
 import json
+import time
 import logging
-import pickle
-from redis import Redis
+import threading
+from collections import Counter, OrderedDict
+import metrics
+import connection
+import serializers
+from cache import LRUCache
 from cerberus import Validator
-from redis.exceptions import ConnectionError
+from redis.exceptions import ConnectionError, WatchError
 
 ######################################################################
 # Custom Exceptions
@@ -37,6 +65,183 @@ class NotFoundError(Exception):
     pass
 
 
+class OutOfStockError(Exception):
+    """ Used when a count change would take a Product below zero """
+    pass
+
+
+class PreconditionFailedError(Exception):
+    """ Used when a Product changed since the version a write expected """
+    pass
+
+
+# Atomically adds ARGV[2] to the count of Product ARGV[1] in the inventory
+# hash KEYS[1] unless that would take it below zero, keeps the Product in
+# the availability set KEYS[3] only while it is in stock and moves it in
+# the count sort index KEYS[4], bumping the catalog version KEYS[5] and
+# stamping it into the Product versions hash KEYS[6]. The record KEYS[2]
+# is written back unchanged so that a WATCH of it sees the new version.
+# Returns nil when the record does not exist, {-1} when it has no
+# inventory entry yet, {0, count} when it is out of stock and
+# {1, count, record} otherwise.
+ADJUST_COUNT_SCRIPT = """
+local record = redis.call('GET', KEYS[2])
+if not record then
+    return nil
+end
+local count = redis.call('HGET', KEYS[1], ARGV[1])
+if not count then
+    return {-1}
+end
+count = tonumber(count) + tonumber(ARGV[2])
+if count < 0 then
+    return {0, count - tonumber(ARGV[2])}
+end
+redis.call('HSET', KEYS[1], ARGV[1], count)
+if count > 0 then
+    redis.call('ZADD', KEYS[3], ARGV[1], ARGV[1])
+else
+    redis.call('ZREM', KEYS[3], ARGV[1])
+end
+redis.call('ZADD', KEYS[4], count, ARGV[1])
+redis.call('HSET', KEYS[6], ARGV[1], redis.call('INCR', KEYS[5]))
+redis.call('SET', KEYS[2], record)
+return {1, count, record}
+"""
+
+# The same change for Products stored as hashes, where KEYS[1] is the
+# Product hash itself, KEYS[2] the availability set, KEYS[3] the count sort
+# index, KEYS[4] the catalog version, KEYS[5] the versions hash and ARGV[1]
+# the id.
+# Returns nil, {0, count} or {1, count, HGETALL}.
+ADJUST_HASH_COUNT_SCRIPT = """
+local count = redis.call('HGET', KEYS[1], 'count')
+if not count then
+    return nil
+end
+count = tonumber(count) + tonumber(ARGV[2])
+if count < 0 then
+    return {0, count - tonumber(ARGV[2])}
+end
+redis.call('HINCRBY', KEYS[1], 'count', ARGV[2])
+if count > 0 then
+    redis.call('ZADD', KEYS[2], ARGV[1], ARGV[1])
+else
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+redis.call('ZADD', KEYS[3], count, ARGV[1])
+redis.call('HSET', KEYS[5], ARGV[1], redis.call('INCR', KEYS[4]))
+return {1, count, redis.call('HGETALL', KEYS[1])}
+"""
+
+# Bumps the catalog version KEYS[1] and records it as the version of
+# Product ARGV[1] in the versions hash KEYS[2], so no two writes, even
+# across a reset, ever share a version.
+STAMP_VERSION_SCRIPT = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('HSET', KEYS[2], ARGV[1], version)
+return version
+"""
+
+# Adds the member ARGV[1] of Product ARGV[2] to the name sort index KEYS[1]
+# and scores the id in the name rank index KEYS[2] halfway between the
+# scores of the names either side of it, so that ids ordered by that score
+# are ordered by name and can be intersected with other sets. When there
+# is no room left between two scores, or a name beside it has no score,
+# every id is scored by its position again, which is all that is done when
+# no member is given.
+INDEX_NAME_SCRIPT = """
+local zero = string.char(0)
+local function id_of(member)
+    local parts, start = {}, 1
+    while true do
+        local stop = string.find(member, zero, start, true)
+        if not stop then
+            break
+        end
+        parts[#parts + 1] = string.sub(member, start, stop - 1)
+        start = stop + 1
+    end
+    parts[#parts + 1] = string.sub(member, start)
+    return parts[math.floor(#parts / 2) + 1]
+end
+-- nil when there is no name at offset, false when it has no score
+local function score_at(offset)
+    if offset < 0 then
+        return nil
+    end
+    local members = redis.call('ZRANGE', KEYS[1], offset, offset)
+    if #members == 0 then
+        return nil
+    end
+    local score = redis.call('ZSCORE', KEYS[2], id_of(members[1]))
+    return score and tonumber(score)
+end
+local function renumber()
+    for position, member in ipairs(redis.call('ZRANGE', KEYS[1], 0, -1)) do
+        redis.call('ZADD', KEYS[2], position, id_of(member))
+    end
+    return 1
+end
+if #ARGV == 0 then
+    return renumber()
+end
+redis.call('ZADD', KEYS[1], 0, ARGV[1])
+local rank = redis.call('ZRANK', KEYS[1], ARGV[1])
+local before, after = score_at(rank - 1), score_at(rank + 1)
+local score
+if before == false or after == false then
+    score = nil
+elseif before == nil then
+    score = after and after - 1 or 0
+elseif after == nil then
+    score = before + 1
+else
+    score = tonumber(string.format('%.17g', (before + after) / 2))
+    if score <= before or score >= after then
+        score = nil
+    end
+end
+if score then
+    redis.call('ZADD', KEYS[2], string.format('%.17g', score), ARGV[2])
+    return 0
+end
+return renumber()
+"""
+
+# Moves the id counter KEYS[1] up to ARGV[1] unless it is already past it
+RAISE_INDEX_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+"""
+
+
+# every key of the model starts with this prefix, see Product.use_prefix()
+KEY_PREFIX = os.getenv('PRODUCT_KEY_PREFIX', 'products:')
+
+# the names of the keys used before they were namespaced, see migrate_keys()
+LEGACY_KEYS = ('index', 'inventory', 'catalog:version', 'versions',
+               'import:checkpoints')
+
+
+# a stored JSON value that is already an integer, see Product.iterate_json()
+INTEGER_JSON = re.compile(r'-?\d+$')
+
+
+def _tokenize(text):
+    """ Splits text into the lowercased words the search index is built on """
+    return re.findall(r'\w+', (u'%s' % text).lower(), re.UNICODE)
+
+
+def _text(value):
+    """ Returns a Redis reply as text on both Python 2 and 3 """
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
 ######################################################################
 # Product Model for database
 #   This class must be initialized with use_db(redis) before using
@@ -52,13 +257,69 @@ class Product(object):
     #lock = threading.Lock()
     #data = []
     #index = 0
+    # no per instance __dict__, large listings hold many Products at once
+    __slots__ = ('id', 'name', 'category', 'price', 'description', 'color',
+                 'count')
     logger = logging.getLogger(__name__)
     redis = None
+    # attributes that get a normalized (lowercased) secondary index
+    indexed_attributes = ('category', 'name', 'color')
+    # attributes whose words go into the full-text search index
+    text_attributes = ('name', 'description')
+    # seconds the combined result of a search is kept for paging
+    search_ttl = 60
+    # number of keys walked per SCAN and fetched per MGET
+    batch_size = 500
+    prefix = KEY_PREFIX
+    # a Product is stored under record_key followed by its id
+    record_key = KEY_PREFIX + 'product:'
+    # counter the ids of new Products are taken from
+    counter_key = KEY_PREFIX + 'index'
+    # set of every key written under the prefix, emptied by remove_all()
+    registry_key = KEY_PREFIX + 'keys'
+    # sorted set of every Product id, used to page through the catalog
+    ids_key = KEY_PREFIX + 'idx:ids'
+    # sorted set of the ids of the Products with count greater than 0
+    available_key = KEY_PREFIX + 'idx:available'
+    # sort indexes: ids scored by price and count, lowercased names by lex
+    price_key = KEY_PREFIX + 'idx:sort:price'
+    count_key = KEY_PREFIX + 'idx:sort:count'
+    name_key = KEY_PREFIX + 'idx:sort:name'
+    # ids scored in the order of their names, see INDEX_NAME_SCRIPT
+    name_rank_key = KEY_PREFIX + 'idx:sort:name_rank'
+    sort_fields = ('price', 'count', 'name')
+    # hash of Product id to count, changed atomically by adjust_count()
+    inventory_key = KEY_PREFIX + 'inventory'
+    __scripts = {}
+    # bumped by every change so cached query results can tell they are stale
+    version_key = KEY_PREFIX + 'catalog:version'
+    # hash of Product id to the catalog version of its last change
+    versions_key = KEY_PREFIX + 'versions'
+    # optional read-through cache of find(), see enable_cache()
+    cache = None
+    # seconds a cached Product is kept when no ttl is given
+    cache_ttl = 60
+    cache_channel = KEY_PREFIX + 'invalidate'
+    __cache_listener = None
+    # the attributes above that hold a key, moved by use_prefix()
+    key_attributes = ('record_key', 'counter_key', 'registry_key', 'ids_key',
+                      'available_key', 'price_key', 'count_key', 'name_key',
+                      'name_rank_key', 'inventory_key', 'version_key', 'versions_key',
+                      'cache_channel')
+    # 'blob' stores encoded records, 'hash' stores one hash per Product
+    storage = os.getenv('PRODUCT_STORAGE', 'blob')
+    # the codec new blobs are written with, see serializers.py
+    codec = serializers.get_codec(os.getenv('PRODUCT_CODEC', 'pickle'))
+    fields = ('id', 'name', 'category', 'price', 'description', 'color',
+              'count')
+    # the fields the REST API returns as integers, the others are strings
+    integer_fields = ('id', 'count')
     schema = {
         'id': {'type': 'integer'},
         'name': {'type': 'string', 'required': True},
         'category': {'type': 'string', 'required': True},
-        'price': {'type': 'integer', 'required': True},
+        # a string in the API model, numbers are taken as well
+        'price': {'type': ['string', 'number'], 'required': True},
         'description': {'type': 'string', 'required': True},
         'color': {'type': 'string', 'required': True},
         'count': {'type': 'integer', 'required': True}
@@ -76,26 +337,123 @@ class Product(object):
         self.description = description
         self.count = count
 
-    def save(self):
+    @metrics.timed
+    def save(self, versions=None):
         """
         Saves a Product to the data store
+        Args:
+            versions (list): only save while the Product still has one of
+                             these versions, see get_version()
+        Raises:
+            PreconditionFailedError: if the Product has another version
         """
         if self.id == 0:
             self.id = Product.__next_index()
+            pipe = Product.redis.pipeline()
+            self._queue(pipe, None)
+            pipe.execute()
+        else:
+            Product.__transact([self.id], lambda pipe, old_data:
+                               self._queue(pipe, old_data.get(self.id)),
+                               versions)
         # Product.data.append(self)
 
-        Product.redis.set(self.id, pickle.dumps(self.serialize()))
-        # print Product.data[-1].id
-        # else:
-        # for i in range(len(Product.data)):
-        #    if Product.data[i].id == self.id:
-        #        Product.data[i] = self
-        #        break
+    @staticmethod
+    def __transact(product_ids, queue, versions=None):
+        """
+        Runs writes that depend on the stored data of Products atomically
+        The record keys are WATCHed while the stored data is read, and the
+        read and the writes are retried when another writer changed one of
+        the Products in between. So index entries are always moved from
+        the values that are really stored, and a hash only gets the fields
+        that differ from what it really holds. Every write that gives a
+        Product a new version also writes its record key, so with versions
+        the check of the one Product's version is covered by the same
+        WATCH and never retried for changes to other Products.
+        Args:
+            product_ids (list): the ids of the Products
+            queue (function): queues the writes given the pipeline and a
+                              dictionary of the stored data by id
+            versions (list): the versions the one Product may have
+        Raises:
+            PreconditionFailedError: if the Product has another version
+        """
+        keys = [Product._key(i) for i in product_ids]
+        if versions is not None:
+            versions = set('%s' % version for version in versions)
+        with Product.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(*keys)
+                    if versions is not None:
+                        version = pipe.hget(Product.versions_key,
+                                            product_ids[0])
+                        if version is None or _text(version) not in versions:
+                            raise PreconditionFailedError(
+                                'Product with id: %s has changed'
+                                % product_ids[0])
+                    old_data = dict((data['id'], data) for data in
+                                    Product.__fetch_data(product_ids))
+                    pipe.multi()
+                    queue(pipe, old_data)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    Product.logger.info('Products %s changed, retrying',
+                                        product_ids)
+
+    def _queue(self, pipe, old_data):
+        """ Queues the writes of a Product and its indexes on a pipeline """
+        try:
+            self.count = int(self.count)
+        except (TypeError, ValueError):
+            raise DataValidationError(
+                'Invalid product: count must be an integer')
+        data = self.serialize()
+        Product.__store(pipe, data, old_data)
+        Product.__unindex(pipe, old_data)
+        Product.__index(pipe, data)
+        Product._invalidate(pipe, self.id)
+        # EVAL rather than a registered script, which would cost the
+        # pipeline a SCRIPT EXISTS round trip on every execute
+        pipe.eval(STAMP_VERSION_SCRIPT, 2, Product.version_key,
+                  Product.versions_key, self.id)
 
+    @metrics.timed
     def delete(self):
         """ Removes a Product from the data store """
         # Product.data.remove(self)
-        Product.redis.delete(self.id)
+        Product.__transact([self.id], lambda pipe, old_data:
+                           Product._queue_delete(pipe, self.id,
+                                                 old_data.get(self.id)))
+
+    @staticmethod
+    def _queue_delete(pipe, product_id, old_data):
+        """ Queues the removal of a Product and its indexes on a pipeline """
+        pipe.delete(Product._key(product_id))
+        pipe.srem(Product.registry_key, Product._key(product_id))
+        pipe.hdel(Product.inventory_key, product_id)
+        Product.__unindex(pipe, old_data)
+        Product._invalidate(pipe, product_id)
+        pipe.incr(Product.version_key)
+        pipe.hdel(Product.versions_key, product_id)
+
+    @staticmethod
+    def from_dict(data):
+        """
+        Builds a Product from a stored dictionary in a single step
+        The read paths use this instead of Product(id).deserialize(data),
+        which would set every attribute twice.
+        Args:
+            data (dict): A dictionary with every field of a Product
+        """
+        try:
+            return Product(data['id'], data['name'], data['category'],
+                           data['price'], data['description'], data['color'],
+                           data['count'])
+        except KeyError as err:
+            raise DataValidationError(
+                'Invalid product: missing ' + err.args[0])
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
@@ -133,53 +491,1050 @@ class Product(object):
 ######################################################################
 
     @staticmethod
-    def __next_index():
-        """ Generates the next index in a continual sequence """
+    def __next_index(count=1):
+        """
+        Generates the next index in a continual sequence
+        When count is greater than 1 a block of that many indexes is
+        reserved and the last one is returned.
+        """
         # with Product.lock:
         #    Product.index += 1
         # return Product.index
-        return Product.redis.incr('index')
+        return Product.redis.incrby(Product.counter_key, count)
+
+    @staticmethod
+    @metrics.timed
+    def save_many(products):
+        """
+        Saves many Products that already have ids in one round trip
+        Products that exist are overwritten and their index entries moved,
+        so saving the same Products again is idempotent. The id counter is
+        moved past the largest id so new Products never collide with them.
+        Args:
+            products (list): the Products to save, all with an id
+        """
+        if not products:
+            return
+
+        def queue(pipe, old_data):
+            for product in products:
+                product._queue(pipe, old_data.get(product.id))
+
+        Product.__transact([p.id for p in products], queue)
+        Product.__run_script(RAISE_INDEX_SCRIPT, [Product.counter_key],
+                             [max(p.id for p in products)])
+
+    @staticmethod
+    @metrics.timed
+    def create_many(items):
+        """
+        Validates and saves many new Products at once
+        Every item is checked against the schema, the ids of the valid
+        ones are reserved as a single block and they are all written
+        through pipelines of batch_size Products.
+        Args:
+            items (list): the dictionaries of Product data
+        Returns:
+            list: a (Product, None) tuple for every item that was saved
+                  and a (None, errors) tuple for every item that was not
+        """
+        validator = Validator(Product.schema)
+        results = []
+        for data in items:
+            if not isinstance(data, dict):
+                results.append((None, 'must be a JSON object'))
+            elif validator.validate(data):
+                results.append((Product().deserialize(data), None))
+            else:
+                results.append((None, validator.errors))
+        products = [product for product, _ in results if product]
+        if products:
+            first = Product.__next_index(len(products)) - len(products) + 1
+            pipe = Product.redis.pipeline()
+            for offset, product in enumerate(products):
+                product.id = first + offset
+                product._queue(pipe, None)
+                if (offset + 1) % Product.batch_size == 0:
+                    pipe.execute()
+            pipe.execute()
+            Product.logger.info('Created %d products', len(products))
+        return results
+
+######################################################################
+#  S T O R A G E   M E T H O D S
+######################################################################
 
     @staticmethod
+    def __store(pipe, data, old_data):
+        """ Queues the writes of a Product's data on a pipeline """
+        key = Product._key(data['id'])
+        if not old_data:
+            pipe.sadd(Product.registry_key, key)
+        if Product.storage == 'hash':
+            # only the fields that changed are written, old_data is read
+            # under WATCH so it is what the hash really holds
+            changed = dict((field, json.dumps(data[field]))
+                           for field in Product.fields
+                           if not old_data or old_data.get(field) != data[field])
+            if changed:
+                pipe.hset(key, mapping=changed)
+        else:
+            record = dict(data)
+            del record['count']  # the inventory hash holds the count
+            pipe.set(key, serializers.encode(record, Product.codec))
+            pipe.hset(Product.inventory_key, data['id'], data['count'])
+
+    @staticmethod
+    def _decode(record, count):
+        """ Decodes a stored record and merges in its inventory count """
+        data = serializers.decode(record)
+        if count is not None:  # older records still carry their own count
+            data['count'] = int(count)
+        return data
+
+    @staticmethod
+    def _decode_fields(fields, values):
+        """ Decodes the JSON encoded fields of a Product hash """
+        return dict((field, json.loads(value))
+                    for field, value in zip(fields, values)
+                    if value is not None)
+
+    @staticmethod
+    def __load(product_id, fields=None):
+        """ Returns the stored dictionary for a Product or None """
+        results = Product.__fetch_data([product_id], fields)
+        return results[0] if results else None
+
+    @staticmethod
+    def __fetch_data(product_ids, fields=None):
+        """
+        Fetches the stored dictionaries of many Products in one round trip
+        Args:
+            product_ids (list): the ids of the Products to fetch
+            fields (list): only return these fields, all of them if None
+        Returns:
+            list: the dictionaries in id order, missing Products skipped
+        """
+        product_ids = sorted(int(i) for i in product_ids)
+        if not product_ids:
+            return []
+        results = []
+        pipe = Product.redis.pipeline()
+        if Product.storage == 'hash':
+            # always read the id so a missing Product can be told apart
+            wanted = ['id'] + [f for f in fields or Product.fields
+                               if f != 'id']
+            for product_id in product_ids:
+                pipe.hmget(Product._key(product_id), wanted)
+            for values in pipe.execute():
+                if values[0] is not None:
+                    results.append(Product._decode_fields(wanted, values))
+        else:
+            pipe.mget([Product._key(i) for i in product_ids])
+            if fields and 'count' not in fields:
+                records, counts = pipe.execute()[0], [None] * len(product_ids)
+            else:
+                pipe.hmget(Product.inventory_key, product_ids)
+                records, counts = pipe.execute()
+            for record, count in zip(records, counts):
+                if record is not None:  # skip keys deleted since the lookup
+                    results.append(Product._decode(record, count))
+        if fields:
+            results = [dict((f, data[f]) for f in fields if f in data)
+                       for data in results]
+        return results
+
+    @staticmethod
+    def __fetch(product_ids, fields=None):
+        """
+        Fetches many Products in one round trip
+        With fields only those fields are read and returned as dictionaries
+        """
+        return Product.__build(Product.__fetch_data(product_ids, fields),
+                               fields)
+
+    @staticmethod
+    def __build(results, fields=None):
+        """ Turns stored dictionaries into Products, or projects fields """
+        if fields:
+            return [dict((f, data[f]) for f in fields if f in data)
+                    for data in results]
+        return [Product.from_dict(data) for data in results]
+
+    @staticmethod
+    @metrics.timed
+    def get_fields(product_id, fields):
+        """
+        Reads only some of the fields of a Product
+        With hash storage only the requested fields leave Redis.
+        Args:
+            product_id (int): the id of the Product to read
+            fields (list): the names of the fields to return
+        Returns:
+            dict: the requested fields or None if the Product was not found
+        """
+        return Product.__load(product_id, fields)
+
+    @staticmethod
+    @metrics.timed
+    def set_fields(product_id, values):
+        """
+        Updates only some of the fields of a Product
+        With hash storage only the fields that changed are written.
+        Args:
+            product_id (int): the id of the Product to update
+            values (dict): the new values of the fields to change
+        Returns:
+            Product: the updated Product
+        Raises:
+            NotFoundError: if the Product does not exist
+        """
+        products = []
+
+        def queue(pipe, old_data):
+            data = old_data.get(int(product_id))
+            if data is None:
+                raise NotFoundError(
+                    'Product with id: %s was not found' % product_id)
+            product = Product(product_id).deserialize(dict(data, **values))
+            product._queue(pipe, data)
+            products[:] = [product]
+
+        Product.__transact([int(product_id)], queue)
+        return products[0]
+
+    @staticmethod
+    def migrate_storage(batch_size=None):
+        """
+        Converts Products stored as encoded blobs into hashes
+        Run this before switching PRODUCT_STORAGE to hash. Keys that are
+        already hashes are left alone so the migration can be re-run.
+        Returns:
+            int: the number of Products that were converted
+        """
+        converted = 0
+        for batch in Product.__scan_ids(batch_size or Product.batch_size):
+            pipe = Product.redis.pipeline(transaction=False)
+            for product_id in batch:
+                pipe.type(Product._key(product_id))
+            blobs = [product_id for product_id, key_type
+                     in zip(batch, pipe.execute())
+                     if _text(key_type) == 'string']
+            if not blobs:
+                continue
+            pipe.mget([Product._key(i) for i in blobs])
+            pipe.hmget(Product.inventory_key, blobs)
+            records, counts = pipe.execute()
+            pipe = Product.redis.pipeline()
+            for product_id, record, count in zip(blobs, records, counts):
+                if record is None:
+                    continue
+                data = Product._decode(record, count)
+                pipe.delete(Product._key(product_id))
+                pipe.hset(Product._key(product_id), mapping=dict(
+                    (field, json.dumps(data[field]))
+                    for field in Product.fields))
+                pipe.hdel(Product.inventory_key, product_id)
+                converted += 1
+            pipe.execute()
+        Product.redis.incr(Product.version_key)
+        Product._invalidate(Product.redis, '*')
+        Product.logger.info('Converted %d products to hashes', converted)
+        return converted
+
+######################################################################
+#  S E C O N D A R Y   I N D E X   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def _index_key(attribute, value):
+        """ Returns the key of the index set for an attribute value """
+        return '%sidx:%s:%s' % (Product.prefix, attribute,
+                                ('%s' % value).lower())
+
+    @staticmethod
+    def __search_key(word):
+        """ Returns the key of the search index of a word """
+        return u'%sidx:text:%s' % (Product.prefix, word)
+
+    @staticmethod
+    def __word_counts(data):
+        """ Counts the words of the searchable attributes of a Product """
+        return Counter(word for attribute in Product.text_attributes
+                       for word in _tokenize(data[attribute]))
+
+    @staticmethod
+    def __price_score(price):
+        """ Returns a price as a number, or None if it isn't numeric """
+        try:
+            return float(price)
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def __name_member(data):
+        """ Returns the member of a Product in the name sort index """
+        # the zero byte sorts before any character so 'mac' < 'mac pro',
+        # the name as it was given follows the id for suggest()
+        name = u'%s' % data['name']
+        return u'%s\x00%d\x00%s' % (name.lower(), data['id'], name)
+
+    @staticmethod
+    def __split_name_member(member):
+        """ Returns the id and the name kept in a member of the name index """
+        parts = _text(member).split(u'\x00')
+        if len(parts) == 2:  # indexed before the name was kept as given
+            return int(parts[1]), parts[0]
+        # a name holds as many zero bytes lowercased as it does as given
+        middle = len(parts) // 2
+        return int(parts[middle]), u'\x00'.join(parts[middle + 1:])
+
+    @staticmethod
+    def __index(pipe, data):
+        """ Adds a Product to the index sets of its attributes """
+        if data:
+            pipe.zadd(Product.ids_key, {data['id']: data['id']})
+            if int(data['count']) > 0:
+                pipe.zadd(Product.available_key, {data['id']: data['id']})
+            pipe.zadd(Product.count_key, {data['id']: int(data['count'])})
+            pipe.eval(INDEX_NAME_SCRIPT, 2, Product.name_key,
+                      Product.name_rank_key, Product.__name_member(data),
+                      data['id'])
+            price = Product.__price_score(data['price'])
+            if price is not None:
+                pipe.zadd(Product.price_key, {data['id']: price})
+            keys = [Product._index_key(attribute, data[attribute])
+                    for attribute in Product.indexed_attributes]
+            for key in keys:
+                pipe.sadd(key, data['id'])
+            for word, count in Product.__word_counts(data).items():
+                keys.append(Product.__search_key(word))
+                pipe.zadd(keys[-1], {data['id']: count})
+            pipe.sadd(Product.registry_key, *keys)
+
+    @staticmethod
+    def __unindex(pipe, data):
+        """ Removes a Product from the index sets of its attributes """
+        if data:
+            pipe.zrem(Product.ids_key, data['id'])
+            pipe.zrem(Product.available_key, data['id'])
+            pipe.zrem(Product.count_key, data['id'])
+            member = Product.__name_member(data)
+            # with the member of indexes built before names kept their case
+            pipe.zrem(Product.name_key, member, member.rsplit(u'\x00', 1)[0])
+            pipe.zrem(Product.name_rank_key, data['id'])
+            pipe.zrem(Product.price_key, data['id'])
+            for attribute in Product.indexed_attributes:
+                pipe.srem(Product._index_key(attribute, data[attribute]),
+                          data['id'])
+            for word in Product.__word_counts(data):
+                pipe.zrem(Product.__search_key(word), data['id'])
+
+    @staticmethod
+    @metrics.timed
+    def rebuild_indexes():
+        """
+        Rebuilds the secondary indexes from the stored Products
+        Use this after loading data that was saved without indexes, it
+        also seeds the inventory hash for records that predate it
+        Returns:
+            int: the number of Products that were indexed
+        """
+        pipe = Product.redis.pipeline()
+        for key in Product.redis.scan_iter(match=Product.prefix + 'idx:*'):
+            pipe.delete(key)
+        count = 0
+        # the id index was just dropped so the records themselves are walked
+        for batch in Product.__scan_ids(Product.batch_size):
+            for product in Product.__fetch(batch):
+                Product.__index(pipe, product.serialize())
+                if Product.storage != 'hash':
+                    pipe.hsetnx(Product.inventory_key, product.id,
+                                product.count)
+                count += 1
+            pipe.execute()
+        Product.logger.info('Rebuilt indexes for %d products', count)
+        return count
+
+    @staticmethod
+    def __scan_ids(batch_size):
+        """
+        Walks the Product keys with SCAN, yielding their ids in batches
+        This finds records that are not in the indexes, for the maintenance
+        methods. SCAN may return a key more than once, so an id can come
+        back twice and what is done with it has to be idempotent.
+        """
+        batch = []
+        start = len(Product.record_key)
+        for key in Product.redis.scan_iter(match=Product.record_key + '*',
+                                           count=batch_size):
+            batch.append(int(_text(key)[start:]))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def __index_ids(batch_size):
+        """
+        Walks the ordered id index, yielding the ids in batches
+        Each batch starts after the last id of the one before, so only one
+        batch is held at a time and no id comes back twice.
+        """
+        after = 0
+        while after is not None:
+            batch = [int(i) for i in Product.redis.zrangebyscore(
+                Product.ids_key, '(%d' % after, '+inf',
+                start=0, num=batch_size)]
+            after = batch[-1] if len(batch) == batch_size else None
+            yield batch
+
+    @staticmethod
+    @metrics.timed
+    def iterate(batch_size=None, fields=None):
+        """
+        Iterates over all of the Products in the database in id order
+        The ordered id index is read one batch at a time, so Redis is never
+        blocked and memory stays flat, and the Products are fetched in MGET
+        batches.
+        Args:
+            batch_size (int): the number of keys to fetch per round trip
+            fields (list): yield dictionaries of only these fields instead
+        """
+        for batch in Product.__index_ids(batch_size or Product.batch_size):
+            for product in Product.__fetch(batch, fields):
+                yield product
+
+    @staticmethod
+    @metrics.timed
+    def iterate_json(batch_size=None):
+        """
+        Iterates over all of the Products already encoded as JSON objects
+        This is the fast path of the largest listings: no Product object
+        is built and every object is encoded once, in the shape the REST
+        API returns with id and count as integers and the other fields as
+        strings. With hash storage the stored JSON of each field is spliced
+        in as it is whenever it already has the right type.
+        Args:
+            batch_size (int): the number of keys to fetch per round trip
+        """
+        for batch in Product.__index_ids(batch_size or Product.batch_size):
+            for text in Product.__fetch_json(batch):
+                yield text
+
+    @staticmethod
+    def __fetch_json(product_ids):
+        """ Fetches many Products as JSON objects in id order """
+        product_ids = sorted(int(i) for i in product_ids)
+        if not product_ids:
+            return []
+        keys = [u'"%s":' % field for field in Product.fields]
+        results = []
+        pipe = Product.redis.pipeline()
+        if Product.storage == 'hash':
+            for product_id in product_ids:
+                pipe.hmget(Product._key(product_id), Product.fields)
+            for values in pipe.execute():
+                if values[0] is not None:
+                    results.append(u'{%s}' % u','.join(
+                        key + Product.__splice_json(field, value)
+                        for key, field, value in zip(keys, Product.fields,
+                                                     values)))
+        else:
+            pipe.mget([Product._key(i) for i in product_ids])
+            pipe.hmget(Product.inventory_key, product_ids)
+            records, counts = pipe.execute()
+            for record, count in zip(records, counts):
+                if record is not None:
+                    data = Product._decode(record, count)
+                    results.append(u'{%s}' % u','.join(
+                        key + Product.__json_value(field, data.get(field))
+                        for key, field in zip(keys, Product.fields)))
+        return results
+
+    @staticmethod
+    def __json_value(field, value):
+        """ Encodes a field value the way the REST API returns it """
+        if value is None:
+            return u'null'
+        if field in Product.integer_fields:
+            return u'%d' % int(value)
+        return json.dumps(u'%s' % value)
+
+    @staticmethod
+    def __splice_json(field, raw):
+        """ Returns a stored JSON field value, re-encoded only if needed """
+        if raw is None:
+            return u'null'
+        raw = _text(raw)
+        if field in Product.integer_fields:
+            if INTEGER_JSON.match(raw):
+                return raw
+        elif raw[:1] == u'"':
+            return raw
+        return Product.__json_value(field, json.loads(raw))
+
+    @staticmethod
+    @metrics.timed
     def all():
         """ Returns all of the Products in the database """
         # return [p for p in Product.data]
-        results = []
-        for key in Product.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Product.redis.get(key))
-                product = Product(data['id']).deserialize(data)
-                results.append(product)
-        return results
+        return list(Product.iterate())
 
     @staticmethod
+    @metrics.timed
     def available():
         """ Returns all of the Products in the database
         with count greater than 0"""
-        results = []
+        return list(Product.iterate_available())
 
-        for key in Product.redis.keys():
-            if key != 'index':  # filer out our id index
-                data = pickle.loads(Product.redis.get(key))
-                product = Product(data['id']).deserialize(data)
+    @staticmethod
+    @metrics.timed
+    def iterate_available(batch_size=None):
+        """
+        Iterates over the Products with count greater than 0
+        Only the ids in the availability index are read, in batches.
+        Args:
+            batch_size (int): the number of Products to fetch per round trip
+        """
+        batch_size = batch_size or Product.batch_size
+        after = 0
+        while after is not None:
+            products, after = Product.page(batch_size, after, available=True)
+            for product in products:
+                yield product
 
-                if product.count > 0:
-                    results.append(product)
-        return results
+    @staticmethod
+    @metrics.timed
+    def page(limit, after=0, available=False, fields=None):
+        """
+        Returns one page of Products ordered by id
+        Only the ids of the page are read from the ordered id index so a
+        page costs O(limit) no matter how large the catalog is.
+        Args:
+            limit (int): the maximum number of Products to return
+            after (int): only return Products with an id greater than this
+            available (bool): only return Products with count greater than 0
+            fields (list): return dictionaries of only these fields instead
+        Returns:
+            tuple: the list of Products and the id to continue after,
+                   which is None when this is the last page
+        """
+        key = Product.available_key if available else Product.ids_key
+        product_ids = Product.redis.zrangebyscore(
+            key, '(%d' % after, '+inf', start=0, num=limit + 1)
+        products = Product.__fetch(product_ids[:limit], fields)
+        if len(product_ids) <= limit:
+            return products, None
+        return products, int(product_ids[limit - 1])
+
+    @staticmethod
+    @metrics.timed
+    def query(sort=None, min_price=None, max_price=None, limit=None,
+              offset=0, fields=None):
+        """
+        Returns Products in a price range sorted by price, count or name
+        The range and the order are resolved with the sorted set indexes
+        so only the Products of the requested page are fetched.
+        Args:
+            sort (string): price, count or name, prefixed with - to reverse
+            min_price (float): the lowest price to return
+            max_price (float): the highest price to return
+            limit (int): the maximum number of Products, all if None
+            offset (int): the number of matching Products to skip
+            fields (list): return dictionaries of only these fields instead
+        Returns:
+            tuple: the list of Products and the offset of the next page,
+                   which is None when this is the last page
+        """
+        sort = sort or 'price'
+        field = sort.lstrip('-')
+        descending = sort.startswith('-')
+        if field not in Product.sort_fields:
+            raise DataValidationError('Invalid sort: ' + sort)
+        ranged = min_price is not None or max_price is not None
+        low = '-inf' if min_price is None else min_price
+        high = '+inf' if max_price is None else max_price
+        num = -1 if limit is None else limit + 1
+        if ranged and field != 'price':
+            # the range is cut out of the price index and ordered in Redis
+            return Product.filter({}, limit=limit, offset=offset,
+                                  fields=fields, sort=sort,
+                                  min_price=min_price, max_price=max_price)
+        if field == 'name':
+            if descending:
+                members = Product.redis.zrevrangebylex(
+                    Product.name_key, '+', '-', start=offset, num=num)
+            else:
+                members = Product.redis.zrangebylex(
+                    Product.name_key, '-', '+', start=offset, num=num)
+            product_ids = [Product.__split_name_member(m)[0]
+                           for m in members]
+        else:
+            key = Product.price_key if field == 'price' else Product.count_key
+            if descending:
+                product_ids = Product.redis.zrevrangebyscore(
+                    key, high, low, start=offset, num=num)
+            else:
+                product_ids = Product.redis.zrangebyscore(
+                    key, low, high, start=offset, num=num)
+        has_more = limit is not None and len(product_ids) > limit
+        results = Product.__fetch_in_order(product_ids[:limit], fields)
+        return results, offset + limit if has_more else None
+
+    @staticmethod
+    @metrics.timed
+    def filter(filters, available=False, limit=None, offset=0,
+               fields=None, sort=None, min_price=None, max_price=None):
+        """
+        Returns the Products that match every filter, in a price range
+        The index sets of the filters are intersected in Redis with the
+        sorted set the results are ordered by, the price range is cut out
+        of that intersection, so only the ids that match everything come
+        back and only the Products of the requested page are fetched.
+        The intersection is kept for a short while under the catalog
+        version so the next pages reuse it.
+        Args:
+            filters (dict): indexed attribute names to the value to match
+            available (bool): only return Products with count greater than 0
+            limit (int): the maximum number of Products, all if None
+            offset (int): the number of matching Products to skip
+            fields (list): return dictionaries of only these fields instead
+            sort (string): price, count or name, prefixed with - to
+                           reverse, by id if None
+            min_price (float): the lowest price to return
+            max_price (float): the highest price to return
+        Returns:
+            tuple: the list of Products and the offset of the next page,
+                   which is None when this is the last page
+        """
+        pairs, keys = Product._filter_keys(filters, available)
+        field = sort.lstrip('-') if sort else None
+        descending = bool(sort) and sort.startswith('-')
+        if field is not None and field not in Product.sort_fields:
+            raise DataValidationError('Invalid sort: ' + sort)
+        ranged = min_price is not None or max_price is not None
+        key = Product.ids_key
+        if keys or ranged or field:
+            if sort:
+                pairs.append(('sort', sort))
+            if min_price is not None:
+                pairs.append(('min_price', min_price))
+            if max_price is not None:
+                pairs.append(('max_price', max_price))
+            key = u'%sfilter:%d:%s' % (
+                Product.prefix, Product.catalog_version(),
+                u'&'.join(u'%s=%s' % pair for pair in pairs))
+            if not Product.redis.exists(key):
+                if field == 'name' and \
+                        not Product.redis.exists(Product.name_rank_key):
+                    # names indexed before the rank index was kept
+                    Product.__run_script(INDEX_NAME_SCRIPT, [
+                        Product.name_key, Product.name_rank_key], [])
+                Product.__store_filter(key, keys, field, min_price, max_price)
+        end = -1 if limit is None else offset + limit
+        if descending:
+            product_ids = Product.redis.zrevrange(key, offset, end)
+        else:
+            product_ids = Product.redis.zrange(key, offset, end)
+        has_more = limit is not None and len(product_ids) > limit
+        results = Product.__fetch_in_order(product_ids[:limit], fields)
+        return results, offset + limit if has_more else None
+
+    @staticmethod
+    def _filter_keys(filters, available):
+        """
+        Returns the normalized filters and the keys of their index sets
+        Raises:
+            DataValidationError: if an attribute is not indexed
+        """
+        for attribute in filters or {}:
+            if attribute not in Product.indexed_attributes:
+                raise DataValidationError('Invalid filter: ' + attribute)
+        pairs = sorted((attribute, ('%s' % value).lower())
+                       for attribute, value in (filters or {}).items())
+        keys = [Product._index_key(attribute, value)
+                for attribute, value in pairs]
+        if available:
+            pairs.append(('available', 'true'))
+            keys.append(Product.available_key)
+        return pairs, keys
+
+    @staticmethod
+    def __store_filter(key, keys, field, min_price, max_price):
+        """
+        Stores the ids that are in every one of keys and in the price range
+        The ids are scored by the sort field, price when there is a range,
+        and by id otherwise. Only that index adds to the score.
+        """
+        ranged = min_price is not None or max_price is not None
+        scores = {'price': Product.price_key, 'count': Product.count_key,
+                  'name': Product.name_rank_key}
+        score_key = Product.price_key if ranged else \
+            scores.get(field, Product.ids_key)
+        weights = dict((k, 0) for k in keys + [Product.ids_key])
+        weights[score_key] = 1
+        pipe = Product.redis.pipeline()
+        pipe.zinterstore(key, weights)
+        if min_price is not None:
+            pipe.zremrangebyscore(key, '-inf', '(%r' % float(min_price))
+        if max_price is not None:
+            pipe.zremrangebyscore(key, '(%r' % float(max_price), '+inf')
+        if ranged and field != 'price':
+            # score what is left by the sort field, or the id
+            pipe.zinterstore(key, {key: 0,
+                                   scores.get(field, Product.ids_key): 1})
+        pipe.expire(key, Product.search_ttl)
+        pipe.execute()
+
+    @staticmethod
+    @metrics.timed
+    def search(text, limit=None, offset=0, fields=None, filters=None,
+               available=False):
+        """
+        Finds the Products whose name or description has every word of text
+        Each word has a sorted set of the ids of the Products it appears
+        in, scored by how often it appears. Several words and the index
+        sets of the filters are intersected in Redis, summing the scores
+        of the words, and the result is kept for a short while under the
+        catalog version so the next pages reuse it.
+        Args:
+            text (string): the words to search for
+            limit (int): the maximum number of Products, all if None
+            offset (int): the number of matching Products to skip
+            fields (list): return dictionaries of only these fields instead
+            filters (dict): indexed attribute names to the value to match
+            available (bool): only return Products with count greater than 0
+        Returns:
+            tuple: the Products, most relevant first, and the offset of the
+                   next page, which is None when this is the last page
+        """
+        pairs, filter_keys = Product._filter_keys(filters, available)
+        words = sorted(set(_tokenize(text)))
+        if not words:
+            return [], None
+        keys = [Product.__search_key(word) for word in words]
+        key = keys[0]
+        if len(keys) > 1 or filter_keys:
+            key = u'%ssearch:%d:%s' % (Product.prefix,
+                                       Product.catalog_version(),
+                                       u' '.join(words))
+            if pairs:
+                key += u'&' + u'&'.join(u'%s=%s' % pair for pair in pairs)
+            if not Product.redis.exists(key):
+                # the filters only narrow, the words make the score
+                weights = dict([(k, 1) for k in keys] +
+                               [(k, 0) for k in filter_keys])
+                pipe = Product.redis.pipeline()
+                pipe.zinterstore(key, weights, aggregate='SUM')
+                pipe.expire(key, Product.search_ttl)
+                pipe.execute()
+        end = -1 if limit is None else offset + limit
+        product_ids = Product.redis.zrevrange(key, offset, end)
+        has_more = limit is not None and len(product_ids) > limit
+        results = Product.__fetch_in_order(product_ids[:limit], fields)
+        return results, offset + limit if has_more else None
+
+    @staticmethod
+    @metrics.timed
+    def suggest(prefix, limit=10):
+        """
+        Returns the distinct names that start with prefix, for autocomplete
+        The names come straight from the lexicographic name index, so no
+        Product is fetched. Names are returned as they were saved, in
+        order, and names that differ only in case are returned once.
+        Args:
+            prefix (string): the start of the name, in any case
+            limit (int): the maximum number of names to return
+        """
+        prefix = (u'%s' % prefix).lower().encode('utf-8')
+        if not prefix:
+            return []
+        # 0xff never occurs in UTF-8 so it sorts after every continuation
+        low, high = b'[' + prefix, b'[' + prefix + b'\xff'
+        names = []
+        start = 0
+        while len(names) < limit:
+            members = Product.redis.zrangebylex(Product.name_key, low, high,
+                                                start=start, num=limit)
+            for member in members:
+                name = Product.__split_name_member(member)[1]
+                # members are sorted by the lowercased name
+                if not names or names[-1].lower() != name.lower():
+                    names.append(name)
+            if len(members) < limit:
+                break
+            start += limit
+        return names[:limit]
+
+    @staticmethod
+    def __fetch_in_order(product_ids, fields=None):
+        """ Fetches many Products, keeping the order of their ids """
+        product_ids = [int(i) for i in product_ids]
+        results = dict((data['id'], data) for data in Product.__fetch_data(
+            product_ids, Product.__with_id(fields)))
+        return Product.__build([results[i] for i in product_ids
+                                if i in results], fields)
+
+    @staticmethod
+    def __with_id(fields):
+        """ Adds the id to a list of fields so results can be told apart """
+        if not fields:
+            return None
+        return ['id'] + [field for field in fields if field != 'id']
+
+    @staticmethod
+    @metrics.timed
+    def adjust_count(product_id, delta):
+        """
+        Atomically adds delta to the count of a Product
+        The out of stock check and the change happen in a single Lua
+        script so concurrent sales can neither lose updates nor oversell.
+        Args:
+            product_id (int): the id of the Product to change
+            delta (int): the number of units to add, negative to remove
+        Returns:
+            Product: the Product with its new count
+        Raises:
+            NotFoundError: if the Product does not exist
+            OutOfStockError: if the count would go below zero
+        """
+        if Product.storage == 'hash':
+            result = Product.__run_script(
+                ADJUST_HASH_COUNT_SCRIPT,
+                [Product._key(product_id), Product.available_key,
+                 Product.count_key, Product.version_key, Product.versions_key],
+                [product_id, delta])
+        else:
+            keys = [Product.inventory_key, Product._key(product_id),
+                    Product.available_key,
+                    Product.count_key, Product.version_key,
+                    Product.versions_key]
+            result = Product.__run_script(
+                ADJUST_COUNT_SCRIPT, keys, [product_id, delta])
+            if result and result[0] == -1:
+                # seed the inventory from a record saved before it existed
+                data = Product.__load(product_id)
+                if data:
+                    Product.redis.hsetnx(Product.inventory_key, product_id,
+                                         int(data['count']))
+                result = Product.__run_script(
+                    ADJUST_COUNT_SCRIPT, keys, [product_id, delta])
+        data = Product._count_result(product_id, result)
+        Product._invalidate(Product.redis, product_id)
+        return Product.from_dict(data)
+
+    @staticmethod
+    def _count_result(product_id, result):
+        """ Decodes the reply of an adjust count script into the Product """
+        if not result:
+            raise NotFoundError(
+                'Product with id: %s was not found' % product_id)
+        if result[0] == 0:
+            raise OutOfStockError(
+                'Product with id: %s is out of Stock' % product_id)
+        if Product.storage == 'hash':
+            pairs = result[2]
+            return Product._decode_fields(
+                [_text(field) for field in pairs[::2]], pairs[1::2])
+        return Product._decode(result[2], result[1])
+
+    @staticmethod
+    def __run_script(source, keys, args):
+        """ Runs a Lua script, registering it with the client once """
+        script = Product.__scripts.get(source)
+        if script is None or script.registered_client is not Product.redis:
+            script = Product.redis.register_script(source)
+            Product.__scripts[source] = script
+        return script(keys=keys, args=args)
+
+    @staticmethod
+    @metrics.timed
+    def catalog_version():
+        """ Returns the version of the catalog, which every change bumps """
+        return int(Product.redis.get(Product.version_key) or 0)
+
+    @staticmethod
+    @metrics.timed
+    def get_version(product_id):
+        """
+        Returns the version of a Product without loading it
+        Products that were not written since versions were introduced,
+        and Products that do not exist, have no version and return None.
+        """
+        version = Product.redis.hget(Product.versions_key, product_id)
+        return int(version) if version is not None else None
 
     @staticmethod
-    def remove_all():
-        """ Removes all of the Products from the database """
+    @metrics.timed
+    def remove_all(batch_size=None):
+        """
+        Removes all of the Products from the database
+        Only the keys in the registry are deleted, a batch at a time with
+        UNLINK so that Redis frees them in the background and never
+        blocks. Other data in the same database is left alone.
+        """
         #del Product.data[:]
         #Product.index = 0
         # return Product.data
-        Product.redis.flushall()
+        version = Product.catalog_version()
+        batch_size = batch_size or Product.batch_size
+        while True:
+            keys = Product.redis.spop(Product.registry_key, batch_size)
+            if not keys:
+                break
+            Product.redis.unlink(*keys)
+        # carry the version on so responses cached before the reset are stale
+        Product.redis.set(Product.version_key,
+                          max(version + 1, int(time.time() * 1000)))
+        Product.__register_fixed_keys()
+        Product._invalidate(Product.redis, '*')
+
+    @staticmethod
+    def _key(product_id):
+        """ Returns the key a Product is stored under """
+        return '%s%s' % (Product.record_key, product_id)
+
+    @staticmethod
+    def register_keys(*keys):
+        """ Records keys in the registry so that remove_all() deletes them """
+        if keys:
+            Product.redis.sadd(Product.registry_key, *keys)
+
+    @staticmethod
+    def __register_fixed_keys():
+        """ Records the keys that exist whatever Products are stored """
+        Product.register_keys(*[getattr(Product, name)
+                                for name in Product.key_attributes
+                                if name not in ('record_key', 'registry_key',
+                                                'cache_channel')])
+
+    @staticmethod
+    def use_prefix(prefix):
+        """ Moves every key of the model under another prefix """
+        for name in Product.key_attributes:
+            key = getattr(Product, name)[len(Product.prefix):]
+            setattr(Product, name, prefix + key)
+        Product.prefix = prefix
+
+    @staticmethod
+    def migrate_keys(batch_size=None):
+        """
+        Moves the keys written before they were namespaced under the prefix
+        The bare Product ids and then the id counter, the inventory,
+        version and import keys are renamed and registered, and the
+        indexes are rebuilt from the moved records. The database may be
+        shared, so only keys that hold this service's data are moved: an
+        all-digit key must hold the record of the Product with that id
+        and the other keys must match the records that were moved. A key
+        is never moved over one that already exists under the prefix.
+        Returns:
+            int: the number of keys that were moved
+        """
+        batch_size = batch_size or Product.batch_size
+        numbers, legacy = [], []
+        for key in Product.redis.scan_iter(count=batch_size):
+            name = _text(key)
+            if name.isdigit():
+                numbers.append(name)
+            elif name in LEGACY_KEYS:
+                legacy.append(name)
+        renames = []
+        for start in range(0, len(numbers), batch_size):
+            renames.extend((name, Product._key(name)) for name in
+                           Product.__records(numbers[start:start + batch_size]))
+        moved = Product.__rename(renames, batch_size)
+        product_ids = set(int(old) for old, _ in moved)
+        if product_ids:
+            moved += Product.__rename(
+                [(name, Product.prefix + name) for name in legacy
+                 if Product.__owns_legacy_key(name, product_ids)],
+                batch_size)
+            Product.rebuild_indexes()
+        Product.redis.incr(Product.version_key)
+        Product._invalidate(Product.redis, '*')
+        Product.logger.info('Moved %d keys under %s', len(moved),
+                            Product.prefix)
+        return len(moved)
+
+    @staticmethod
+    def __rename(renames, batch_size):
+        """
+        Renames keys unless their new name is taken, registering them
+        Returns:
+            list: the (old, new) names of the keys that were renamed
+        """
+        moved = []
+        renames = [(old, new) for old, new in renames if old != new]
+        for start in range(0, len(renames), batch_size):
+            batch = renames[start:start + batch_size]
+            pipe = Product.redis.pipeline(transaction=False)
+            for old, new in batch:
+                pipe.renamenx(old, new)
+            done = [pair for pair, ok in zip(batch, pipe.execute()) if ok]
+            if done:
+                Product.redis.sadd(Product.registry_key,
+                                   *[new for _, new in done])
+            moved.extend(done)
+        return moved
+
+    @staticmethod
+    def __owns_legacy_key(name, product_ids):
+        """
+        Tells if a legacy key holds this service's data
+        The counters must hold an integer, the id counter one no lower
+        than any moved id, and the inventory and versions hashes must
+        only have fields that are ids of moved Products.
+        """
+        kind = _text(Product.redis.type(name))
+        if name in ('index', 'catalog:version'):
+            value = _text(Product.redis.get(name)) if kind == 'string' else ''
+            return value.isdigit() and (
+                name != 'index' or int(value) >= max(product_ids))
+        if kind != 'hash':
+            return False
+        if name == 'import:checkpoints':
+            return all(_text(value).isdigit()
+                       for value in Product.redis.hvals(name))
+        return all(_text(field).isdigit() and int(field) in product_ids
+                   for field in Product.redis.hkeys(name))
+
+    @staticmethod
+    def __records(names):
+        """ Returns the keys of names that hold a Product with that id """
+        pipe = Product.redis.pipeline(transaction=False)
+        for name in names:
+            pipe.type(name)
+        kinds = [_text(kind) for kind in pipe.execute()]
+        for name, kind in zip(names, kinds):
+            if kind == 'hash':
+                pipe.hmget(name, Product.fields)
+            else:
+                pipe.get(name)
+        records = []
+        for name, kind, value in zip(names, kinds,
+                                     pipe.execute(raise_on_error=False)):
+            try:
+                if kind == 'hash':
+                    data = Product._decode_fields(Product.fields, value)
+                else:
+                    data = serializers.decode(value)
+            except Exception:  # pylint: disable=broad-except
+                continue  # not written by a Product
+            # the count may be kept in the inventory instead of the record
+            if isinstance(data, dict) and data.get('id') == int(name) and \
+                    all(field in data for field in Product.fields
+                        if field != 'count'):
+                records.append(name)
+        return records
 
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
 
     @staticmethod
+    @metrics.timed
     def find(product_id):
         """ Finds a Product by it's ID """
         # if not Product.data:
@@ -188,37 +1543,58 @@ class Product(object):
         # if product:
         #    return product[0]
         # return None
-        if Product.redis.exists(product_id):
-            data = pickle.loads(Product.redis.get(product_id))
-            product = Product(data['id']).deserialize(data)
-            return product
+        cache = Product.cache
+        data = cache.get(int(product_id)) if cache else None
+        if data is None:
+            generation = cache.generation if cache else None
+            data = Product.__load(product_id)
+            if data and cache:
+                cache.set(data['id'], data, generation)
+        if data:
+            return Product.from_dict(data)
         return None
 
     @staticmethod
+    @metrics.timed
+    def find_many(product_ids, fields=None):
+        """
+        Finds many Products by their ids in one round trip
+        Products in the cache are served from it and the rest are read
+        with a single bulk fetch.
+        Args:
+            product_ids (list): the ids of the Products you want
+            fields (list): return dictionaries of only these fields instead
+        Returns:
+            tuple: the Products found, in the order their ids were given
+                   without repeats, and the list of the ids not found
+        """
+        product_ids = list(OrderedDict.fromkeys(int(i) for i in product_ids))
+        cache = Product.cache
+        found = {}
+        if cache:
+            for product_id in product_ids:
+                data = cache.get(product_id)
+                if data is not None:
+                    found[product_id] = data
+        missed = [i for i in product_ids if i not in found]
+        generation = cache.generation if cache else None
+        for data in Product.__fetch_data(missed, Product.__with_id(fields)):
+            found[data['id']] = data
+            if cache and not fields:
+                cache.set(data['id'], data, generation)
+        products = Product.__build([found[i] for i in product_ids
+                                    if i in found], fields)
+        return products, [i for i in product_ids if i not in found]
+
+    @staticmethod
+    @metrics.timed
     def __find_by(attribute, value):
         """ Generic Query that finds a key with a specific value """
         Product.logger.info('Processing %s query for %s', attribute, value)
-        # if isinstance(value, str):
-        search_criteria = value.lower()  # make case insensitive
-        # else:
-        #print ("INFB")
-        #print (value)
-        #search_criteria = value
-        results = []
-        for key in Product.redis.keys():
-            if key != 'index':  # filer out our id index
-                # print("Key:" + key)
-                data = pickle.loads(Product.redis.get(key))
-                # print(data[attribute])
-                # perform case insensitive search on strings
-                # if isinstance(data[attribute], str):
-                test_value = data[attribute].lower()
-                # else:
-                #test_value = data[attribute]
-                # print(search_criteria, test_value)
-                if test_value == search_criteria:
-                    results.append(Product(data['id']).deserialize(data))
-        return results
+        # the index sets are normalized so the search is case insensitive
+        product_ids = Product.redis.smembers(
+            Product._index_key(attribute, value))
+        return Product.__fetch(product_ids)
 
     @staticmethod
     def find_by_category(category):
@@ -239,15 +1615,102 @@ class Product(object):
         # return [p for p in Product.data if p.name == name]
         return Product.__find_by('name', name)
 
+######################################################################
+#  C A C H E   M E T H O D S
+######################################################################
+
+    @staticmethod
+    def enable_cache(maxsize=1024, ttl=None):
+        """
+        Keeps the Products returned by find() in process memory
+        Entries are dropped when this process changes a Product and when
+        a message on cache_channel says another process changed one. The
+        ttl bounds how long a missed message can leave a Product stale,
+        and the cache is disabled if the listener loses its connection.
+        Args:
+            maxsize (int): the number of Products to keep
+            ttl (float): seconds a Product is kept, cache_ttl if None,
+                         until it is invalidated if 0
+        """
+        Product.disable_cache()
+        cache = Product.cache = LRUCache(
+            maxsize, Product.cache_ttl if ttl is None else ttl)
+        pubsub = Product.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{Product.cache_channel: Product.__on_invalidate})
+        stopped = Product.__cache_listener = threading.Event()
+        listener = threading.Thread(target=Product.__listen,
+                                    args=(pubsub, cache, stopped))
+        listener.daemon = True
+        listener.start()
+        Product.logger.info('Caching up to %d products', maxsize)
+
+    @staticmethod
+    def disable_cache():
+        """ Stops caching Products and listening for invalidations """
+        if Product.__cache_listener:
+            Product.__cache_listener.set()
+            Product.__cache_listener = None
+        Product.cache = None
+
+    @staticmethod
+    def __listen(pubsub, cache, stopped):
+        """
+        Handles the messages on cache_channel until stopped is set
+        Messages sent while the connection is down are lost, so when it
+        fails the cache it serves is cleared and disabled.
+        """
+        try:
+            while not stopped.is_set():
+                pubsub.get_message(timeout=1)
+        except Exception:  # pylint: disable=broad-except
+            Product.logger.exception('Lost cache invalidations, disabling '
+                                     'the cache')
+            cache.clear()
+            if Product.cache is cache:
+                Product.disable_cache()
+        finally:
+            pubsub.close()
+
+    @staticmethod
+    def cache_stats():
+        """ Returns the hit and miss counters of the cache or None """
+        return Product.cache.stats() if Product.cache else None
+
+    @staticmethod
+    def _invalidate(client, product_id):
+        """
+        Drops a Product, or '*' for all, from every process's cache
+        The message is published even when this process keeps no cache
+        of its own, other processes may still keep one.
+        """
+        Product.__on_invalidate({'data': product_id})
+        client.publish(Product.cache_channel, product_id)
+
+    @staticmethod
+    def __on_invalidate(message):
+        """ Handles an invalidation message from cache_channel """
+        cache = Product.cache
+        if cache:
+            product_id = _text(message['data'])
+            if product_id == '*':
+                cache.clear()
+            else:
+                cache.delete(int(product_id))
+
 ######################################################################
 #  R E D I S   D A T A B A S E   C O N N E C T I O N   M E T H O D S
 ######################################################################
 
     @staticmethod
-    def connect_to_redis(hostname, port, password):
-        """ Connects to Redis and tests the connection """
+    def connect_to_redis(hostname, port, password, **options):
+        """
+        Connects to Redis and tests the connection
+        The pool size, timeouts and retries can be passed as options, see
+        connection.OPTIONS for their names and defaults.
+        """
         Product.logger.info("Testing Connection to: %s:%s", hostname, port)
-        Product.redis = Redis(host=hostname, port=port, password=password)
+        Product.redis = connection.create_client(hostname, port, password,
+                                                 **options)
         try:
             Product.redis.ping()
             Product.logger.info("Connection established")
@@ -257,7 +1720,7 @@ class Product(object):
         return Product.redis
 
     @staticmethod
-    def init_db(redis=None):
+    def init_db(redis=None, prefix=None, **options):
         """
         Initialized Redis database connection
         This method will work in the following conditions:
@@ -265,10 +1728,15 @@ class Product(object):
           2) With Redis running on the local server as with Travis CI
           3) With Redis --link in a Docker container called 'redis'
           4) Passing in your own Redis connection object
+        Connection pool options are read from the environment, then from
+        the VCAP_SERVICES credentials and then from the options passed in.
+        A prefix replaces PRODUCT_KEY_PREFIX for every key of the model.
         Exception:
         ----------
           redis.ConnectionError - if ping() test fails
         """
+        if prefix is not None:
+            Product.use_prefix(prefix)
         if redis:
             Product.logger.info("Using client connection...")
             Product.redis = redis
@@ -279,6 +1747,8 @@ class Product(object):
                 Product.logger.error("Client Connection Error!")
                 Product.redis = None
                 raise ConnectionError('Could not connect to the Redis Service')
+            Product.__register_fixed_keys()
+            Product.__init_cache()
             return
         # Get the credentials from the Bluemix environment
         if 'VCAP_SERVICES' in os.environ:
@@ -288,18 +1758,39 @@ class Product(object):
             creds = services['rediscloud'][0]['credentials']
             Product.logger.info("Conecting to Redis on host %s port %s",
                                 creds['hostname'], creds['port'])
+            pool_options = dict((name, value) for name, value in creds.items()
+                                if name in connection.OPTIONS)
+            pool_options.update(options)
             Product.connect_to_redis(creds['hostname'], creds[
-                                     'port'], creds['password'])
+                                     'port'], creds['password'],
+                                     **pool_options)
         else:
             Product.logger.info(
                 "VCAP_SERVICES not found, checking localhost for Redis")
-            Product.connect_to_redis('127.0.0.1', 6379, None)
+            Product.connect_to_redis('127.0.0.1', 6379, None, **options)
             if not Product.redis:
                 Product.logger.info(
                     "No Redis on localhost, looking for redis host")
-                Product.connect_to_redis('redis', 6379, None)
+                Product.connect_to_redis('redis', 6379, None, **options)
         if not Product.redis:
             # if you end up here, redis instance is down.
             Product.logger.fatal(
                 '*** FATAL ERROR: Could not connect to the Redis Service')
             raise ConnectionError('Could not connect to the Redis Service')
+        Product.__register_fixed_keys()
+        Product.__init_cache()
+
+    @staticmethod
+    def pool_stats():
+        """ Returns the usage of the Redis connection pool """
+        return connection.pool_stats(Product.redis)
+
+    @staticmethod
+    def __init_cache():
+        """ Enables the cache when PRODUCT_CACHE_SIZE is set """
+        if os.getenv('PRODUCT_CACHE_SIZE'):
+            ttl = os.getenv('PRODUCT_CACHE_TTL')
+            Product.enable_cache(int(os.getenv('PRODUCT_CACHE_SIZE')),
+                                 float(ttl) if ttl else None)
+        else:
+            Product.disable_cache()
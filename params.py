@@ -0,0 +1,94 @@
+"""
+Query Parameters of the Product Store Service
+Reads the paging, field, id and flag parameters the same way for the
+Flask routes of server.py and the ASGI routes of asgi.py. Each function
+takes the query parameters as a mapping, whatever the framework, and
+raises DataValidationError when they are wrong, which both servers answer
+with 400 Bad Request.
+"""
+import math
+import base64
+from models import Product, DataValidationError
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+MAX_IDS = 100
+
+
+def get_page_args(args):
+    """
+    Reads the limit and cursor query parameters
+    Returns:
+        tuple: the page size, or None when paging was not asked for,
+               and the position the page starts after
+    """
+    limit = args.get('limit')
+    cursor = args.get('cursor')
+    if limit is None and cursor is None:
+        return None, 0
+    try:
+        limit = int(limit) if limit is not None else DEFAULT_PAGE_SIZE
+        after = decode_cursor(cursor) if cursor else 0
+    except (TypeError, ValueError):
+        raise DataValidationError('Invalid limit or cursor')
+    if limit < 1:
+        raise DataValidationError('limit must be greater than 0')
+    return min(limit, MAX_PAGE_SIZE), after
+
+
+def get_number_arg(args, name):
+    """ Reads a numeric query parameter, None when it is absent """
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        number = None
+    # float() also takes nan and inf, which no price range can use
+    if number is None or math.isnan(number) or math.isinf(number):
+        raise DataValidationError('{} must be a number'.format(name))
+    return number
+
+
+def get_fields_arg(args):
+    """ Reads the fields query parameter, None when it is absent """
+    value = args.get('fields')
+    if value is None:
+        return None
+    wanted = [field.strip() for field in value.split(',') if field.strip()]
+    unknown = [field for field in wanted if field not in Product.fields]
+    if not wanted or unknown:
+        raise DataValidationError(
+            'fields must be some of ' + ','.join(Product.fields))
+    return wanted
+
+
+def get_ids_arg(value):
+    """ Reads a comma separated list of at most MAX_IDS Product ids """
+    try:
+        ids = [int(i) for i in value.split(',') if i.strip()]
+    except ValueError:
+        raise DataValidationError('ids must be integers')
+    if not ids or len(ids) > MAX_IDS:
+        raise DataValidationError(
+            'ids must list 1 to {} Products'.format(MAX_IDS))
+    return ids
+
+
+def get_flag_arg(args, name):
+    """ Reads a true or false query parameter, False when it is absent """
+    value = args.get(name, 'false').lower()
+    if value not in ('true', 'false', '1', '0'):
+        raise DataValidationError('{} must be true or false'.format(name))
+    return value in ('true', '1')
+
+
+def encode_cursor(after):
+    """ Encodes the position of a page into an opaque cursor """
+    return base64.urlsafe_b64encode(str(after).encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decodes an opaque cursor back into the position of a page """
+    return int(base64.urlsafe_b64decode(str(cursor)).decode('ascii'))
@@ -0,0 +1,105 @@
+"""
+Serialization codecs for Product records
+Every record is stored with a two byte header, a zero byte followed by
+the tag of the codec that wrote it, so data written with different codecs
+can be read side by side. Records without a header were written before
+codecs existed and are read as pickles.
+
+Codecs:
+-------
+pickle - Python pickle, the original format
+json - compact UTF-8 JSON
+msgpack - MessagePack binary, needs the msgpack package
+"""
+import json
+import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+HEADER = b'\x00'
+
+
+class Codec(object):
+    """ Encodes Product dictionaries into bytes and back """
+    name = None
+    tag = None
+
+    def encode(self, data):
+        """ Encodes a dictionary into bytes """
+        raise NotImplementedError
+
+    def decode(self, payload):
+        """ Decodes bytes back into a dictionary """
+        raise NotImplementedError
+
+
+class PickleCodec(Codec):
+    """ Python pickle, only safe for data this service wrote itself """
+    name = 'pickle'
+    tag = b'p'
+
+    def encode(self, data):
+        return pickle.dumps(data, 2)
+
+    def decode(self, payload):
+        return pickle.loads(payload)
+
+
+class JsonCodec(Codec):
+    """ Compact UTF-8 JSON """
+    name = 'json'
+    tag = b'j'
+
+    def encode(self, data):
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+class MsgpackCodec(Codec):
+    """ MessagePack, a compact binary JSON """
+    name = 'msgpack'
+    tag = b'm'
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = dict((codec.name, codec)
+              for codec in (PickleCodec(), JsonCodec(), MsgpackCodec()))
+TAGS = dict((codec.tag, codec) for codec in CODECS.values())
+
+
+def get_codec(name):
+    """
+    Returns the codec with the given name
+    Raises:
+        ValueError: if the codec is unknown or its package is missing
+    """
+    if name not in CODECS:
+        raise ValueError('Unknown codec: {}'.format(name))
+    if name == 'msgpack' and msgpack is None:
+        raise ValueError('The msgpack codec needs the msgpack package')
+    return CODECS[name]
+
+
+def encode(data, codec):
+    """ Encodes a dictionary with a codec and tags it with a header """
+    return HEADER + codec.tag + codec.encode(data)
+
+
+def decode(record):
+    """ Decodes a record written by any codec """
+    if record[:1] != HEADER:
+        return pickle.loads(record)  # written before codecs existed
+    codec = TAGS.get(record[1:2])
+    if codec is None:
+        raise ValueError('Unknown codec tag: {!r}'.format(record[1:2]))
+    return codec.decode(record[2:])
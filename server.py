@@ -3,20 +3,51 @@ Product Store Service with Swagger
 Paths:
 ------
 GET / - Displays a UI for Selenium testing
+GET /metrics - Returns request and Redis metrics in the Prometheus format
 GET /products - Returns a list all of the Products
+GET /products?limit={n}&cursor={cursor} - Returns one page of Products
+GET /products?min_price={p}&max_price={p}&sort={field} - Returns Products
+    in a price range sorted by price, -price, count, -count, name or -name
+GET /products?ids={id},{id} - Returns the Products with the given ids and
+    the ids that were not found
+GET /products?q={words} - Returns the Products whose name or description
+    has every word, most relevant first
+GET /products?category={c}&color={c}&name={n}&available=true - Returns the
+    Products that match every filter, also with a price range, sort or q
+GET /products/export?format={ndjson|csv} - Streams every Product
+GET /products/suggest?prefix={prefix}&limit={n} - Returns the names that
+    start with a prefix, for autocomplete
 GET /products/{id} - Returns the Product with a given id number
+GET /products?fields={field},{field} and /products/{id}?fields=... - Only
+    return some fields of each Product
 POST /products - creates a new Product record in the database
+POST /products/bulk - creates many Products from a JSON array or NDJSON
 PUT /products/{id} - updates a Product record in the database
 DELETE /products/{id} - deletes a Product record in the database
+PUT /products/{id}/add_unit - adds one unit to the count of a Product
+PUT /products/{id}/sell_products - sells one unit of a Product
+PUT /products/{id}/inventory - adds a delta to the count of a Product
 """
 import os
+import io
 import sys
-from flask import request, json, url_for, make_response, abort
+import csv
+import time
+import numbers
+from functools import wraps
+from collections import OrderedDict
+from flask import request, json, url_for, make_response, abort, g
 from flask import Flask, Response, jsonify
 from flask_api import status
-from flask_restplus import Api, Resource, fields
+from flask_restplus import Api, Resource, fields, marshal
+from flask_restplus.utils import unpack
 from models import Product, DataValidationError, DatabaseConnectionError
+from models import NotFoundError, OutOfStockError, PreconditionFailedError
+from cache import LRUCache
+import metrics
+import params
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 
 
 # Pull options from environment
@@ -30,9 +61,26 @@ app = Flask(__name__)
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
+HTTP_412_PRECONDITION_FAILED = 412
+
+# Suggestion limits, the page limits are in params.py
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 100
+
+# Whole list responses cached by query and catalog version, 0 disables it
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '256'))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES',
+                                         str(1024 * 1024)))
+# bound on the bytes of all the cached responses together
+RESPONSE_CACHE_TOTAL_BYTES = int(os.getenv('RESPONSE_CACHE_TOTAL_BYTES',
+                                           str(16 * 1024 * 1024)))
+response_cache = LRUCache(RESPONSE_CACHE_SIZE,
+                          maxbytes=RESPONSE_CACHE_TOTAL_BYTES) \
+    if RESPONSE_CACHE_SIZE else None
 
 
 ######################################################################
@@ -74,16 +122,108 @@ product_model = api.model('Product', {
 @api.errorhandler(DataValidationError)
 def request_validation_error(error):
     """ Handles all data validation issues from the model """
-    message = error.message or str(error)
+    message = str(error)
     return {'status': 400, 'error': 'Bad Request', 'message': message}, 400
 
 
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
-    message = error.message or str(error)
+    message = str(error)
     app.logger.critical(message)
     return {'status': 500, 'error': 'Server Error', 'message': message}, 500
+
+######################################################################
+# Response Cache
+######################################################################
+
+
+def cache_response(function):
+    """
+    Serves a list endpoint from the response cache
+    Responses are cached by path, query string and catalog version. Every
+    change to the catalog bumps the version, so a cached body is only
+    served until the next write and then ages out of the LRU cache.
+    """
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if response_cache is None:
+            return function(*args, **kwargs)
+        key = (request.host_url, request.path,
+               tuple(sorted(request.args.items(multi=True))),
+               catalog_version())
+        cached = response_cache.get(key)
+        if cached is not None:
+            body, headers = cached
+            return Response(body, status=HTTP_200_OK,
+                            mimetype='application/json', headers=headers)
+        response = function(*args, **kwargs)
+        if response.status_code == HTTP_200_OK and response.is_streamed:
+            response.response = cache_stream(key, response.response,
+                                             response.headers)
+        return response
+    return wrapper
+
+
+def catalog_version():
+    """ Reads the catalog version once per request """
+    if 'catalog_version' not in g:
+        g.catalog_version = Product.catalog_version()
+    return g.catalog_version
+
+
+def catalog_etag(**kwargs):
+    """ Returns the unquoted ETag of any list of Products """
+    return str(catalog_version())
+
+
+def product_etag(products_id, **kwargs):
+    """ Returns the unquoted ETag of a Product, None if it has no version """
+    version = Product.get_version(products_id)
+    return str(version) if version is not None else None
+
+
+def conditional(etag_of):
+    """
+    Adds an ETag to the responses of a GET endpoint
+    When If-None-Match already holds the current ETag the endpoint is not
+    called at all and 304 Not Modified is returned, so the decision only
+    costs a version lookup in Redis.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            etag = etag_of(**kwargs)
+            if etag is not None and etag in request.if_none_match:
+                response = Response(status=HTTP_304_NOT_MODIFIED)
+                response.set_etag(etag)
+                return response
+            response = function(*args, **kwargs)
+            if etag is None:
+                return response
+            if isinstance(response, Response):
+                response.set_etag(etag)
+                return response
+            data, code, headers = unpack(response)
+            headers = dict(headers or {}, ETag=quote_etag(etag))
+            return data, code, headers
+        return wrapper
+    return decorator
+
+
+def cache_stream(key, body, headers):
+    """ Passes a streamed body through, caching it once it is complete """
+    headers = dict((name, value) for name, value in headers if name == 'Link')
+    chunks, size = [], 0
+    for chunk in body:
+        if chunks is not None:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > RESPONSE_CACHE_MAX_BYTES:
+                chunks = None  # too big to keep, just stream it
+        yield chunk
+    if chunks is not None:
+        response_cache.set(key, (''.join(chunks), headers), size=size)
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
@@ -92,8 +232,81 @@ def database_connection_error(error):
 @app.route('/healthcheck')
 def healthcheck():
     """ Let them know our heart is still beating """
-    return make_response(jsonify(status=200,
-                                 message='Healthy'), status.HTTP_200_OK)
+    return make_response(jsonify(status=200, message='Healthy',
+                                 cache=Product.cache_stats(),
+                                 response_cache=response_cache.stats()
+                                 if response_cache else None,
+                                 redis_pool=Product.pool_stats()),
+                         status.HTTP_200_OK)
+
+######################################################################
+# GET METRICS
+######################################################################
+
+
+@app.route('/metrics')
+def get_metrics():
+    """ Returns the metrics of this process in the Prometheus text format """
+    return Response(metrics.render(), status=HTTP_200_OK,
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_timer():
+    """ Notes when the request started """
+    g.started = time.time()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records the request metrics
+    Streamed bodies are measured once they have been sent, so the
+    latency and size include the Products read while streaming.
+    """
+    started = g.get('started', time.time())
+    labels = request_labels(response.status_code)
+    if response.is_streamed:
+        response.response = measure_stream(response.response, started,
+                                           labels)
+    else:
+        metrics.observe_request(*labels, seconds=time.time() - started,
+                                size=response.calculate_content_length())
+    g.recorded = True
+    return response
+
+
+@app.teardown_request
+def record_failed_request(error=None):
+    """
+    Records a request that ended with an unhandled exception
+    Flask skips the after_request functions then, so the 500 it answers
+    with would not be counted at all.
+    """
+    if g.get('recorded'):
+        return
+    labels = request_labels(status.HTTP_500_INTERNAL_SERVER_ERROR)
+    metrics.observe_request(*labels, size=None, seconds=time.time() -
+                            g.get('started', time.time()))
+
+
+def request_labels(status_code):
+    """ Returns the method, route and status labels of the request """
+    return (request.method,
+            request.url_rule.rule if request.url_rule else 'unmatched',
+            status_code)
+
+
+def measure_stream(body, started, labels):
+    """ Passes a streamed body through, recording it once it is sent """
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        metrics.observe_request(*labels, seconds=time.time() - started,
+                                size=size)
 
 ######################################################################
 # GET INDEX
@@ -128,8 +341,11 @@ class ProductResource(Resource):
     # RETRIEVE A PRODUCT
     #------------------------------------------------------------------
     @ns.doc('get_products`')
+    @ns.param('fields', 'Comma separated fields to return, all if absent')
+    @ns.response(200, 'Success', product_model)
     @ns.response(404, 'Product not found')
-    @ns.marshal_with(product_model)
+    @ns.response(304, 'Product not modified since the If-None-Match ETag')
+    @conditional(product_etag)
     #@app.route('/products/<int:id>', methods=['GET'])
     def get(self, products_id):
         """
@@ -138,11 +354,18 @@ class ProductResource(Resource):
         """
         app.logger.info(
             "Request to Retrieve a product with id [%s]", products_id)
+        wanted = get_fields_arg()
+        if wanted:
+            data = Product.get_fields(products_id, wanted)
+            if data is None:
+                raise NotFound(
+                    "Product with id '{}' was not found.".format(products_id))
+            return marshal(data, model_of(wanted)), status.HTTP_200_OK
         product = Product.find(products_id)
         if product:
             message = product.serialize()
             return_code = HTTP_200_OK
-            return product.serialize(), status.HTTP_200_OK
+            return marshal(message, product_model), status.HTTP_200_OK
             if product.count == 0:
                 raise NotFound("Product is Understocked.")
 
@@ -156,6 +379,7 @@ class ProductResource(Resource):
     @ns.doc('update_products')
     @ns.response(404, 'Product not found')
     @ns.response(400, 'The posted Product data was not valid')
+    @ns.response(412, 'Product changed since the If-Match ETag')
     @ns.expect(product_model)
     @ns.marshal_with(product_model)
     def put(self, products_id):
@@ -171,13 +395,22 @@ class ProductResource(Resource):
             #api.abort(404, "Pet with id '{}' was not found.".format(pet_id))
             raise NotFound(
                 'Product with id [{}] was not found.'.format(products_id))
+        versions = None
+        if request.if_match and not request.if_match.star_tag:
+            versions = request.if_match.as_set()
         #data = request.get_json()
         data = api.payload
         app.logger.info(data)
         product.deserialize(data)
         product.id = products_id
-        product.save()
-        return product.serialize(), status.HTTP_200_OK
+        try:
+            # the version is checked in the same transaction as the write
+            product.save(versions)
+        except PreconditionFailedError:
+            abort(HTTP_412_PRECONDITION_FAILED,
+                  'Product with id [{}] has changed.'.format(products_id))
+        return product.serialize(), status.HTTP_200_OK, \
+            {'ETag': quote_etag(product_etag(products_id))}
 
     #------------------------------------------------------------------
     # DELETE A PRODUCT
@@ -207,34 +440,69 @@ class ProductCollection(Resource):
     # LIST ALL PRODUCTS
     #------------------------------------------------------------------
     @ns.doc('list_products')
+    @ns.param('ids', 'Comma separated ids of the Products to return')
+    @ns.param('fields', 'Comma separated fields to return, all if absent')
+    @ns.param('q', 'Words to search for in the name and description')
     @ns.param('category', 'List Product by category')
-    @ns.marshal_list_with(product_model)
+    @ns.param('name', 'List Product by name')
+    @ns.param('color', 'List Product by color')
+    @ns.param('available', 'true to only list Products that are in stock')
+    @ns.param('limit', 'The maximum number of Products to return')
+    @ns.param('cursor', 'The cursor from the next link of a previous page')
+    @ns.param('min_price', 'The lowest price of the Products to return')
+    @ns.param('max_price', 'The highest price of the Products to return')
+    @ns.param('sort', 'price, count or name, prefixed with - to reverse')
+    @ns.response(200, 'Success', [product_model])
+    @ns.response(304, 'No Product changed since the If-None-Match ETag')
+    @conditional(catalog_etag)
+    @cache_response
     def get(self):
         """ Returns all of the Products """
         app.logger.info('Request to list Products...')
-        results = []
-        category = request.args.get('category')
-        #print (category)
-        name = request.args.get('name')
-        if category:
-            # print("Category is " + category)
-            results = Product.find_by_category(str(category).lower())
-        elif name:
-            results = Product.find_by_name(str(name).lower())
+        ids = request.args.get('ids')
+        words = request.args.get('q')
+        filters = dict((attribute, request.args[attribute])
+                       for attribute in Product.indexed_attributes
+                       if request.args.get(attribute))
+        available = get_flag_arg('available')
+        sort = request.args.get('sort')
+        min_price = get_number_arg('min_price')
+        max_price = get_number_arg('max_price')
+        limit, after = get_page_args()
+        wanted = get_fields_arg()
+        ordered = sort or min_price is not None or max_price is not None
+        if ids is not None and (words or filters or available or ordered or
+                                limit):
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'ids cannot be combined with other query parameters')
+        if words and ordered:
+            abort(status.HTTP_400_BAD_REQUEST,
+                  'q results are ordered by relevance, sort, min_price and '
+                  'max_price cannot be combined with q')
+        if ids is not None:
+            products, missing = Product.find_many(get_ids_arg(ids), wanted)
+            return make_response(jsonify(
+                products=[marshal(data, model_of(wanted))
+                          for data in serialized(products, wanted)],
+                missing=missing), HTTP_200_OK)
+        elif words:
+            results, after = Product.search(
+                words, limit or params.DEFAULT_PAGE_SIZE, after, wanted,
+                filters, available)
+        elif filters or available:
+            results, after = Product.filter(filters, available, limit, after,
+                                            wanted, sort, min_price,
+                                            max_price)
+        elif ordered:
+            results, after = Product.query(sort, min_price, max_price,
+                                           limit, after, wanted)
+        elif limit:
+            results, after = Product.page(limit, after, fields=wanted)
+        elif wanted:
+            results, after = Product.iterate(fields=wanted), None
         else:
-            results = Product.all()
-
-            # for pro in results:
-            #     print(pro.id)
-        # app.logger.info('[%s] Products returned', len(results))
-        # return make_response(jsonify([p.serialize() for p in results]),
-        #                     HTTP_200_OK)
-        resultsUpd = [prod.serialize() for prod in results]
-
-        # for prod in resultsUpd:
-        #     print(prod['id'])
-
-        return resultsUpd, status.HTTP_200_OK
+            return stream_json(Product.iterate_json())
+        return stream_products(results, after, wanted)
 
 #------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -262,31 +530,133 @@ class ProductCollection(Resource):
         return prod.serialize(), status.HTTP_201_CREATED, \
             {'Location': location_url}
 
+######################################################################
+#  PATH: /products/bulk
+######################################################################
+@ns.route('/bulk')
+class ProductBulk(Resource):
+    """ Handles the creation of many Products at once """
+    #------------------------------------------------------------------
+    # ADD MANY NEW PRODUCTS
+    #------------------------------------------------------------------
+    @ns.doc('create_products_bulk')
+    @ns.expect([product_model])
+    @ns.response(200, 'The status of every posted Product')
+    @ns.response(400, 'The posted data was not a list of Products')
+    def post(self):
+        """
+        Creates many Products
+        The body is either a JSON array or NDJSON (one Product per line with
+        Content-Type application/x-ndjson). Every Product is validated on
+        its own and the response reports a status for each one in order.
+        """
+        app.logger.info('Request to Create Products in bulk')
+        content_type = request.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-ndjson'):
+            items = parse_ndjson(request.get_data())
+        elif content_type.startswith('application/json'):
+            items = request.get_json(silent=True)
+            if not isinstance(items, list):
+                abort(status.HTTP_400_BAD_REQUEST,
+                      'Body must be a JSON array of Products')
+        else:
+            abort(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                  'Content-Type must be application/json '
+                  'or application/x-ndjson')
+        results = []
+        for index, (product, errors) in enumerate(Product.create_many(items)):
+            if product:
+                results.append({'index': index, 'status': HTTP_201_CREATED,
+                                'id': product.id})
+            else:
+                results.append({'index': index, 'status': HTTP_400_BAD_REQUEST,
+                                'errors': errors})
+        app.logger.info('Bulk request for %d Products processed', len(items))
+        return results, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /products/suggest
+######################################################################
+@ns.route('/suggest')
+class ProductSuggest(Resource):
+    """ Completes Product names as they are typed """
+    #------------------------------------------------------------------
+    # SUGGEST PRODUCT NAMES
+    #------------------------------------------------------------------
+    @ns.doc('suggest_products')
+    @ns.param('prefix', 'The start of the name')
+    @ns.param('limit', 'The maximum number of names to return')
+    @ns.response(200, 'The matching names in order')
+    @ns.response(304, 'No Product changed since the If-None-Match ETag')
+    @conditional(catalog_etag)
+    def get(self):
+        """ Returns the Product names that start with a prefix """
+        prefix = request.args.get('prefix', '')
+        try:
+            limit = int(request.args.get('limit', DEFAULT_SUGGESTIONS))
+        except ValueError:
+            abort(status.HTTP_400_BAD_REQUEST, 'limit must be an integer')
+        if limit < 1:
+            abort(status.HTTP_400_BAD_REQUEST, 'limit must be greater than 0')
+        return Product.suggest(prefix, min(limit, MAX_SUGGESTIONS)), \
+            HTTP_200_OK
+
+
 ######################################################################
 # LIST AVAILABLE Products
 ######################################################################
 
 
 @app.route('/products/available', methods=['GET'])
+@conditional(catalog_etag)
+@cache_response
 def list_available_products():
     """ Retrieves a list of available products from the database """
-    results = []
-    results = Product.available()
-    return make_response(jsonify([p.serialize() for p in results]),
-                         HTTP_200_OK)
+    limit, after = get_page_args()
+    if limit:
+        results, after = Product.page(limit, after, available=True)
+        return stream_products(results, after)
+    return stream_products(Product.iterate_available())
+
+
+######################################################################
+# EXPORT ALL Products
+######################################################################
+
+
+@app.route('/products/export', methods=['GET'])
+def export_products():
+    """
+    Streams every Product as NDJSON or CSV
+    Products are written out as they are read from Redis in batches so a
+    full dump keeps a flat memory profile however large the catalog is.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format == 'ndjson':
+        rows = (json.dumps(product.serialize()) + '\n'
+                for product in Product.iterate())
+        mimetype = 'application/x-ndjson'
+    elif export_format == 'csv':
+        rows = csv_rows(product.serialize() for product in Product.iterate())
+        mimetype = 'text/csv'
+    else:
+        abort(status.HTTP_400_BAD_REQUEST, 'format must be ndjson or csv')
+    app.logger.info('Request to export Products as %s', export_format)
+    return Response(rows, status=HTTP_200_OK, mimetype=mimetype, headers={
+        'Content-Disposition':
+            'attachment; filename=products.{}'.format(export_format)})
 
 
 @app.route('/products/<int:id>/add_unit', methods=['PUT'])
 def add_product_unit(id):
-    """ Updates a Product in the database fom the posted database """
-    product = Product.find(id)
-    if product:
-        product.count = int(product.count) + 1
-        product.save()
+    """ Adds one unit to the count of a Product """
+    try:
+        product = Product.adjust_count(id, 1)
         message = product.serialize()
         return_code = HTTP_200_OK
-    else:
-        message = {'error': 'Product with id: %s was not found' % str(id)}
+    except NotFoundError as error:
+        message = {'error': str(error)}
         return_code = HTTP_404_NOT_FOUND
 
     return make_response(jsonify(message), return_code)
@@ -294,20 +664,42 @@ def add_product_unit(id):
 
 @app.route('/products/<int:id>/sell_products', methods=['PUT'])
 def sell_products(id):
-    """ Updates a Product in the database fom the posted database """
-    product = Product.find(id)
-    if product:
-        if product.count == 0:
-            message = {
-                'error': 'Product with id: %s is out of Stock' % str(id)}
-        else:
-            product.count = int(product.count) - 1
-            product.save()
-            message = product.serialize()
+    """ Sells one unit of a Product if it is in stock """
+    try:
+        product = Product.adjust_count(id, -1)
+        message = product.serialize()
+        return_code = HTTP_200_OK
+    except OutOfStockError as error:
+        message = {'error': str(error)}
+        return_code = HTTP_200_OK
+    except NotFoundError as error:
+        message = {'error': str(error)}
+        return_code = HTTP_404_NOT_FOUND
+
+    return make_response(jsonify(message), return_code)
+
 
+@app.route('/products/<int:id>/inventory', methods=['PUT'])
+def adjust_inventory(id):
+    """
+    Adds a delta to the count of a Product
+    The body must be a JSON object like {"delta": -3}. A change that would
+    take the count below zero is refused with 409 Conflict.
+    """
+    check_content_type('application/json')
+    payload = request.get_json(silent=True)
+    delta = payload.get('delta') if isinstance(payload, dict) else None
+    if isinstance(delta, bool) or not isinstance(delta, numbers.Integral):
+        abort(status.HTTP_400_BAD_REQUEST, 'delta must be an integer')
+    try:
+        product = Product.adjust_count(id, delta)
+        message = product.serialize()
         return_code = HTTP_200_OK
-    else:
-        message = {'error': 'Product with id: %s was not found' % str(id)}
+    except OutOfStockError as error:
+        message = {'error': str(error)}
+        return_code = HTTP_409_CONFLICT
+    except NotFoundError as error:
+        message = {'error': str(error)}
         return_code = HTTP_404_NOT_FOUND
 
     return make_response(jsonify(message), return_code)
@@ -334,6 +726,127 @@ def data_load(payload):
     Product(0, 'Hp', 'Microwave', '960', 'Brand New', 'Blue', 0).save()
 
 
+def stream_products(products, after=None, wanted=None):
+    """
+    Streams Products as a JSON array
+    Each Product is marshalled as it is read so large listings are never
+    held in memory as a whole. When after is given a Link header points
+    to the next page. With wanted the items are dictionaries of only
+    those fields.
+    """
+    model = model_of(wanted)
+    return stream_json((json.dumps(marshal(data, model))
+                        for data in serialized(products, wanted)), after)
+
+
+def stream_json(objects, after=None):
+    """
+    Streams JSON objects that are already encoded as a JSON array
+    The objects are spliced in as they are, so nothing is encoded twice.
+    When after is given a Link header points to the next page.
+    """
+    def generate():
+        separator = '['
+        for text in objects:
+            yield separator + text
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+    response = Response(generate(), status=HTTP_200_OK,
+                        mimetype='application/json')
+    if after is not None:
+        response.headers['Link'] = '<{}>; rel="next"'.format(
+            next_page_url(after))
+    return response
+
+
+def get_page_args():
+    """ Reads the limit and cursor query parameters, see params.py """
+    return parse_args(params.get_page_args, request.args)
+
+
+def get_number_arg(name):
+    """ Reads a numeric query parameter, None when it is absent """
+    return parse_args(params.get_number_arg, request.args, name)
+
+
+def get_fields_arg():
+    """ Reads the fields query parameter, None when it is absent """
+    return parse_args(params.get_fields_arg, request.args)
+
+
+def model_of(wanted):
+    """ Returns the marshalling model of the wanted fields of a Product """
+    if not wanted:
+        return product_model
+    return OrderedDict((field, product_model[field]) for field in wanted)
+
+
+def serialized(products, wanted):
+    """ Yields the dictionaries of Products, already projected or not """
+    for product in products:
+        yield product if wanted else product.serialize()
+
+
+def get_ids_arg(value):
+    """ Reads a comma separated list of Product ids, see params.py """
+    return parse_args(params.get_ids_arg, value)
+
+
+def get_flag_arg(name):
+    """ Reads a true or false query parameter, False when it is absent """
+    return parse_args(params.get_flag_arg, request.args, name)
+
+
+def parse_args(parse, *args):
+    """
+    Runs one of the readers of params.py
+    What it rejects is answered with 400 Bad Request here, because the
+    routes that are not Resources never reach request_validation_error.
+    """
+    try:
+        return parse(*args)
+    except DataValidationError as error:
+        abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+
+def next_page_url(after):
+    """ Returns the url of the page that starts after the given position """
+    args = request.args.to_dict()
+    args.update(request.view_args or {})
+    args['cursor'] = params.encode_cursor(after)
+    return url_for(request.endpoint, _external=True, **args)
+
+
+def csv_rows(rows):
+    """ Formats dictionaries as CSV lines, starting with a header line """
+    buffer = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+    writer = csv.DictWriter(buffer, fieldnames=Product.fields,
+                            lineterminator='\n')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parse_ndjson(data):
+    """
+    Parses an NDJSON body into a list of items
+    Blank lines are skipped and a line that isn't valid JSON becomes None
+    so that it is reported as invalid in its position.
+    """
+    items = []
+    for line in data.decode('utf-8').splitlines():
+        if line.strip():
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)
+    return items
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
@@ -362,11 +875,8 @@ def data_reset():
 
 def get_product_data():
 
-    # with open("sample_products.csv") as csvfile:
-    #     reader = csv.DictReader(csvfile)
-    #     for row in reader:
-    #         Product(0, row['Name'], row['Category'], row['Price'], row[
-    #                 'Description'], row['Color'], int(row['Count'])).save()
+    # load the full sample catalog with:
+    #     python manage.py import sample_products.csv
     init_db()
     data_reset()
 
@@ -41,6 +41,88 @@ $(function () {
         $("#flash_message").append(message);
     }
 
+    // Number of Products requested per page of search results
+    var PAGE_SIZE = 20;
+
+    // Returns the url of the next page from a Link header or null
+    function next_page_url(link) {
+        var match = /<([^>]*)>;\s*rel="next"/.exec(link || "");
+        return match ? match[1] : null;
+    }
+
+    // Renders a list of Products, appending to the results if asked
+    function render_results(res, append) {
+        if (!append) {
+            $("#search_results").empty();
+            $("#search_results").append('<table class="table-striped" id="search_table"></table>');
+            var header = '<tr>'
+            header += '<th style="width:10%">ID</th>'
+            header += '<th style="width:20%">Name</th>'
+            header += '<th style="width:10%">Category</th>'
+            header += '<th style="width:10%">Color</th>'
+            header += '<th style="width:10%">Price</th>'
+            header += '<th style="width:20%">Count</th>'
+            header += '<th style="width:20%">Description</th></tr>'
+            $("#search_table").append(header);
+        }
+        for(var i = 0; i < res.length; i++) {
+            var product = res[i];
+            var row = "<tr><td>"+product.id+"</td><td>"+product.name+"</td><td>"+product.category+"</td><td>"+product.color+"</td><td>"+product.price+"</td><td>"+product.count+"</td><td>"+product.description+"</td></tr>";
+            $("#search_table").append(row);
+        }
+    }
+
+    // Milliseconds typing must pause for before names are suggested
+    var SUGGEST_DELAY = 150;
+    var suggest_timer = null;
+
+    // Fills the name suggestions with the names that start with prefix
+    function suggest_names(prefix) {
+        if (!prefix) {
+            $("#name_suggestions").empty();
+            return;
+        }
+        var ajax = $.ajax({
+            type: "GET",
+            url: "/products/suggest",
+            data: {prefix: prefix, limit: 10}
+        })
+
+        ajax.done(function(res)
+        {
+            if ($("#product_name").val() != prefix) {
+                return;  // a newer request is on its way
+            }
+            $("#name_suggestions").empty();
+            for (var i = 0; i < res.length; i++) {
+                $("#name_suggestions").append($("<option>").attr("value", res[i]));
+            }
+        });
+    }
+
+    // Fetches a page of Products and shows the next page button if needed
+    function search_products(url, append) {
+        var ajax = $.ajax({
+            type: "GET",
+            url: url,
+            contentType:"application/json",
+            data: ''
+        })
+
+        ajax.done(function(res, text_status, xhr)
+        {
+            render_results(res, append)
+            var next_url = next_page_url(xhr.getResponseHeader("Link"));
+            $("#next-page-btn").data("url", next_url).toggle(next_url != null);
+            flash_message("Great Success")
+        });
+
+        ajax.fail(function(res)
+        {
+            flash_message(res.responseJSON.message)
+        });
+    }
+
     // ****************************************
     // Create a Product
     // ****************************************
@@ -292,43 +374,38 @@ $(function () {
        //     }
        // }
 
-        var ajax = $.ajax({
-            type: "GET",
-            url: "/products?" + queryString,
-            contentType:"application/json",
-            data: ''
-        })
+        // page through the unfiltered listing instead of loading it all
+        if (queryString.length == 0) {
+            queryString = 'limit=' + PAGE_SIZE
+        }
 
-        ajax.done(function(res)
-        {
-            //alert(res.toSource())
-            $("#search_results").empty();
-            $("#search_results").append('<table class="table-striped">');
-            var header = '<tr>'
-            header += '<th style="width:10%">ID</th>'
-            header += '<th style="width:20%">Name</th>'
-            header += '<th style="width:10%">Category</th>'
-			header += '<th style="width:10%">Color</th>'
-			header += '<th style="width:10%">Price</th>'
-			header += '<th style="width:20%">Count</th>'
-            header += '<th style="width:20%">Description</th></tr>'
-            $("#search_results").append(header);
-            for(var i = 0; i < res.length; i++) {
-                product = res[i];
-                var row = "<tr><td>"+product.id+"</td><td>"+product.name+"</td><td>"+product.category+"</td><td>"+product.color+"</td><td>"+product.price+"</td><td>"+product.count+"</td><td>"+product.description+"</td></tr>";
-                $("#search_results").append(row);
-            }
+        search_products("/products?" + queryString, false)
 
-            $("#search_results").append('</table>');
+    });
 
-            flash_message("Great Success")
-        });
+    // ****************************************
+    // Suggest names while the name is typed
+    // ****************************************
 
-        ajax.fail(function(res)
-        {
-            flash_message(res.responseJSON.message)
-        });
+    $("#product_name").on("input", function ()
+    {
+        var prefix = $(this).val();
+        clearTimeout(suggest_timer);
+        suggest_timer = setTimeout(function () {
+            suggest_names(prefix)
+        }, SUGGEST_DELAY);
+    });
 
+    // ****************************************
+    // Load the next page of search results
+    // ****************************************
+
+    $("#next-page-btn").click(function () 
+    {
+        var next_url = $("#next-page-btn").data("url");
+        if (next_url) {
+            search_products(next_url, true)
+        }
     });
 
 })
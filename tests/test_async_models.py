@@ -0,0 +1,271 @@
+""" Test cases for the asyncio Product Model and its ASGI server """
+import json
+import unittest
+from mock import patch
+from models import Product, NotFoundError, OutOfStockError
+import params
+
+try:
+    import asyncio
+    import asgi
+    import async_models
+    from async_models import AsyncProduct
+    from redis.asyncio import Redis
+    from redis.exceptions import ConnectionError
+except (ImportError, SyntaxError):  # needs Python 3 and redis.asyncio
+    AsyncProduct = None
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+@unittest.skipIf(AsyncProduct is None, 'needs Python 3 and redis.asyncio')
+class TestAsyncProduct(unittest.TestCase):
+    """ Test Cases for the asyncio Product Model """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run every test on one event loop """
+        cls.loop = asyncio.new_event_loop()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.close()
+
+    def setUp(self):
+        """ Initialize the db """
+        Product.init_db()
+        Product.remove_all()
+        self.run_async(AsyncProduct.init_db())
+
+    def run_async(self, coroutine):
+        """ Runs a coroutine to completion """
+        return self.loop.run_until_complete(coroutine)
+
+    def request(self, method, path, body=None, query=b'', headers=None):
+        """ Sends a request to the ASGI app and returns status and JSON """
+        status, body, _ = self.request_with_headers(method, path, body, query,
+                                                    headers)
+        return status, body
+
+    def request_with_headers(self, method, path, body=None, query=b'',
+                             headers=None):
+        """ Sends a request and returns status, JSON and headers """
+        payload = json.dumps(body).encode('utf-8') if body is not None else b''
+        messages = [{'type': 'http.request', 'body': payload}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query,
+                 'headers': [(b'content-type', b'application/json'),
+                             (b'host', b'localhost')] + (headers or [])}
+        self.run_async(asgi.app(scope, receive, send))
+        body = sent[1]['body']
+        return sent[0]['status'], json.loads(body) if body else None, \
+            dict((name.decode('latin-1'), value.decode('latin-1'))
+                 for name, value in sent[0]['headers'])
+
+    def test_save_and_find(self):
+        """ Save a Product and find it from both models """
+        product = Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4)
+        self.run_async(AsyncProduct.save(product))
+        self.assertEqual(product.id, 1)
+        self.assertEqual(Product.find(1).name, 'Asus2500')
+        found = self.run_async(AsyncProduct.find(1))
+        self.assertEqual(found.serialize(), product.serialize())
+        self.assertIsNone(self.run_async(AsyncProduct.find(2)))
+
+    def test_all_and_finders(self):
+        """ List Products and find them by category and name """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '34324', 'micro', 'black', 0).save()
+        self.assertEqual(len(self.run_async(AsyncProduct.all())), 2)
+        products = self.run_async(AsyncProduct.find_by_category('microwave'))
+        self.assertEqual([p.name for p in products], ['GE4509'])
+        products = self.run_async(AsyncProduct.find_by_name('asus2500'))
+        self.assertEqual([p.id for p in products], [1])
+        products = self.run_async(AsyncProduct.available())
+        self.assertEqual([p.id for p in products], [1])
+
+    def test_delete(self):
+        """ Delete a Product and its index entries """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        self.run_async(AsyncProduct.delete(1))
+        self.assertIsNone(Product.find(1))
+        self.assertEqual(Product.find_by_category('laptop'), [])
+
+    def test_invalidate_without_cache(self):
+        """ Tell other processes about a change without a cache of our own """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 1).save()
+        Product.disable_cache()
+        pubsub = Product.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Product.cache_channel)
+        try:
+            self.run_async(AsyncProduct.adjust_count(1, -1))
+            message = None
+            for _ in range(20):
+                message = pubsub.get_message(timeout=0.1)
+                if message:
+                    break
+            self.assertEqual(message['data'], b'1')
+        finally:
+            pubsub.close()
+
+    def test_adjust_count(self):
+        """ Change the count atomically and refuse to oversell """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 1).save()
+        product = self.run_async(AsyncProduct.adjust_count(1, -1))
+        self.assertEqual(product.count, 0)
+        self.assertRaises(OutOfStockError, self.run_async,
+                          AsyncProduct.adjust_count(1, -1))
+        self.assertRaises(NotFoundError, self.run_async,
+                          AsyncProduct.adjust_count(5, 1))
+
+    def test_asgi_routes(self):
+        """ Create, read, sell and delete a Product over ASGI """
+        status, data = self.request('POST', '/products', {
+            'name': 'Hp', 'category': 'Microwave', 'price': '960',
+            'description': 'Brand New', 'color': 'Blue', 'count': 1})
+        self.assertEqual(status, 201)
+        path = '/products/{}'.format(data['id'])
+        self.assertEqual(self.request('GET', path)[1]['name'], 'Hp')
+        status, data = self.request('GET', '/products',
+                                    query=b'category=microwave')
+        self.assertEqual(len(data), 1)
+        self.assertEqual(self.request('PUT', path + '/sell_products')[0], 200)
+        status, data = self.request('PUT', path + '/inventory', {'delta': -1})
+        self.assertEqual(status, 409)
+        self.assertEqual(self.request('DELETE', path)[0], 204)
+        self.assertEqual(self.request('GET', path)[0], 404)
+        version = Product.catalog_version()
+        self.assertEqual(self.request('DELETE', path)[0], 204)
+        self.assertEqual(Product.catalog_version(), version)
+        self.assertEqual(self.request('POST', '/products', {'name': 'x'})[0],
+                         400)
+
+    def test_asgi_list_products(self):
+        """ Filter, page and project the Product list over ASGI """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '34324', 'micro', 'black', 0).save()
+        Product(0, 'Hp', 'Laptop', '960', 'laptop', 'black', 2).save()
+        status, data = self.request('GET', '/products',
+                                    query=b'category=laptop&color=black')
+        self.assertEqual([p['id'] for p in data], [3])
+        status, data = self.request('GET', '/products',
+                                    query=b'available=true&fields=name')
+        self.assertEqual(data, [{'name': 'Asus2500'}, {'name': 'Hp'}])
+        status, data = self.request('GET', '/products', query=b'ids=3,9,1')
+        self.assertEqual([p['id'] for p in data['products']], [3, 1])
+        self.assertEqual(data['missing'], [9])
+        status, data, headers = self.request_with_headers(
+            'GET', '/products', query=b'limit=2')
+        self.assertEqual([p['id'] for p in data], [1, 2])
+        link = headers['link'][1:headers['link'].index('>')]
+        query = link.split('?', 1)[1].encode('ascii')
+        status, data, headers = self.request_with_headers(
+            'GET', '/products', query=query)
+        self.assertEqual([p['id'] for p in data], [3])
+        self.assertNotIn('link', headers)
+        status, data = self.request('GET', '/products/available',
+                                    query=b'limit=1&cursor=' +
+                                    params.encode_cursor(1).encode('ascii'))
+        self.assertEqual([p['id'] for p in data], [3])
+        for query in (b'q=laptop', b'sort=price', b'min_price=3',
+                      b'ids=1&category=laptop', b'limit=0', b'fields=size'):
+            self.assertEqual(self.request('GET', '/products', query=query)[0],
+                             400)
+
+    def test_asgi_etag(self):
+        """ Answer 304 until the catalog or the Product changes """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        etags = {}
+        for path in ('/products', '/products/1'):
+            status, _, headers = self.request_with_headers('GET', path)
+            etags[path] = [(b'if-none-match',
+                            headers['etag'].encode('latin-1'))]
+            status, data = self.request('GET', path, headers=etags[path])
+            self.assertEqual(status, 304)
+            self.assertIsNone(data)
+        self.run_async(AsyncProduct.adjust_count(1, 1))
+        for path in ('/products', '/products/1'):
+            self.assertEqual(self.request('GET', path,
+                                          headers=etags[path])[0], 200)
+
+    def test_asgi_update_if_match(self):
+        """ Update a Product only while If-Match holds its ETag """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        _, _, headers = self.request_with_headers('GET', '/products/1')
+        etag = headers['etag'].encode('latin-1')
+        body = {'name': 'Asus3000', 'category': 'Laptop', 'price': '300',
+                'description': 'laptop', 'color': 'blue', 'count': 4}
+        status, data, headers = self.request_with_headers(
+            'PUT', '/products/1', body, headers=[(b'if-match', etag)])
+        self.assertEqual(status, 200)
+        self.assertEqual(data['name'], 'Asus3000')
+        self.assertNotEqual(headers['etag'].encode('latin-1'), etag)
+        body['name'] = 'Asus4000'
+        status, _ = self.request('PUT', '/products/1', body,
+                                 headers=[(b'if-match', etag)])
+        self.assertEqual(status, 412)
+        self.assertEqual(Product.find(1).name, 'Asus3000')
+
+
+@unittest.skipIf(AsyncProduct is None, 'needs Python 3 and redis.asyncio')
+class TestAsyncConnection(unittest.TestCase):
+    """ Test Cases for the asyncio Redis client """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.calls = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def fail(self, client, *args, **options):
+        """ Stands in for a command that could not reach Redis """
+        self.calls.append(args)
+        raise ConnectionError()
+
+    async def no_sleep(self, delay):
+        """ Stands in for the backoff """
+
+    def test_retry_connection_error(self):
+        """ Retry an idempotent command that could not reach Redis """
+        client = async_models.create_client('127.0.0.1', 6379, None,
+                                            retries=2)
+        with patch.object(Redis, 'execute_command', self.fail), \
+                patch.object(asyncio, 'sleep', self.no_sleep):
+            self.assertRaises(ConnectionError, self.loop.run_until_complete,
+                              client.execute_command('GET', 'index'))
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(client.connection_pool.connection_kwargs[
+            'retry']._retries, 0)
+
+    def test_unsafe_commands_not_retried(self):
+        """ Do not retry commands that may already have run """
+        client = async_models.create_client('127.0.0.1', 6379, None,
+                                            retries=2)
+        with patch.object(Redis, 'execute_command', self.fail), \
+                patch.object(asyncio, 'sleep', self.no_sleep):
+            for args in (('INCR', 'index'), ('EVALSHA', 'sha', 0),
+                         ('HINCRBY', 'inventory', 1, -1),
+                         ('ZADD', 'key', 'INCR', 1, 'a')):
+                self.calls = []
+                self.assertRaises(ConnectionError,
+                                  self.loop.run_until_complete,
+                                  client.execute_command(*args))
+                self.assertEqual(len(self.calls), 1)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
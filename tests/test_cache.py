@@ -0,0 +1,81 @@
+""" Test cases for the in-process caches """
+import time
+import unittest
+from cache import LRUCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the LRU cache """
+
+    def test_get_and_set(self):
+        """ Cache a value and count the hits and misses """
+        cache = LRUCache(maxsize=2)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1,
+                                         'size': 1, 'maxsize': 2})
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used value when full """
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_expires(self):
+        """ Treat values older than the ttl as missing """
+        cache = LRUCache(maxsize=2, ttl=0.05)
+        cache.set('a', 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_refuse_value_read_before_delete(self):
+        """ Do not cache a value read before a key was deleted """
+        cache = LRUCache()
+        generation = cache.generation
+        cache.delete('a')
+        cache.set('a', 1, generation)
+        self.assertIsNone(cache.get('a'))
+        cache.set('a', 2, cache.generation)
+        self.assertEqual(cache.get('a'), 2)
+
+    def test_evicts_to_fit_maxbytes(self):
+        """ Evict the least recently used values until their sizes fit """
+        cache = LRUCache(maxsize=10, maxbytes=10)
+        cache.set('a', 1, size=4)
+        cache.set('b', 2, size=4)
+        cache.set('c', 3, size=4)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+        cache.set('d', 4, size=11)  # too big to cache at all
+        self.assertIsNone(cache.get('d'))
+        cache.set('b', 5, size=2)
+        self.assertEqual(cache.stats()['bytes'], 6)
+        cache.delete('c')
+        self.assertEqual(cache.stats()['bytes'], 2)
+
+    def test_delete_and_clear(self):
+        """ Remove values from the cache """
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+        cache.clear()
+        self.assertIsNone(cache.get('b'))
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+""" Test cases for the Redis connection pool """
+import os
+import unittest
+from mock import patch
+from redis import Redis, BlockingConnectionPool
+from redis.exceptions import ConnectionError, TimeoutError
+import connection
+import metrics
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestConnection(unittest.TestCase):
+    """ Test Cases for the Redis connection pool """
+
+    def test_default_options(self):
+        """ Use the defaults when nothing is configured """
+        options = connection.get_options()
+        self.assertEqual(options['max_connections'], 50)
+        self.assertFalse(options['blocking'])
+
+    @patch.dict(os.environ, {'REDIS_MAX_CONNECTIONS': '10',
+                             'REDIS_BLOCKING_POOL': 'True'})
+    def test_options_from_environment(self):
+        """ Read options from the environment and let arguments win """
+        options = connection.get_options({'max_connections': '20',
+                                          'hostname': 'ignored'})
+        self.assertEqual(options['max_connections'], 20)
+        self.assertTrue(options['blocking'])
+        self.assertNotIn('hostname', options)
+
+    def test_create_blocking_client(self):
+        """ Create a client on a bounded blocking pool """
+        client = connection.create_client('127.0.0.1', 6379, None,
+                                          blocking=True, max_connections=4,
+                                          socket_timeout=1)
+        pool = client.connection_pool
+        self.assertIsInstance(pool, BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 4)
+        self.assertEqual(pool.connection_kwargs['socket_timeout'], 1)
+        self.assertEqual(connection.pool_stats(client)['in_use'], 0)
+
+    @patch('time.sleep')
+    @patch.object(Redis, 'execute_command')
+    def test_retry_connection_error(self, execute_mock, sleep_mock):
+        """ Retry a command that could not reach Redis with backoff """
+        execute_mock.side_effect = [ConnectionError(), ConnectionError(), 1]
+        client = connection.create_client('127.0.0.1', 6379, None,
+                                          retries=3, retry_backoff=0.1)
+        self.assertEqual(client.execute_command('GET', 'index'), 1)
+        self.assertEqual([call[0][0] for call in sleep_mock.call_args_list],
+                         [0.1, 0.2])
+
+    @patch('time.sleep')
+    @patch.object(Redis, 'execute_command')
+    def test_unsafe_commands_not_retried(self, execute_mock, sleep_mock):
+        """ Do not retry commands that may already have run """
+        execute_mock.side_effect = ConnectionError()
+        client = connection.create_client('127.0.0.1', 6379, None, retries=2)
+        for args in (('INCR', 'index'), ('EVALSHA', 'sha', 0),
+                     ('HINCRBY', 'inventory', 1, -1),
+                     ('ZADD', 'key', 'INCR', 1, 'a')):
+            execute_mock.reset_mock()
+            self.assertRaises(ConnectionError, client.execute_command, *args)
+            self.assertEqual(execute_mock.call_count, 1)
+        self.assertFalse(sleep_mock.called)
+
+    @patch('redis.client.Pipeline.execute')
+    @patch.object(Redis, 'execute_command')
+    def test_count_commands(self, execute_mock, pipeline_mock):
+        """ Count commands and pipelined commands against a method """
+        client = connection.create_client('127.0.0.1', 6379, None)
+        metrics.reset()
+
+        @metrics.timed
+        def method():
+            client.execute_command('INCR', 'index')
+            pipe = client.pipeline()
+            pipe.set('a', 1).set('b', 2)
+            pipe.execute()
+
+        method()
+        self.assertEqual(metrics.REDIS_COMMANDS.get(('method',)), 3)
+
+    @patch('time.sleep')
+    @patch.object(Redis, 'execute_command')
+    def test_retries_exhausted(self, execute_mock, sleep_mock):
+        """ Give up once every retry failed """
+        execute_mock.side_effect = ConnectionError()
+        client = connection.create_client('127.0.0.1', 6379, None, retries=2)
+        self.assertRaises(ConnectionError, client.execute_command, 'PING')
+        self.assertEqual(execute_mock.call_count, 3)
+
+    @patch('time.sleep')
+    @patch.object(Redis, 'execute_command')
+    def test_timeout_not_retried(self, execute_mock, sleep_mock):
+        """ Only retry timeouts when asked to """
+        execute_mock.side_effect = TimeoutError()
+        client = connection.create_client('127.0.0.1', 6379, None, retries=2)
+        self.assertRaises(TimeoutError, client.execute_command, 'INCR', 'x')
+        self.assertEqual(execute_mock.call_count, 1)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
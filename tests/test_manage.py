@@ -0,0 +1,52 @@
+""" Test cases for the management commands """
+import os
+import unittest
+import manage
+from models import Product
+
+SAMPLE_PRODUCTS = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'sample_products.csv')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestManage(unittest.TestCase):
+    """ Test Cases for the management commands """
+
+    def setUp(self):
+        """ Initialize the db """
+        Product.init_db()
+        Product.remove_all()
+
+    def test_import_csv(self):
+        """ Import the sample catalog twice """
+        manage.main(['import', SAMPLE_PRODUCTS, '--batch-size', '10'])
+        manage.main(['import', SAMPLE_PRODUCTS, '--batch-size', '10'])
+        products = Product.all()
+        self.assertEqual(len(products), 76)
+        self.assertEqual(Product.find(1003).name, 'Apple MacBook Pro')
+        self.assertEqual(Product.find(1003).count, 2)
+        self.assertEqual(len(Product.find_by_category('laptop')), 1)
+
+    def test_import_resume(self):
+        """ Resume an import from its checkpoint """
+        path = os.path.abspath(SAMPLE_PRODUCTS)
+        Product.redis.hset(manage.checkpoint_key(), path, 70)
+        manage.main(['import', SAMPLE_PRODUCTS, '--resume'])
+        self.assertEqual(len(Product.all()), 6)
+        self.assertIsNone(Product.redis.hget(manage.checkpoint_key(), path))
+
+    def test_rebuild_indexes(self):
+        """ Rebuild the indexes from the command line """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        manage.main(['rebuild-indexes'])
+        self.assertEqual(len(Product.find_by_name('Asus2500')), 1)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+""" Test cases for the Prometheus metrics """
+import unittest
+import metrics
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the Prometheus metrics """
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_render_counter_and_histogram(self):
+        """ Render counters and cumulative histogram buckets """
+        metrics.observe_request('GET', '/products', 200, 0.003, 120)
+        metrics.observe_request('GET', '/products', 404, 20, None)
+        text = metrics.render()
+        self.assertIn('# TYPE http_requests_total counter', text)
+        self.assertIn('http_requests_total{method="GET",route="/products",'
+                      'status="200"} 1', text)
+        self.assertIn('http_request_errors_total{method="GET",'
+                      'route="/products",status="404"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/products",le="0.0025"} 0', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/products",le="0.005"} 1', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/products",le="+Inf"} 2', text)
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/products"} 2', text)
+        self.assertIn('http_response_size_bytes_count{method="GET",'
+                      'route="/products"} 1', text)
+
+    def test_escape_labels(self):
+        """ Escape quotes and backslashes in label values """
+        metrics.REQUESTS.inc(('GET', 'a"b\\c', '200'))
+        self.assertIn(r'route="a\"b\\c"', metrics.render())
+
+    def test_timed_counts_outer_call(self):
+        """ Count the Redis commands of nested calls against the outer one """
+        @metrics.timed
+        def inner():
+            metrics.count_commands(2)
+
+        @metrics.timed
+        def outer():
+            metrics.count_commands()
+            inner()
+
+        outer()
+        metrics.count_commands(5)  # outside of any method
+        self.assertEqual(metrics.REDIS_COMMANDS.get(('outer',)), 3)
+        self.assertEqual(metrics.METHOD_LATENCY.get(('outer',)), 1)
+        self.assertEqual(metrics.METHOD_LATENCY.get(('inner',)), 0)
+
+    def test_timed_generator(self):
+        """ Record a generator once it is exhausted """
+        @metrics.timed
+        def numbers():
+            for number in range(3):
+                metrics.count_commands()
+                yield number
+
+        items = numbers()
+        self.assertEqual(next(items), 0)
+        self.assertEqual(metrics.METHOD_LATENCY.get(('numbers',)), 0)
+        metrics.count_commands()  # the caller's work is not counted
+        self.assertEqual(list(items), [1, 2])
+        self.assertEqual(metrics.METHOD_LATENCY.get(('numbers',)), 1)
+        self.assertEqual(metrics.REDIS_COMMANDS.get(('numbers',)), 3)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
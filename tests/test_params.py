@@ -0,0 +1,48 @@
+""" Test cases for the query parameters shared by the servers """
+import unittest
+import params
+from models import DataValidationError
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestParams(unittest.TestCase):
+    """ Test Cases for the query parameter readers """
+
+    def test_page_args(self):
+        """ Read the page size and the cursor it starts after """
+        self.assertEqual(params.get_page_args({}), (None, 0))
+        cursor = params.encode_cursor(42)
+        self.assertEqual(params.get_page_args({'cursor': cursor}),
+                         (params.DEFAULT_PAGE_SIZE, 42))
+        self.assertEqual(params.get_page_args({'limit': '5000'}),
+                         (params.MAX_PAGE_SIZE, 0))
+        for args in ({'limit': '0'}, {'limit': 'x'}, {'cursor': '!'}):
+            self.assertRaises(DataValidationError, params.get_page_args, args)
+
+    def test_number_arg(self):
+        """ Read finite numbers only """
+        self.assertIsNone(params.get_number_arg({}, 'min_price'))
+        self.assertEqual(params.get_number_arg({'min_price': '9.5'},
+                                               'min_price'), 9.5)
+        for value in ('cheap', 'nan', 'inf', '-Infinity'):
+            self.assertRaises(DataValidationError, params.get_number_arg,
+                              {'min_price': value}, 'min_price')
+
+    def test_fields_ids_and_flags(self):
+        """ Read the fields, ids and true or false parameters """
+        self.assertEqual(params.get_fields_arg({'fields': 'id, name'}),
+                         ['id', 'name'])
+        self.assertRaises(DataValidationError, params.get_fields_arg,
+                          {'fields': 'id,size'})
+        self.assertEqual(params.get_ids_arg('1,2,'), [1, 2])
+        self.assertRaises(DataValidationError, params.get_ids_arg, 'a')
+        self.assertRaises(DataValidationError, params.get_ids_arg,
+                          ','.join(['1'] * (params.MAX_IDS + 1)))
+        self.assertTrue(params.get_flag_arg({'available': 'TRUE'},
+                                            'available'))
+        self.assertFalse(params.get_flag_arg({}, 'available'))
+        self.assertRaises(DataValidationError, params.get_flag_arg,
+                          {'available': 'yes'}, 'available')
@@ -1,10 +1,14 @@
 """ Test cases for Product Model """
 import os
 import json
+import time
+import pickle
 import unittest
 from mock import patch
 from redis import Redis, ConnectionError
 from models import Product, DataValidationError,DatabaseConnectionError,BadRequestError,NotFoundError
+from models import OutOfStockError, PreconditionFailedError
+import serializers
 
 VCAP_SERVICES = os.getenv('VCAP_SERVICES', None)
 
@@ -69,6 +73,71 @@ class TestProduct(unittest.TestCase):
         self.assertEqual(len(products), 1)
         self.assertEqual(products[0].category, "gaming_laptop")
 
+    def test_concurrent_updates(self):
+        """ Move the index entries from what another writer just stored """
+        Product(0, 'iPad', 'Tablet', '499', 'ipad', 'grey', 4).save()
+        first, second = Product.find(1), Product.find(1)
+        first.category = 'Phone'
+        second.category = 'Laptop'
+        load = Product._Product__fetch_data
+
+        def racing_fetch(product_ids, fields=None):
+            """ Lets the first writer save right after the second read """
+            data = load(product_ids, fields)
+            if first.category == 'Phone':
+                first.category = 'phone'
+                first.save()
+            return data
+
+        with patch.object(Product, '_Product__fetch_data',
+                          staticmethod(racing_fetch)):
+            second.save()
+        self.assertEqual(Product.find(1).category, 'Laptop')
+        self.assertEqual(Product.find_by_category('tablet'), [])
+        self.assertEqual(Product.find_by_category('phone'), [])
+        self.assertEqual([p.id for p in Product.find_by_category('laptop')],
+                         [1])
+
+    def test_save_if_version(self):
+        """ Only save while the Product still has an expected version """
+        product = Product(0, 'iPad', 'Tablet', '499', 'ipad', 'grey', 4)
+        product.save()
+        version = Product.get_version(1)
+        product.price = '399'
+        product.save([version])
+        self.assertNotEqual(Product.get_version(1), version)
+        product.price = '299'
+        self.assertRaises(PreconditionFailedError, product.save, [version])
+        self.assertEqual(Product.find(1).price, '399')
+
+    def test_save_if_version_watches_one_product(self):
+        """ Retry a versioned save only for changes to its own Product """
+        product = Product(0, 'iPad', 'Tablet', '499', 'ipad', 'grey', 4)
+        product.save()
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        fetch = Product._Product__fetch_data
+        reads = []
+
+        def racing_fetch(product_ids, fields=None):
+            reads.append(product_ids)
+            if len(reads) == 1:
+                Product.adjust_count(racing_id, -1)
+            return fetch(product_ids, fields)
+
+        with patch.object(Product, '_Product__fetch_data', racing_fetch):
+            racing_id = 2  # another Product sells while we save
+            product.price = '399'
+            product.save([Product.get_version(1)])
+            self.assertEqual(len(reads), 1)
+            racing_id = 1  # our Product sells, so its version moves on
+            del reads[:]
+            product.price = '299'
+            self.assertRaises(PreconditionFailedError, product.save,
+                              [Product.get_version(1)])
+            self.assertEqual(len(reads), 1)
+        self.assertEqual(Product.find(1).price, '399')
+        self.assertEqual(Product.find(1).count, 3)
+
     def test_delete_a_product(self):
         """ Delete a Product """
         p = Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4)
@@ -143,6 +212,155 @@ class TestProduct(unittest.TestCase):
         self.assertEqual(products[0].id, 1)
         self.assertEqual(products[0].name, "Asus2500")
 
+    def test_iterate_in_batches(self):
+        """ Iterate over all Products a few at a time """
+        for i in range(7):
+            Product(0, 'Asus%d' % i, 'Laptop', '234', 'laptop', 'blue',
+                    i).save()
+        Product.find(6).delete()
+        products = list(Product.iterate(batch_size=3))
+        self.assertEqual([p.id for p in products], [1, 2, 3, 4, 5, 7])
+
+    def test_page_through_products(self):
+        """ Page through the Products in id order """
+        for i in range(5):
+            Product(0, 'Asus%d' % i, 'Laptop', '234', 'laptop', 'blue',
+                    i % 2).save()
+        products, after = Product.page(2)
+        self.assertEqual([p.id for p in products], [1, 2])
+        products, after = Product.page(2, after)
+        self.assertEqual([p.id for p in products], [3, 4])
+        products, after = Product.page(2, after)
+        self.assertEqual([p.id for p in products], [5])
+        self.assertIsNone(after)
+
+    def test_page_available_products(self):
+        """ Page through the Products that are in stock """
+        for i in range(5):
+            Product(0, 'Asus%d' % i, 'Laptop', '234', 'laptop', 'blue',
+                    i % 2).save()
+        products, after = Product.page(1, available=True)
+        self.assertEqual([p.id for p in products], [2])
+        products, after = Product.page(1, after, available=True)
+        self.assertEqual([p.id for p in products], [4])
+
+    def test_adjust_count(self):
+        """ Add and remove units of a Product atomically """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        product = Product.adjust_count(1, 3)
+        self.assertEqual(product.count, 7)
+        self.assertEqual(product.name, 'Asus2500')
+        product = Product.adjust_count(1, -7)
+        self.assertEqual(product.count, 0)
+        self.assertEqual(Product.find(1).count, 0)
+
+    def test_adjust_count_out_of_stock(self):
+        """ Sell more units of a Product than are in stock """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 2).save()
+        self.assertRaises(OutOfStockError, Product.adjust_count, 1, -3)
+        self.assertEqual(Product.find(1).count, 2)
+
+    def test_adjust_count_not_found(self):
+        """ Change the count of a Product that doesn't exist """
+        self.assertRaises(NotFoundError, Product.adjust_count, 1, 1)
+
+    def test_adjust_count_of_older_record(self):
+        """ Change the count of a Product saved before the inventory hash """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product.redis.hdel(Product.inventory_key, 1)
+        Product.redis.set(Product._key(1), pickle.dumps(
+            {"id": 1, "name": "Asus2500", "category": "Laptop",
+             "price": "234", "description": "laptop",
+             "color": "blue", "count": 4}))
+        product = Product.adjust_count(1, -1)
+        self.assertEqual(product.count, 3)
+
+    def test_available_follows_count(self):
+        """ A Product leaves and rejoins the available list with its count """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 1).save()
+        self.assertEqual(len(Product.available()), 1)
+        Product.adjust_count(1, -1)
+        self.assertEqual(Product.available(), [])
+        Product.adjust_count(1, 2)
+        self.assertEqual(len(Product.available()), 1)
+        product = Product.find(1)
+        product.count = 0
+        product.save()
+        self.assertEqual(Product.available(), [])
+        product.count = 5
+        product.save()
+        product.delete()
+        self.assertEqual(Product.available(), [])
+
+    def test_query_price_range(self):
+        """ Query Products in a price range, cheapest first """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'microwave', 'black', 12).save()
+        Product(0, 'Hp', 'Microwave', '960', 'microwave', 'blue', 0).save()
+        products, offset = Product.query(min_price=40, max_price=300)
+        self.assertEqual([p.name for p in products], ['GE4509', 'Asus2500'])
+        self.assertIsNone(offset)
+        products, offset = Product.query('-price', limit=2)
+        self.assertEqual([p.name for p in products], ['Hp', 'Asus2500'])
+        self.assertEqual(offset, 2)
+        products, offset = Product.query('-price', limit=2, offset=offset)
+        self.assertEqual([p.name for p in products], ['GE4509'])
+        self.assertIsNone(offset)
+
+    def test_query_sorted_by_count_and_name(self):
+        """ Query Products sorted by count and by name """
+        Product(0, 'hp', 'Microwave', '960', 'microwave', 'blue', 0).save()
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'microwave', 'black', 12).save()
+        products, _ = Product.query('count')
+        self.assertEqual([p.name for p in products], ['hp', 'Asus2500', 'GE4509'])
+        products, _ = Product.query('name')
+        self.assertEqual([p.name for p in products], ['Asus2500', 'GE4509', 'hp'])
+        products, _ = Product.query('-name', max_price=500)
+        self.assertEqual([p.name for p in products], ['GE4509', 'Asus2500'])
+        Product.adjust_count(1, 20)
+        products, _ = Product.query('-count', limit=1)
+        self.assertEqual(products[0].name, 'hp')
+        self.assertRaises(DataValidationError, Product.query, 'color')
+
+    def test_save_many(self):
+        """ Save many Products with their own ids, twice """
+        products = [Product(1001, 'Asus2500', 'Laptop', '234', 'laptop',
+                            'blue', 4),
+                    Product(1002, 'GE4509', 'Microwave', '45', 'microwave',
+                            'black', 1)]
+        Product.save_many(products)
+        products[1].category = 'Oven'
+        Product.save_many(products)
+        self.assertEqual(len(Product.all()), 2)
+        self.assertEqual(Product.find_by_category('Microwave'), [])
+        self.assertEqual(Product.find_by_category('Oven')[0].id, 1002)
+        p = Product(0, 'Hp', 'Microwave', '960', 'microwave', 'blue', 0)
+        p.save()
+        self.assertEqual(p.id, 1003)
+
+    def test_create_many(self):
+        """ Create many Products at once with one block of ids """
+        Product(0, 'Asus2500', 'Laptop', 234, 'laptop', 'blue', 4).save()
+        items = [{'name': 'GE4509', 'category': 'Microwave', 'price': 45,
+                  'description': 'microwave', 'color': 'black', 'count': 1},
+                 {'name': 'Hp', 'category': 'Microwave'},
+                 {'name': 'Hp', 'category': 'Microwave', 'price': 960,
+                  'description': 'microwave', 'color': 'blue', 'count': 0},
+                 {'name': 'Lg', 'category': 'Microwave', 'price': '10',
+                  'description': 'microwave', 'color': 'red', 'count': 2},
+                 {'name': 'Lg', 'category': 'Microwave', 'price': None,
+                  'description': 'microwave', 'color': 'red', 'count': 2}]
+        results = Product.create_many(items)
+        self.assertEqual([p.id if p else None for p, _ in results],
+                         [2, None, 3, 4, None])
+        self.assertIn('price', results[1][1])
+        self.assertIn('price', results[4][1])
+        self.assertEqual(len(Product.all()), 4)
+        self.assertEqual(len(Product.find_by_category('microwave')), 3)
+        self.assertEqual(Product.find(4).price, '10')
+        self.assertEqual(Product.redis.get(Product.counter_key), b'4')
+
     def test_find_product(self):
         """ Find a Product by ID """
         Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
@@ -186,11 +404,457 @@ class TestProduct(unittest.TestCase):
         self.assertEqual(products[0].category, "Laptop")
         self.assertEqual(products[0].name, "Asus2500")
 
+    def test_find_by_category_is_case_insensitive(self):
+        """ Find Products by Category ignoring case """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'MacBook', 'LAPTOP', '1500', 'laptop', 'silver', 2).save()
+        Product(0, 'GE4509', 'Microwave', '34324',
+                'microwave', 'black', 4).save()
+        products = Product.find_by_category("laptop")
+        self.assertEqual(len(products), 2)
+        self.assertEqual(products[0].name, "Asus2500")
+        self.assertEqual(products[1].name, "MacBook")
+
+    def test_update_moves_index_entry(self):
+        """ Update a Product and find it by its new Category only """
+        p = Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4)
+        p.save()
+        p.category = "Tablet"
+        p.save()
+        self.assertEqual(Product.find_by_category("Laptop"), [])
+        products = Product.find_by_category("Tablet")
+        self.assertEqual(len(products), 1)
+        self.assertEqual(products[0].id, p.id)
+
+    def test_delete_removes_index_entry(self):
+        """ Delete a Product and make sure it can't be found by name """
+        p = Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4)
+        p.save()
+        p.delete()
+        self.assertEqual(Product.find_by_name("Asus2500"), [])
+
+    def test_rebuild_indexes(self):
+        """ Rebuild the indexes after they were lost """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '34324',
+                'microwave', 'black', 4).save()
+        for key in Product.redis.keys(Product.prefix + 'idx:*'):
+            Product.redis.delete(key)
+        self.assertEqual(Product.find_by_name("GE4509"), [])
+        self.assertEqual(Product.rebuild_indexes(), 2)
+        products = Product.find_by_name("GE4509")
+        self.assertEqual(len(products), 1)
+        self.assertEqual(products[0].id, 2)
+
+    def test_read_mixed_codecs(self):
+        """ Read Products written with different codecs """
+        codec = Product.codec
+        try:
+            Product.codec = serializers.get_codec('pickle')
+            Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+            Product.codec = serializers.get_codec('json')
+            Product(0, 'GE4509', 'Microwave', '34324',
+                    'microwave', 'black', 4).save()
+        finally:
+            Product.codec = codec
+        products = Product.all()
+        self.assertEqual(sorted(p.name for p in products),
+                         ['Asus2500', 'GE4509'])
+
+    def test_get_fields(self):
+        """ Read only some fields of a Product """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        data = Product.get_fields(1, ['name', 'count'])
+        self.assertEqual(data, {'name': 'Asus2500', 'count': 4})
+        self.assertIsNone(Product.get_fields(2, ['name']))
+
+    def test_set_fields(self):
+        """ Update only some fields of a Product """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        product = Product.set_fields(1, {'category': 'Tablet', 'count': 2})
+        self.assertEqual(product.category, 'Tablet')
+        product = Product.find(1)
+        self.assertEqual(product.name, 'Asus2500')
+        self.assertEqual(product.count, 2)
+        self.assertEqual(len(Product.find_by_category('Tablet')), 1)
+        self.assertRaises(NotFoundError, Product.set_fields, 2, {'count': 1})
+
+    def test_search(self):
+        """ Search the names and descriptions ranked by word frequency """
+        Product(0, 'Asus2500', 'Laptop', '234',
+                'Laptop with a long battery life', 'blue', 4).save()
+        Product(0, 'Dell XPS', 'Laptop', '999',
+                'Battery laptop, the laptop of laptops', 'black', 2).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'Open box', 'black', 1).save()
+        products, after = Product.search('LAPTOP battery')
+        self.assertEqual([p.id for p in products], [2, 1])
+        self.assertIsNone(after)
+        products, after = Product.search('laptop', limit=1)
+        self.assertEqual([p.id for p in products], [2])
+        products, after = Product.search('laptop', limit=1, offset=after)
+        self.assertEqual([p.id for p in products], [1])
+        self.assertIsNone(after)
+        self.assertEqual(Product.search('laptop microwave'), ([], None))
+        self.assertEqual(Product.search('  '), ([], None))
+
+    def test_find_many(self):
+        """ Find many Products at once and report the missing ids """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'micro', 'black', 1).save()
+        Product(0, 'Hp', 'Microwave', '960', 'micro', 'blue', 0).save()
+        Product.find(3).delete()
+        products, missing = Product.find_many([2, 7, '1', 2, 3])
+        self.assertEqual([p.id for p in products], [2, 1])
+        self.assertEqual(products[0].name, 'GE4509')
+        self.assertEqual(missing, [7, 3])
+        self.assertEqual(Product.find_many([]), ([], []))
+
+    def test_from_dict(self):
+        """ Build a compact Product from a dictionary in one step """
+        data = {'id': '3', 'name': 'Hp', 'category': 'Microwave',
+                'price': '960', 'description': 'Brand New', 'color': 'Blue',
+                'count': 0}
+        product = Product.from_dict(data)
+        self.assertEqual(product.serialize(), dict(data, id=3))
+        self.assertFalse(hasattr(product, '__dict__'))
+        del data['color']
+        self.assertRaises(DataValidationError, Product.from_dict, data)
+
+    def test_iterate_json(self):
+        """ Encode every Product as the JSON the API returns """
+        Product(0, 'Asus2500', 'Laptop', 234, 'laptop', 'blue', 4).save()
+        Product(0, u'Caf\xe9', 'Kitchen', '45', 'say "hi"', 'black', 0).save()
+        products = sorted((json.loads(text) for text in
+                           Product.iterate_json(batch_size=1)),
+                          key=lambda data: data['id'])
+        self.assertEqual(products, [
+            {'id': 1, 'name': 'Asus2500', 'category': 'Laptop',
+             'price': '234', 'description': 'laptop', 'color': 'blue',
+             'count': 4},
+            {'id': 2, 'name': u'Caf\xe9', 'category': 'Kitchen',
+             'price': '45', 'description': 'say "hi"', 'color': 'black',
+             'count': 0}])
+
+    def test_list_fields(self):
+        """ Read only some fields of the Products of a listing """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'micro', 'black', 0).save()
+        fields = ['name', 'count']
+        products, _ = Product.page(10, fields=fields)
+        self.assertEqual(products, [{'name': 'Asus2500', 'count': 4},
+                                    {'name': 'GE4509', 'count': 0}])
+        products, _ = Product.query('-price', fields=['id'])
+        self.assertEqual(products, [{'id': 1}, {'id': 2}])
+        products, _ = Product.filter({'color': 'black'}, fields=['price'])
+        self.assertEqual(products, [{'price': '45'}])
+        products = list(Product.iterate(fields=['color']))
+        self.assertEqual(sorted(p['color'] for p in products),
+                         ['black', 'blue'])
+        products, missing = Product.find_many([2, 3], fields=['name'])
+        self.assertEqual((products, missing), ([{'name': 'GE4509'}], [3]))
+
+    def test_filter(self):
+        """ Find Products that match several filters at once """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'Silver', 4).save()
+        Product(0, 'Dell XPS', 'Laptop', '999', 'laptop', 'silver', 0).save()
+        Product(0, 'Dell XPS', 'Laptop', '899', 'laptop', 'black', 2).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'micro', 'silver', 1).save()
+        products, after = Product.filter({'category': 'LAPTOP',
+                                          'color': 'silver'})
+        self.assertEqual([p.id for p in products], [1, 2])
+        self.assertIsNone(after)
+        products, after = Product.filter({'color': 'silver'}, available=True,
+                                         limit=1)
+        self.assertEqual([p.id for p in products], [1])
+        products, after = Product.filter({'color': 'silver'}, available=True,
+                                         limit=1, offset=after)
+        self.assertEqual([p.id for p in products], [4])
+        self.assertIsNone(after)
+        products, _ = Product.filter({'name': 'dell xps'}, available=True)
+        self.assertEqual([p.id for p in products], [3])
+        self.assertEqual(Product.filter({'category': 'laptop',
+                                         'color': 'red'}), ([], None))
+        self.assertRaises(DataValidationError, Product.filter,
+                          {'price': '234'})
+
+    def test_filter_price_range_and_sort(self):
+        """ Combine filters with a price range and a sort order """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'silver', 4).save()
+        Product(0, 'Dell XPS', 'Laptop', '999', 'laptop', 'silver', 1).save()
+        Product(0, 'Dell Air', 'Laptop', '899', 'laptop', 'black', 9).save()
+        Product(0, 'GE4509', 'Microwave', '45', 'micro', 'silver', 2).save()
+
+        def ids(products):
+            return [p.id for p in products]
+
+        products, _ = Product.filter({'category': 'laptop'}, min_price=500)
+        self.assertEqual(ids(products), [2, 3])
+        products, _ = Product.filter({'category': 'laptop'}, sort='-price')
+        self.assertEqual(ids(products), [2, 3, 1])
+        products, _ = Product.filter({'color': 'silver'}, sort='count',
+                                     max_price=500)
+        self.assertEqual(ids(products), [4, 1])
+        products, after = Product.filter({'category': 'laptop'}, sort='name',
+                                         min_price=200, max_price=900,
+                                         limit=1)
+        self.assertEqual((ids(products), after), ([1], 1))
+        products, after = Product.filter({'category': 'laptop'}, sort='name',
+                                         min_price=200, max_price=900,
+                                         limit=1, offset=after)
+        self.assertEqual((ids(products), after), ([3], None))
+        self.assertRaises(DataValidationError, Product.filter,
+                          {'category': 'laptop'}, sort='color')
+
+    def test_search_with_filters(self):
+        """ Narrow a search with filters """
+        Product(0, 'Hp', 'Microwave', '960', 'Brand new', 'blue', 0).save()
+        Product(0, 'Asus', 'Laptop', '234', 'Brand new laptop', 'blue',
+                1).save()
+        products, _ = Product.search('brand', filters={'category': 'laptop'})
+        self.assertEqual([p.id for p in products], [2])
+        products, _ = Product.search('brand', available=True)
+        self.assertEqual([p.id for p in products], [2])
+        products, _ = Product.search('brand new', filters={'color': 'blue'})
+        self.assertEqual(sorted(p.id for p in products), [1, 2])
+
+    def test_search_after_update(self):
+        """ Move a Product in the search index when it changes """
+        product = Product(0, 'Asus2500', 'Laptop', '234',
+                          'long battery life', 'blue', 4)
+        product.save()
+        product.description = 'open box'
+        product.save()
+        self.assertEqual(Product.search('battery')[0], [])
+        self.assertEqual(len(Product.search('box')[0]), 1)
+        product.delete()
+        self.assertEqual(Product.search('box')[0], [])
+
+    def test_suggest(self):
+        """ Suggest the distinct names that start with a prefix """
+        Product(0, 'MacBook Pro', 'Laptop', '1999', 'laptop', 'grey', 4).save()
+        Product(0, 'Mac Mini', 'Desktop', '699', 'desktop', 'grey', 4).save()
+        Product(0, 'MacBook Pro', 'Laptop', '2499', 'laptop', 'grey', 1).save()
+        Product(0, 'Surface', 'Laptop', '999', 'laptop', 'black', 1).save()
+        Product(0, 'Macbook pro', 'Laptop', '999', 'laptop', 'black', 1).save()
+        self.assertEqual(Product.suggest('MAC'), ['Mac Mini', 'MacBook Pro'])
+        self.assertEqual(Product.suggest('mac', limit=1), ['Mac Mini'])
+        self.assertEqual(Product.suggest('macbook p'), ['MacBook Pro'])
+        self.assertEqual(Product.suggest('z'), [])
+        self.assertEqual(Product.suggest(''), [])
+
+    def test_name_index_before_case_was_kept(self):
+        """ Read and replace name index members of the older format """
+        Product(0, 'MacBook Pro', 'Laptop', '1999', 'laptop', 'grey', 4).save()
+        Product.redis.delete(Product.name_key)
+        Product.redis.zadd(Product.name_key, {u'macbook pro\x001': 0})
+        self.assertEqual(Product.suggest('mac'), ['macbook pro'])
+        self.assertEqual([p.id for p in Product.query('name')[0]], [1])
+        product = Product.find(1)
+        product.name = 'MacBook Air'
+        product.save()
+        self.assertEqual(Product.suggest('mac'), ['MacBook Air'])
+
+    def test_name_rank_index(self):
+        """ Keep ids in name order when names crowd into one gap """
+        names = ['0', 'a', 'b'] + ['a%s1' % ('0' * k) for k in range(60)]
+        for name in names:
+            Product(0, name, 'Laptop', '234', 'laptop', 'grey', 1).save()
+        products, _ = Product.filter({'category': 'laptop'}, sort='name')
+        self.assertEqual([p.name for p in products], sorted(names))
+        products, _ = Product.query('-name', max_price=500, limit=3)
+        self.assertEqual([p.name for p in products], sorted(names)[:-4:-1])
+        # indexed before the rank index was kept
+        Product.redis.delete(Product.name_rank_key)
+        Product.adjust_count(1, 1)
+        products, _ = Product.filter({}, sort='name', limit=2)
+        self.assertEqual([p.name for p in products], sorted(names)[:2])
+
+    def test_catalog_version(self):
+        """ Bump the catalog version on every change """
+        version = Product.catalog_version()
+        product = Product(0, "iPhone", "Phone", "650", "Brand New", "White", 2)
+        product.save()
+        self.assertGreater(Product.catalog_version(), version)
+        version = Product.catalog_version()
+        Product.adjust_count(product.id, -1)
+        self.assertGreater(Product.catalog_version(), version)
+        version = Product.catalog_version()
+        product.delete()
+        self.assertGreater(Product.catalog_version(), version)
+        version = Product.catalog_version()
+        Product.remove_all()
+        self.assertGreater(Product.catalog_version(), version)
+
+    def test_get_version(self):
+        """ Stamp a new version on a Product every time it changes """
+        product = Product(0, "iPhone", "Phone", "650", "Brand New", "White", 2)
+        product.save()
+        version = Product.get_version(product.id)
+        self.assertIsNotNone(version)
+        Product.adjust_count(product.id, 1)
+        self.assertGreater(Product.get_version(product.id), version)
+        version = Product.get_version(product.id)
+        product.save()
+        self.assertGreater(Product.get_version(product.id), version)
+        product.delete()
+        self.assertIsNone(Product.get_version(product.id))
+
+    def test_find_from_cache(self):
+        """ Find a Product from the cache until it changes """
+        Product.enable_cache(maxsize=10)
+        try:
+            Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+            self.assertEqual(Product.find(1).name, 'Asus2500')
+            self.assertEqual(Product.find(1).name, 'Asus2500')
+            self.assertEqual(Product.cache_stats()['hits'], 1)
+            Product.adjust_count(1, 1)
+            self.assertEqual(Product.find(1).count, 5)
+            # another instance changed the Product and tells us about it
+            Product.cache.set(1, dict(Product.find(1).serialize(), count=9))
+            self.assertEqual(Product.find(1).count, 9)
+            Product.redis.publish(Product.cache_channel, 1)
+            for _ in range(20):
+                if Product.find(1).count == 5:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(Product.find(1).count, 5)
+        finally:
+            Product.disable_cache()
+
+    def test_cache_skips_data_read_before_invalidation(self):
+        """ Do not cache a Product read before it was invalidated """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product.enable_cache(maxsize=10)
+        self.assertEqual(Product.cache.ttl, Product.cache_ttl)
+        load = Product._Product__load
+
+        def racing_load(product_id):
+            data = load(product_id)
+            Product.cache.delete(int(product_id))  # a change arrives
+            return data
+
+        try:
+            with patch.object(Product, '_Product__load', racing_load):
+                self.assertEqual(Product.find(1).name, 'Asus2500')
+            self.assertEqual(Product.cache.stats()['size'], 0)
+            self.assertEqual(Product.find(1).name, 'Asus2500')
+            self.assertEqual(Product.cache.stats()['size'], 1)
+        finally:
+            Product.disable_cache()
+
+    def test_cache_disabled_when_listener_fails(self):
+        """ Stop caching when invalidations can no longer be received """
+        pubsub = Product.redis.pubsub()
+        with patch.object(pubsub, 'get_message',
+                          side_effect=ConnectionError('gone')), \
+                patch.object(Product.redis, 'pubsub', return_value=pubsub):
+            Product.enable_cache(maxsize=10)
+            try:
+                for _ in range(20):
+                    if Product.cache is None:
+                        break
+                    time.sleep(0.05)
+                self.assertIsNone(Product.cache)
+            finally:
+                Product.disable_cache()
+
     def test_passing_connection(self):
         """ Pass in the Redis connection """
         Product.init_db()
         self.assertIsNotNone(Product.redis)
 
+    def test_remove_all_keeps_other_data(self):
+        """ Reset only the keys under the prefix """
+        Product.redis.set('other:tenant', 'keep me')
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product.remove_all(batch_size=2)
+        self.assertEqual(Product.all(), [])
+        self.assertEqual(Product.find_by_category('laptop'), [])
+        self.assertEqual(Product.redis.get('other:tenant'), b'keep me')
+        self.assertEqual(Product.redis.keys(Product.record_key + '*'), [])
+        Product.redis.delete('other:tenant')
+
+    def test_use_prefix(self):
+        """ Keep the Products of two prefixes apart """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        prefix = Product.prefix
+        try:
+            Product.init_db(prefix='tenant:')
+            Product.remove_all()
+            self.assertEqual(Product.all(), [])
+            Product(0, 'GE4509', 'Microwave', '34324',
+                    'microwave', 'black', 1).save()
+            self.assertTrue(Product.redis.exists('tenant:product:1'))
+            Product.remove_all()
+        finally:
+            Product.use_prefix(prefix)
+        self.assertEqual(Product.find(1).name, 'Asus2500')
+
+    def test_migrate_keys(self):
+        """ Move keys written before the prefix under it """
+        data = {"id": 1, "name": "Asus2500", "category": "Laptop",
+                "price": "234", "description": "laptop",
+                "color": "blue", "count": 4}
+        if Product.storage == 'hash':
+            Product.redis.hset('1', mapping=dict(
+                (field, json.dumps(value)) for field, value in data.items()))
+        else:
+            Product.redis.set('1', pickle.dumps(data))
+        Product.redis.set('index', 1)
+        Product.redis.hset('versions', 1, 7)
+        # keys of other applications that share the database
+        Product.redis.set('2', 'not a product')
+        Product.redis.set('3', pickle.dumps(dict(data, id=1)))
+        Product.redis.hset('4', 'name', json.dumps('Asus2500'))
+        Product.redis.hset('inventory', 'sku-1', 5)
+        self.assertEqual(Product.migrate_keys(), 3)
+        self.assertEqual(Product.redis.get(Product.counter_key), b'1')
+        self.assertEqual(Product.get_version(1), 7)
+        self.assertEqual(Product.redis.get('2'), b'not a product')
+        self.assertEqual(Product.redis.exists('3', '4', 'inventory'), 3)
+        Product.redis.delete('2', '3', '4', 'inventory')
+        self.assertEqual(Product.find_by_category('laptop')[0].count, 4)
+        Product.remove_all()
+        self.assertIsNone(Product.redis.get(Product._key(1)))
+
+    def test_migrate_keys_keeps_existing_keys(self):
+        """ Never move a foreign key over a key under the prefix """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product.redis.set('index', 'other-app-counter')
+        Product.redis.hset('inventory', 1, 99)
+        self.assertEqual(Product.migrate_keys(), 0)
+        self.assertEqual(Product.redis.get(Product.counter_key), b'1')
+        self.assertEqual(Product.redis.get('index'), b'other-app-counter')
+        self.assertEqual(Product.redis.hget('inventory', 1), b'99')
+        self.assertEqual(Product.find(1).count, 4)
+        # a legacy record moves, its versions may not replace the live ones
+        data = {'id': 5, 'name': 'Hp', 'category': 'Laptop', 'price': '960',
+                'description': 'laptop', 'color': 'blue', 'count': 1}
+        if Product.storage == 'hash':
+            Product.redis.hset('5', mapping=dict(
+                (field, json.dumps(value)) for field, value in data.items()))
+        else:
+            Product.redis.set('5', pickle.dumps(data))
+        Product.redis.hset('versions', 5, 3)
+        version = Product.get_version(1)
+        self.assertEqual(Product.migrate_keys(), 1)
+        self.assertEqual(Product.get_version(1), version)
+        self.assertEqual(Product.redis.hget('versions', 5), b'3')
+        self.assertEqual(Product.find(5).name, 'Hp')
+        product = Product(0, 'GE4509', 'Microwave', '34324', 'micro',
+                          'black', 1)
+        product.save()
+        self.assertEqual(product.id, 2)
+        Product.redis.delete('index', 'inventory', 'versions')
+        Product.remove_all()
+        self.assertIsNone(Product.redis.get(Product._key(1)))
+
+    def test_pool_stats(self):
+        """ Report the usage of the connection pool """
+        stats = Product.pool_stats()
+        self.assertIn('in_use', stats)
+        self.assertGreater(stats['max_connections'], 0)
+
     def test_passing_bad_connection(self):
         """ Pass in a bad Redis connection """
         self.assertRaises(ConnectionError, Product.init_db,
@@ -211,6 +875,65 @@ class TestProduct(unittest.TestCase):
         self.assertIsNone(Product.redis)
 
 
+class TestProductHashStorage(TestProduct):
+    """ Runs the Product Test Cases against the hash storage layout """
+
+    def setUp(self):
+        """ Switch to hash storage and initialize the db """
+        self.storage = Product.storage
+        Product.storage = 'hash'
+        TestProduct.setUp(self)
+
+    def tearDown(self):
+        """ Restore the storage layout """
+        Product.storage = self.storage
+
+    def test_adjust_count_of_older_record(self):
+        """ Hashes never predate the inventory so there is nothing to seed """
+        pass
+
+    def test_stored_as_hash(self):
+        """ Save a Product as a hash of JSON encoded fields """
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        self.assertEqual(Product.redis.hget(Product._key(1), 'name'),
+                         b'"Asus2500"')
+        self.assertEqual(Product.redis.hget(Product._key(1), 'count'), b'4')
+
+    def test_concurrent_full_updates(self):
+        """ Never merge two concurrent updates into one record """
+        Product(0, 'iPad', 'Tablet', '499', 'ipad', 'grey', 4).save()
+        first = Product(1, 'iPhone', 'Phone', '999', 'iphone', 'black', 4)
+        second = Product(1, 'iPad', 'Tablet', '399', 'ipad', 'grey', 4)
+        load = Product._Product__fetch_data
+
+        def racing_fetch(product_ids, fields=None):
+            """ Lets the first writer save right after the second read """
+            data = load(product_ids, fields)
+            if first.price == '999':
+                first.price = '899'
+                first.save()
+            return data
+
+        with patch.object(Product, '_Product__fetch_data',
+                          staticmethod(racing_fetch)):
+            second.save()
+        self.assertEqual(Product.find(1).serialize(), second.serialize())
+
+    def test_migrate_storage(self):
+        """ Convert Products stored as pickled blobs into hashes """
+        Product.storage = 'blob'
+        Product(0, 'Asus2500', 'Laptop', '234', 'laptop', 'blue', 4).save()
+        Product(0, 'GE4509', 'Microwave', '34324',
+                'microwave', 'black', 0).save()
+        Product.storage = 'hash'
+        self.assertEqual(Product.migrate_storage(), 2)
+        self.assertEqual(Product.migrate_storage(), 0)
+        product = Product.find(1)
+        self.assertEqual(product.name, 'Asus2500')
+        self.assertEqual(product.count, 4)
+        self.assertIsNone(Product.redis.hget(Product.inventory_key, 1))
+
+
 ######################################################################
 #   M A I N
 ######################################################################
@@ -0,0 +1,46 @@
+""" Test cases for the Product serialization codecs """
+import pickle
+import unittest
+import serializers
+
+PRODUCT = {"id": 1, "name": "Asus2500", "category": "Laptop",
+           "price": "234", "description": "laptop",
+           "color": "blue", "count": 4}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestSerializers(unittest.TestCase):
+    """ Test Cases for the codecs """
+
+    def test_round_trip(self):
+        """ Encode and decode a Product with every codec """
+        for name in serializers.CODECS:
+            if name == 'msgpack' and serializers.msgpack is None:
+                continue
+            codec = serializers.get_codec(name)
+            record = serializers.encode(PRODUCT, codec)
+            self.assertEqual(record[:2], serializers.HEADER + codec.tag)
+            self.assertEqual(serializers.decode(record), PRODUCT)
+
+    def test_decode_untagged_pickle(self):
+        """ Decode a record written before codecs existed """
+        record = pickle.dumps(PRODUCT)
+        self.assertEqual(serializers.decode(record), PRODUCT)
+
+    def test_decode_unknown_tag(self):
+        """ Decode a record with a tag no codec owns """
+        self.assertRaises(ValueError, serializers.decode, b'\x00zdata')
+
+    def test_unknown_codec(self):
+        """ Ask for a codec that doesn't exist """
+        self.assertRaises(ValueError, serializers.get_codec, 'yaml')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
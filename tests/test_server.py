@@ -6,6 +6,7 @@ import json
 from mock import MagicMock, patch
 from flask_api import status    # HTTP Status Codes
 import server
+import metrics
 
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
@@ -56,12 +57,211 @@ class TestProductServer(unittest.TestCase):
         self.assertTrue(len(resp.data) > 0)
         # self.assertEqual(len(data), 3)
 
+    def test_get_product_list_by_page(self):
+        """ Get the list of Products one page at a time """
+        resp = self.app.get('/products', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['id'] for p in data], [1, 2])
+        link = resp.headers.get('Link')
+        self.assertIn('rel="next"', link)
+        next_url = link[link.index('<') + 1:link.index('>')]
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['id'] for p in data], [3])
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_get_product_list_bad_cursor(self):
+        """ Get a page of Products with a bad cursor """
+        resp = self.app.get('/products', query_string='cursor=bogus')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_product_list_by_price(self):
+        """ Query Products in a price range sorted by price """
+        resp = self.app.get('/products',
+                            query_string='min_price=100&sort=-price&limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Hp'])
+        link = resp.headers.get('Link')
+        next_url = link[link.index('<') + 1:link.index('>')]
+        resp = self.app.get(next_url)
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Asus2500'])
+        self.assertIsNone(resp.headers.get('Link'))
+
+    def test_search_products(self):
+        """ Search Products by the words of their description """
+        resp = self.app.get('/products?q=open+BOX')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['GE4509'])
+        resp = self.app.get('/products?q=condition&limit=1')
+        self.assertEqual(len(json.loads(resp.data)), 1)
+        self.assertNotIn('Link', resp.headers)
+
+    def test_metrics(self):
+        """ Report request and Product method metrics """
+        metrics.reset()
+        self.app.get('/products/1')
+        self.app.get('/products/0')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        text = resp.get_data(as_text=True)
+        self.assertIn('http_requests_total{method="GET",'
+                      'route="/products/<int:products_id>",status="200"} 1',
+                      text)
+        self.assertIn('http_request_errors_total{method="GET",'
+                      'route="/products/<int:products_id>",status="404"} 1',
+                      text)
+        self.assertIn('product_method_duration_seconds_count'
+                      '{method="find"} 2', text)
+
+    def test_metrics_of_unhandled_error(self):
+        """ Report a request that failed with an unhandled exception """
+        metrics.reset()
+        with patch('server.Product.adjust_count',
+                   MagicMock(side_effect=RuntimeError('boom'))):
+            resp = self.app.put('/products/1/add_unit')
+        self.assertEqual(resp.status_code,
+                         status.HTTP_500_INTERNAL_SERVER_ERROR)
+        text = self.app.get('/metrics').get_data(as_text=True)
+        self.assertIn('http_request_errors_total{method="PUT",'
+                      'route="/products/<int:id>/add_unit",status="500"} 1',
+                      text)
+        self.assertEqual(metrics.REQUESTS.get(
+            ('GET', '/metrics', '200')), 1)
+
+    def test_get_product_list_json(self):
+        """ List every Product through the JSON fast path """
+        resp = self.app.get('/products')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = sorted(json.loads(resp.data), key=lambda p: p['id'])
+        self.assertEqual(data[2], {'id': 3, 'name': 'Hp',
+                                   'category': 'Microwave', 'price': '960',
+                                   'description': 'Brand New',
+                                   'color': 'Blue', 'count': 0})
+
+    def test_get_product_fields(self):
+        """ Get only some fields of Products """
+        resp = self.app.get('/products?fields=id,name&sort=price')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0], {'id': 2, 'name': 'GE4509'})
+        resp = self.app.get('/products/3?fields=price')
+        self.assertEqual(json.loads(resp.data), {'price': '960'})
+        resp = self.app.get('/products/9?fields=price')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/products?fields=name,secret')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_products_by_ids(self):
+        """ Get several Products by id in one request """
+        resp = self.app.get('/products?ids=3,9,1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data['products']],
+                         ['Hp', 'Asus2500'])
+        self.assertEqual(data['missing'], [9])
+        resp = self.app.get('/products?ids=1,x')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products?ids=')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_filter_product_list(self):
+        """ Query Products by several filters at once """
+        resp = self.app.get('/products?category=microwave&color=black')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['GE4509'])
+        resp = self.app.get('/products?category=microwave&available=true')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['GE4509'])
+        resp = self.app.get('/products?color=blue&name=hp&available=false')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Hp'])
+        resp = self.app.get('/products?category=microwave&min_price=500')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Hp'])
+        resp = self.app.get('/products?category=microwave&sort=-price')
+        data = json.loads(resp.data)
+        self.assertEqual([p['name'] for p in data], ['Hp', 'GE4509'])
+        resp = self.app.get('/products?q=brand&category=laptop')
+        self.assertEqual(json.loads(resp.data), [])
+        resp = self.app.get('/products?q=brand&sort=price')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products?ids=1&category=laptop')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products?available=maybe')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_suggest_product_names(self):
+        """ Suggest Product names for a prefix """
+        resp = self.app.get('/products/suggest?prefix=g&limit=5')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(resp.data), ['GE4509'])
+        resp = self.app.get('/products/suggest?prefix=g&limit=x')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_product_list_bad_price(self):
+        """ Query Products with a price that isn't a number """
+        resp = self.app.get('/products', query_string='min_price=cheap')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for value in ('nan', 'inf', '-Infinity'):
+            resp = self.app.get('/products', query_string='min_price=' + value)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_query_product_list_bad_sort(self):
+        """ Query Products sorted by a field that can't be sorted on """
+        resp = self.app.get('/products', query_string='sort=bogus')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        data = json.loads(resp.data)
+        self.assertIn('Invalid sort', data['message'])
+
+    def test_export_products_ndjson(self):
+        """ Export every Product as NDJSON """
+        resp = self.app.get('/products/export')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        rows = [json.loads(line) for line in resp.data.splitlines()]
+        self.assertEqual(sorted(row['id'] for row in rows), [1, 2, 3])
+
+    def test_export_products_csv(self):
+        """ Export every Product as CSV """
+        resp = self.app.get('/products/export', query_string='format=csv')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'text/csv')
+        lines = resp.data.splitlines()
+        self.assertEqual(lines[0], b'id,name,category,price,description,color,count')
+        self.assertEqual(len(lines), 4)
+
+    def test_export_products_bad_format(self):
+        """ Export the Products in a format that isn't supported """
+        resp = self.app.get('/products/export', query_string='format=xml')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_list_available_products(self):
         resp = self.app.get('/products/available')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         data = json.loads(resp.data)
         self.assertEqual(len(data), 2)
 
+    def test_list_products_from_response_cache(self):
+        """ Serve a repeated list from cache until the catalog changes """
+        hits = server.response_cache.stats()['hits']
+        first = self.app.get('/products/available').data
+        second = self.app.get('/products/available')
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data, first)
+        self.assertEqual(server.response_cache.stats()['hits'], hits + 1)
+        resp = self.app.put('/products/2/inventory',
+                            data=json.dumps({'delta': -12}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get('/products/available')
+        self.assertEqual(len(json.loads(resp.data)), 1)
+
     def test_get_product(self):
         """ Get one product """
         resp = self.app.get('/products/2')
@@ -69,6 +269,28 @@ class TestProductServer(unittest.TestCase):
         data = json.loads(resp.data)
         self.assertEqual(data['name'], 'GE4509')
 
+    def test_get_product_not_modified(self):
+        """ Answer 304 while a Product matches the If-None-Match ETag """
+        resp = self.app.get('/products/2')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/products/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b'')
+        self.app.put('/products/2/add_unit')
+        resp = self.app.get('/products/2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_get_product_list_not_modified(self):
+        """ Answer 304 while no Product changed since the list ETag """
+        etag = self.app.get('/products').headers['ETag']
+        resp = self.app.get('/products', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.app.delete('/products/3')
+        resp = self.app.get('/products', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(json.loads(resp.data)), 2)
+
     def test_get_product_count(self):
         """ Get one product """
         resp = self.app.get('/products/3')
@@ -108,6 +330,37 @@ class TestProductServer(unittest.TestCase):
         self.assertEqual(len(data), product_count + 1)
         self.assertIn(new_json, data)
 
+    def test_create_products_in_bulk(self):
+        """ Create many Products from a JSON array """
+        product_count = self.get_product_count()
+        new_products = [{'name': 'High_Sierra', 'category': 'Bag',
+                         'price': 1234, 'description': 'Cool Bag',
+                         'color': 'blue', 'count': 3},
+                        {'name': 'No_Price', 'category': 'Bag',
+                         'description': 'Cool Bag', 'color': 'blue',
+                         'count': 3}]
+        resp = self.app.post('/products/bulk', data=json.dumps(new_products),
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(data[0]['status'], status.HTTP_201_CREATED)
+        self.assertEqual(data[0]['id'], 4)
+        self.assertEqual(data[1]['status'], status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.get_product_count(), product_count + 1)
+
+    def test_create_products_in_bulk_ndjson(self):
+        """ Create many Products from NDJSON """
+        lines = [json.dumps({'name': 'Bag%d' % i, 'category': 'Bag',
+                             'price': 10, 'description': 'Cool Bag',
+                             'color': 'blue', 'count': i})
+                 for i in range(3)] + ['not json']
+        resp = self.app.post('/products/bulk', data='\n'.join(lines),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual([item['status'] for item in data],
+                         [201, 201, 201, 400])
+
     def test_update_product(self):
         """ Update a Product """
         upd_product = {'name': 'GE4509', 'category': 'Microwave',
@@ -122,6 +375,29 @@ class TestProductServer(unittest.TestCase):
         new_json = json.loads(resp.data)
         self.assertEqual(new_json['price'], '1000')
 
+    def test_update_product_if_match(self):
+        """ Refuse to update a Product that changed since its ETag """
+        etag = self.app.get('/products/2').headers['ETag']
+        self.app.put('/products/2/add_unit')
+        data = json.dumps({'name': 'GE4509', 'category': 'Microwave',
+                           'price': '1000', 'description': 'Dont buy',
+                           'color': 'faded', 'count': 6})
+        resp = self.app.put('/products/2', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        etag = self.app.get('/products/2').headers['ETag']
+        resp = self.app.put('/products/2', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        # a second writer holding the same ETag loses
+        resp = self.app.put('/products/2', data=data,
+                            content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
     def test_update_product_with_no_name(self):
         """ Update a Product with no name """
         new_product = {'category': 'Microwave', 'price': '1200',
@@ -177,6 +453,31 @@ class TestProductServer(unittest.TestCase):
                             content_type='application/json')
         self.assertEquals(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_adjust_inventory(self):
+        """ Add a delta to the count of a Product """
+        resp = self.app.put('/products/2/inventory',
+                            data=json.dumps({'delta': -5}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_json = json.loads(resp.data)
+        self.assertEqual(new_json['count'], 7)
+
+    def test_adjust_inventory_out_of_stock(self):
+        """ Remove more units of a Product than are in stock """
+        resp = self.app.put('/products/2/inventory',
+                            data=json.dumps({'delta': -13}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get('/products/2')
+        self.assertEqual(json.loads(resp.data)['count'], 12)
+
+    def test_adjust_inventory_bad_delta(self):
+        """ Add a delta that is not an integer """
+        resp = self.app.put('/products/2/inventory',
+                            data=json.dumps({'delta': 'lots'}),
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_delete_product(self):
         """ Delete a Product that exists """
         # save the current number of products for later comparrison